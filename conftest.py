@@ -44,7 +44,12 @@ if "surveys" not in settings.INSTALLED_APPS:
 # Use the MD5 password hasher by default for quicker test runs.
 PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',)
 """
-            f.write(test_settings + local_settings)
+            replica_settings = """
+# A second database to test routing reads to a replica
+DATABASES["replica"] = dict(DATABASES["default"], NAME="replica.db")
+DATABASE_ROUTERS = ["surveys.routers.ReplicaRouter"]
+"""
+            f.write(test_settings + local_settings + replica_settings)
 
         def cleanup_test_settings():
             import os  # Outer scope sometimes unavailable in atexit functions.
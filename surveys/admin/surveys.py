@@ -5,6 +5,11 @@ from __future__ import absolute_import, unicode_literals
 from copy import deepcopy
 
 from django.contrib import admin
+from django.core.exceptions import PermissionDenied
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.template.response import TemplateResponse
+from django.urls import re_path, reverse
 from django.utils.html import format_html
 from django.utils.translation import gettext_lazy as _
 
@@ -14,7 +19,10 @@ from mezzanine.utils.admin import admin_url
 
 from mezzy.utils.admin import LinkedInlineMixin
 
+from ..exports import iter_purchase_codes_csv
+from ..forms.surveys import PurchaseCodeGenerationForm
 from ..models import SurveyPage, SurveyPurchase, SurveyPurchaseCode, Category
+from ..routers import route_request
 
 
 surveypage_fieldsets = [
@@ -25,7 +33,8 @@ surveypage_fieldsets = [
     }),
     (_("Purchasing"), {
         "classes": ["collapse-closed"],
-        "fields": ["get_purchases_link", "cost", "purchase_response"],
+        "fields": [
+            "get_purchases_link", "get_generate_codes_link", "cost", "purchase_response"],
     }),
     (_("Instructions"), {
         "classes": ["collapse-closed"],
@@ -58,7 +67,7 @@ class SurveyPageAdmin(PageAdmin):
     Allows staff users to create and manage the available surveys.
     """
     fieldsets = surveypage_fieldsets
-    readonly_fields = ["get_purchases_link"]
+    readonly_fields = ["get_purchases_link", "get_generate_codes_link"]
     inlines = [SurveyPurchaseCodeInlineAdmin, CategoryInlineAdmin]
 
     def get_purchases_link(self, obj):
@@ -72,6 +81,49 @@ class SurveyPageAdmin(PageAdmin):
         )
     get_purchases_link.short_description = _("Purchases")
 
+    def get_generate_codes_link(self, obj):
+        if obj.pk is None:
+            return ""
+        return format_html(
+            "<a href='{}'>Generate purchase codes in bulk</a>",
+            reverse("admin:surveys_surveypage_generate_codes", args=[obj.pk]))
+    get_generate_codes_link.short_description = _("Purchase codes")
+
+    def get_urls(self):
+        urls = [
+            re_path(r"^(?P<object_id>\d+)/generate-codes/$",
+                    self.admin_site.admin_view(self.generate_codes_view),
+                    name="surveys_surveypage_generate_codes"),
+        ]
+        return urls + super(SurveyPageAdmin, self).get_urls()
+
+    def generate_codes_view(self, request, object_id):
+        """
+        Generate purchase codes for a survey and download them as CSV.
+        """
+        survey = get_object_or_404(SurveyPage, pk=object_id)
+        if not self.has_change_permission(request, survey):
+            raise PermissionDenied
+
+        form = PurchaseCodeGenerationForm(request.POST or None)
+        if form.is_valid():
+            codes = SurveyPurchaseCode.objects.generate(survey, **form.cleaned_data)
+            response = StreamingHttpResponse(
+                iter_purchase_codes_csv(codes), content_type="text/csv")
+            response["Content-Disposition"] = \
+                "attachment; filename=purchase-codes-%s.csv" % survey.slug.replace("/", "-")
+            return response
+
+        context = dict(
+            self.admin_site.each_context(request),
+            title=_("Generate purchase codes"),
+            opts=self.model._meta,
+            original=survey,
+            form=form,
+        )
+        return TemplateResponse(
+            request, "admin/surveys/surveypage/generate_codes.html", context)
+
 
 @admin.register(SurveyPurchase)
 class SurveyPurchaseAdmin(admin.ModelAdmin):
@@ -91,10 +143,20 @@ class SurveyPurchaseAdmin(admin.ModelAdmin):
                 "created"]
         }),
         ("Responses", {
-            "fields": ["get_public_link", "get_response_count", "report_generated"]
+            "fields": [
+                "get_public_link", "get_response_count", "report_generated", "report_status",
+                "ingest_token"]
         })
     ]
     readonly_fields = ["created", "get_response_count", "get_public_link"]
+    actions = ["generate_ingest_tokens"]
+
+    def changelist_view(self, request, extra_context=None):
+        """
+        Listing purchases is read from the replica, actions go to the primary.
+        """
+        return route_request(
+            request, super(SurveyPurchaseAdmin, self).changelist_view, request, extra_context)
 
     def get_response_count(self, obj):
         return obj.responses.count()
@@ -105,3 +167,12 @@ class SurveyPurchaseAdmin(admin.ModelAdmin):
             "<a href='{}' target='_blank'>Open public page</a>",
             obj.get_response_create_url())
     get_public_link.short_description = _("Public link")
+
+    def generate_ingest_tokens(self, request, queryset):
+        """
+        Give each selected purchase a new token for uploading responses (see SurveyPurchaseIngest).
+        """
+        for pk in queryset.values_list("pk", flat=True):
+            SurveyPurchase.objects.filter(pk=pk).update(
+                ingest_token=SurveyPurchase.generate_ingest_token())
+    generate_ingest_tokens.short_description = _("Generate ingest tokens")
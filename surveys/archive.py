@@ -0,0 +1,135 @@
+from __future__ import absolute_import, unicode_literals
+
+import json
+import zlib
+
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+
+# Columns of each archived QuestionResponse. The rest (prompts, titles, field types) is
+# read from the current survey tree, like the joins made for responses that aren't archived.
+ARCHIVE_FIELDS = ["response_id", "response__created", "question_id", "rating", "text_response"]
+
+CHUNK_SIZE = 64 * 1024
+
+
+def compress_rows(rows):
+    """
+    Compress rows of ARCHIVE_FIELDS as JSON lines. Returns a tuple of (data, count).
+    """
+    compressor = zlib.compressobj(9)
+    chunks = []
+    count = 0
+    for row in rows:
+        line = json.dumps(row, separators=(",", ":"), default=lambda value: value.isoformat())
+        chunks.append(compressor.compress(line.encode("utf-8") + b"\n"))
+        count += 1
+    chunks.append(compressor.flush())
+    return b"".join(chunks), count
+
+
+def decompress_rows(data):
+    """
+    Iterate over the rows of compressed `data` as tuples of ARCHIVE_FIELDS.
+    The data is decompressed one chunk at a time.
+    """
+    data = bytes(data)
+    decompressor = zlib.decompressobj()
+    pending = b""
+    for start in range(0, len(data), CHUNK_SIZE):
+        pending += decompressor.decompress(data[start:start + CHUNK_SIZE])
+        lines = pending.split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            yield parse_row(line)
+    pending += decompressor.flush()
+    if pending:
+        yield parse_row(pending)
+
+
+def parse_row(line):
+    response_id, created, question_id, rating, text_response = json.loads(line.decode("utf-8"))
+    return response_id, parse_datetime(created), question_id, rating, text_response
+
+
+def archive_purchase(purchase, chunk_size=2000):
+    """
+    Move the QuestionResponses of `purchase` into a new compressed segment of its archive.
+    Segments archived before are never read or rewritten, so purchases that received more
+    responses after being archived can be archived again. Returns the number of responses moved.
+    """
+    from .models import QuestionResponse, ResponseArchive, SurveyPurchase
+    with transaction.atomic():
+        # Archiving the same purchase concurrently would store its responses twice
+        list(SurveyPurchase.objects.select_for_update().filter(pk=purchase.pk).values("pk"))
+        responses = QuestionResponse.objects.filter(purchase=purchase)
+        last_pk = responses.order_by("-pk").values_list("pk", flat=True).first()
+        if last_pk is None:
+            return 0
+
+        # Responses saved while archiving aren't deleted, they'll be archived next time
+        responses = responses.filter(pk__lte=last_pk)
+        rows = responses.order_by("response_id", "pk") \
+            .values_list(*ARCHIVE_FIELDS) \
+            .iterator(chunk_size=chunk_size)
+        data, count = compress_rows(rows)
+        ResponseArchive.objects.create(purchase=purchase, data=data, count=count)
+        responses.delete()
+    return count
+
+
+def iter_archived_values(purchase, lookups, field_type=None):
+    """
+    Iterate over the archived responses of `purchase` as tuples of QuestionResponse
+    `lookups`, like `QuestionResponse.objects.values_list(*lookups)` would.
+    Segments are loaded and decompressed one at a time, oldest first.
+    Lookups that span the question are read from the survey in one query. Responses to
+    questions that have been deleted are skipped, as they would have been deleted with them.
+    Pass `field_type` to only get the responses to questions of that type.
+    """
+    from .models import Question, ResponseArchive
+    segments = ResponseArchive.objects.filter(purchase=purchase)
+    segment_ids = list(segments.order_by("pk").values_list("pk", flat=True))
+    if not segment_ids:
+        return
+
+    question_lookups = [lookup[len("question__"):] for lookup in lookups
+                        if lookup.startswith("question__")]
+    questions = dict(
+        (values[0], values[1:]) for values in Question.objects
+        .filter(survey=purchase.survey_id)
+        .values_list("pk", "field_type", *question_lookups))
+
+    for segment_id in segment_ids:
+        data = segments.filter(pk=segment_id).values_list("data", flat=True).get()
+        for row in decompress_rows(data):
+            question = questions.get(row[2])
+            if question is None or (field_type is not None and question[0] != field_type):
+                continue
+            values = []
+            for lookup in lookups:
+                if lookup in ARCHIVE_FIELDS:
+                    values.append(row[ARCHIVE_FIELDS.index(lookup)])
+                elif lookup == "question":
+                    values.append(row[2])
+                elif lookup == "field_type":
+                    values.append(question[0])
+                else:
+                    values.append(
+                        question[1 + question_lookups.index(lookup[len("question__"):])])
+            yield tuple(values)
+
+
+def get_response_histogram(purchase):
+    """
+    Count the rating responses of `purchase` by question and rating, archived or not.
+    Returns a dict in the same shape as QuestionResponseQuerySet.get_histogram().
+    """
+    from .models import Question, QuestionResponse
+    histogram = QuestionResponse.objects.filter(
+        purchase=purchase, field_type=Question.RATING_FIELD).get_histogram()
+    rows = iter_archived_values(
+        purchase, ["question", "rating"], field_type=Question.RATING_FIELD)
+    for question_id, rating in rows:
+        histogram[question_id][rating] = histogram[question_id].get(rating, 0) + 1
+    return histogram
@@ -0,0 +1,183 @@
+from __future__ import absolute_import, unicode_literals
+
+import json
+import logging
+import sqlite3
+import threading
+
+from collections import defaultdict
+from uuid import UUID, uuid4
+
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import now
+
+from mezzanine.conf import settings
+
+from .ingest import save_responses
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseBuffer(object):
+    """
+    Durable append-only log of validated survey submissions, kept in a local SQLite database
+    in WAL mode. Web processes append submissions to it and `flush_buffer` moves them to
+    the main database in large batches.
+    Every buffer file gets a random ID on creation, used to track what has been flushed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    def get_connection(self):
+        """
+        SQLite connections can't be shared between threads, each one opens its own.
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=FULL")  # Appends survive power loss
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS submissions "
+                "(id INTEGER PRIMARY KEY AUTOINCREMENT, data TEXT NOT NULL)")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            connection.execute(
+                "INSERT OR IGNORE INTO meta (key, value) VALUES ('buffer_id', ?)", [uuid4().hex])
+            self._local.connection = connection
+        return connection
+
+    def close(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    @property
+    def buffer_id(self):
+        return self.get_connection().execute(
+            "SELECT value FROM meta WHERE key = 'buffer_id'").fetchone()[0]
+
+    def __len__(self):
+        return self.get_connection().execute("SELECT COUNT(*) FROM submissions").fetchone()[0]
+
+    def append(self, purchase_id, created, token, responses):
+        """
+        Durably store a submission. `token` is the submission token of the response (or None)
+        and `responses` is a list of (question_id, rating, text_response, is_rating) tuples.
+        """
+        data = json.dumps({
+            "purchase": purchase_id,
+            "created": created.isoformat(),
+            "token": token,
+            "responses": responses,
+        })
+        self.get_connection().execute("INSERT INTO submissions (data) VALUES (?)", [data])
+
+    def read(self, after=0, limit=None):
+        """
+        Get the submissions after the entry `after` as a list of (entry_id, data) tuples.
+        """
+        rows = self.get_connection().execute(
+            "SELECT id, data FROM submissions WHERE id > ? ORDER BY id LIMIT ?",
+            [after, -1 if limit is None else limit])
+        return [(entry_id, json.loads(data)) for entry_id, data in rows]
+
+    def discard(self, up_to):
+        """
+        Remove the submissions up to the entry `up_to` once they're in the main database.
+        """
+        self.get_connection().execute("DELETE FROM submissions WHERE id <= ?", [up_to])
+
+
+_buffers = {}
+_buffers_lock = threading.Lock()
+
+
+def get_response_buffer():
+    """
+    Get the buffer configured in SURVEYS_RESPONSE_BUFFER, or None if buffering is disabled.
+    """
+    path = settings.SURVEYS_RESPONSE_BUFFER
+    if not path:
+        return None
+    with _buffers_lock:
+        if path not in _buffers:
+            _buffers[path] = ResponseBuffer(path)
+        return _buffers[path]
+
+
+def flush_buffer(buffer, batch_size=None):
+    """
+    Move up to `batch_size` buffered submissions to the main database in one transaction.
+    The last flushed entry is stored in the same transaction, so submissions are saved
+    exactly once even if the process dies before they're discarded from the buffer.
+    Responses to purchases or questions deleted in the meantime are dropped, as well as
+    retried submissions whose token has already been saved. Like uploads, responses to
+    purchases closed in the meantime (their report has been generated) are dropped too.
+    Returns the number of submissions flushed.
+    """
+    from .models import Question, QuestionResponse, ResponseBufferCheckpoint, SurveyPurchase
+    from .models import SurveyResponse
+    batch_size = batch_size or settings.SURVEYS_RESPONSE_BUFFER_BATCH_SIZE
+
+    with transaction.atomic():
+        checkpoint, _ = ResponseBufferCheckpoint.objects.select_for_update() \
+            .get_or_create(buffer_id=buffer.buffer_id)
+        entries = buffer.read(after=checkpoint.last_entry, limit=batch_size)
+
+        if entries:
+            purchases = SurveyPurchase.objects.only("pk", "report_generated").in_bulk(
+                set(data["purchase"] for _, data in entries))
+            question_ids = set(Question.objects.filter(pk__in=set(
+                response[0] for _, data in entries for response in data["responses"]))
+                .values_list("pk", flat=True))
+            tokens = set(UUID(data["token"]) for _, data in entries if data.get("token"))
+            saved_tokens = set(SurveyResponse.objects.filter(
+                purchase__in=purchases, submission_token__in=tokens)
+                .values_list("purchase", "submission_token")) if tokens else set()
+
+            grouped = defaultdict(list)
+            closed = 0
+            for entry_id, data in entries:
+                purchase = purchases.get(data["purchase"])
+                if purchase is None:
+                    continue
+                if purchase.report_generated is not None:
+                    closed += 1
+                    continue
+                token = UUID(data["token"]) if data.get("token") else None
+                if token is not None:
+                    if (purchase.pk, token) in saved_tokens:
+                        continue
+                    saved_tokens.add((purchase.pk, token))
+                survey_response = SurveyResponse(
+                    purchase=purchase, created=parse_datetime(data["created"]), updated=now(),
+                    submission_token=token)
+                question_responses = []
+                rating_responses = []
+                for question_id, rating, text_response, is_rating in data["responses"]:
+                    if question_id not in question_ids:
+                        continue
+                    response = QuestionResponse(
+                        response=survey_response, question_id=question_id, rating=rating,
+                        text_response=text_response, purchase=purchase,
+                        field_type=Question.RATING_FIELD if is_rating else Question.TEXT_FIELD)
+                    question_responses.append(response)
+                    if is_rating:
+                        rating_responses.append(response)
+                grouped[purchase].append((survey_response, question_responses, rating_responses))
+
+            for purchase, responses in grouped.items():
+                save_responses(purchase, responses)
+            if closed:
+                logger.warning("Dropped %s buffered responses to closed purchases", closed)
+
+            checkpoint.last_entry = entries[-1][0]
+            checkpoint.save()
+
+    buffer.discard(checkpoint.last_entry)
+    return len(entries)
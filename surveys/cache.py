@@ -0,0 +1,101 @@
+from __future__ import absolute_import, unicode_literals
+
+import json
+import threading
+
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+from mezzanine.conf import settings
+
+
+class LRUCache(object):
+    """
+    Thread-safe least recently used cache bounded by the total size of its values.
+    The size of each value is provided by the caller when setting it.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                size, value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = (size, value)  # Move to the most recently used position
+            return value
+
+    def set(self, key, value, size):
+        """
+        Values bigger than the whole cache are not stored.
+        """
+        with self._lock:
+            if key in self._data:
+                self.size -= self._data.pop(key)[0]
+            if size > self.max_size:
+                return
+            self._data[key] = (size, value)
+            self.size += size
+            while self.size > self.max_size:
+                self.size -= self._data.popitem(last=False)[1][0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+
+_reports = None
+_reports_lock = threading.Lock()
+
+
+def get_local_cache():
+    global _reports
+    with _reports_lock:
+        if _reports is None or _reports.max_size != settings.SURVEYS_REPORT_CACHE_SIZE:
+            _reports = LRUCache(settings.SURVEYS_REPORT_CACHE_SIZE)
+    return _reports
+
+
+def get_shared_cache():
+    alias = settings.SURVEYS_REPORT_CACHE_BACKEND
+    return caches[alias] if alias else None
+
+
+def get_parsed_report(purchase):
+    """
+    Parse the cached report of `purchase`, memoized per report version.
+    Versions are identified by (purchase.pk, purchase.report_generated), so a new report
+    never hits an old entry. Parsed reports are shared and must not be modified.
+    The report_cache field is only accessed on misses, so it can be deferred in querysets.
+    """
+    if purchase.pk is None or purchase.report_generated is None:
+        return json.loads(purchase.report_cache)  # No versioned report yet
+
+    key = (purchase.pk, purchase.report_generated)
+    local_cache = get_local_cache()
+    report = local_cache.get(key)
+    if report is not None:
+        return report
+
+    shared_cache = get_shared_cache()
+    shared_key = "surveys.report.%s.%s" % (purchase.pk, purchase.report_generated.isoformat())
+    cached = shared_cache.get(shared_key) if shared_cache is not None else None
+    if cached is None:
+        raw_report = purchase.report_cache
+        cached = (len(raw_report), json.loads(raw_report))
+        if shared_cache is not None:
+            shared_cache.set(shared_key, cached)
+
+    size, report = cached
+    local_cache.set(key, report, size)
+    return report
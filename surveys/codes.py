@@ -0,0 +1,149 @@
+from __future__ import absolute_import, division, unicode_literals
+
+import hashlib
+import math
+import threading
+
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils.timezone import now
+
+from mezzanine.conf import settings
+
+from .cache import LRUCache, get_shared_cache
+
+
+class BloomFilter(object):
+    """
+    Compact set of strings that can return false positives but never false negatives.
+    Sized for `capacity` values with a false positive rate of `error_rate`.
+    """
+
+    def __init__(self, capacity, error_rate):
+        capacity = max(capacity, 1)
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+
+    def get_positions(self, value):
+        """
+        Derive the bit positions of a value from a single hash (double hashing).
+        """
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * second) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, value):
+        for position in self.get_positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self.get_positions(value))
+
+
+def build_code_filter(survey):
+    """
+    Collect the codes of `survey` with uses remaining into a BloomFilter, in one query.
+    """
+    from .models import SurveyPurchaseCode
+    codes = SurveyPurchaseCode.objects \
+        .filter(Q(uses_remaining__gt=0) | Q(shards__uses_remaining__gt=0), survey=survey) \
+        .values_list("code", flat=True) \
+        .distinct()
+    codes = list(codes)
+    code_filter = BloomFilter(len(codes), settings.SURVEYS_PURCHASE_CODE_FILTER_ERROR_RATE)
+    for code in codes:
+        code_filter.add(code)
+    return code_filter
+
+
+_filters = None
+_filters_lock = threading.Lock()
+
+
+def get_local_cache():
+    global _filters
+    with _filters_lock:
+        if _filters is None or \
+                _filters.max_size != settings.SURVEYS_PURCHASE_CODE_FILTER_CACHE_SIZE:
+            _filters = LRUCache(settings.SURVEYS_PURCHASE_CODE_FILTER_CACHE_SIZE)
+    return _filters
+
+
+def get_code_filter(survey):
+    """
+    Get the BloomFilter of the usable purchase codes of `survey`, memoized per code version.
+    Versions are identified by (survey.pk, survey.codes_updated), which is bumped whenever
+    codes are created, deleted or run out (see `invalidate_code_filter`). It's separate from
+    survey.updated so codes running out don't invalidate the form schema.
+    """
+    updated = survey.codes_updated.isoformat() if survey.codes_updated else None
+    key = (survey.pk, updated)
+    local_cache = get_local_cache()
+    code_filter = local_cache.get(key)
+    if code_filter is not None:
+        return code_filter
+
+    shared_cache = get_shared_cache()
+    shared_key = "surveys.code_filter.%s.%s" % key
+    code_filter = shared_cache.get(shared_key) if shared_cache is not None else None
+    if code_filter is None:
+        code_filter = build_code_filter(survey)
+        if shared_cache is not None:
+            shared_cache.set(shared_key, code_filter)
+
+    local_cache.set(key, code_filter, len(code_filter.bits))
+    return code_filter
+
+
+def invalidate_code_filter(survey_id):
+    """
+    Bump the code version of a survey so the filter of its codes is built again.
+    """
+    from .models import SurveyPage
+    SurveyPage.objects.filter(pk=survey_id).update(codes_updated=now())
+
+
+def get_client_ip(request):
+    """
+    Get the address of the client from SURVEYS_PURCHASE_CODE_IP_HEADER. Headers with a list
+    of addresses (like X-Forwarded-For) give the last one, added by the closest proxy.
+    """
+    addresses = request.META.get(settings.SURVEYS_PURCHASE_CODE_IP_HEADER, "")
+    return addresses.split(",")[-1].strip()
+
+
+def get_attempt_keys(request):
+    keys = ["surveys.code_attempts.ip.%s" % get_client_ip(request)]
+    if request.user.pk is not None:
+        keys.append("surveys.code_attempts.user.%s" % request.user.pk)
+    return keys
+
+
+def is_attempt_limited(request):
+    """
+    Check if the client has made too many failed purchase code attempts recently.
+    Clients are tracked by IP address and user in the default cache.
+    """
+    limit = settings.SURVEYS_PURCHASE_CODE_ATTEMPTS
+    if not limit:
+        return False
+    attempts = cache.get_many(get_attempt_keys(request))
+    return any(count >= limit for count in attempts.values())
+
+
+def add_failed_attempt(request):
+    """
+    Count a failed purchase code attempt. Counters expire
+    SURVEYS_PURCHASE_CODE_ATTEMPTS_PERIOD seconds after the first failure.
+    """
+    if not settings.SURVEYS_PURCHASE_CODE_ATTEMPTS:
+        return
+    for key in get_attempt_keys(request):
+        if not cache.add(key, 1, settings.SURVEYS_PURCHASE_CODE_ATTEMPTS_PERIOD):
+            try:
+                cache.incr(key)
+            except ValueError:  # Expired in the meantime
+                cache.add(key, 1, settings.SURVEYS_PURCHASE_CODE_ATTEMPTS_PERIOD)
@@ -1,5 +1,7 @@
 from __future__ import absolute_import, unicode_literals
 
+from django.utils.translation import gettext_lazy as _
+
 from mezzanine.conf import register_setting
 
 register_setting(
@@ -13,3 +15,174 @@ register_setting(
     default="surveys.views.SurveyPurchaseReport",
     editable=False,
 )
+
+register_setting(
+    name="SURVEYS_PURCHASE_CODE_SHARDS",
+    description=_("Number of rows the uses of a purchase code are spread over, so codes with "
+                  "many uses can be redeemed concurrently without waiting on each other. "
+                  "Set to 1 to always decrement codes in place."),
+    default=8,
+    editable=False,
+)
+
+register_setting(
+    name="SURVEYS_PURCHASE_CODE_FILTER_ERROR_RATE",
+    description=_("False positive rate of the in-memory filters used to reject invalid "
+                  "purchase codes without querying the database."),
+    default=0.001,
+    editable=False,
+)
+
+register_setting(
+    name="SURVEYS_PURCHASE_CODE_FILTER_CACHE_SIZE",
+    description=_("Maximum size in bytes of the purchase code filters kept in memory by each "
+                  "process. Use 0 to disable the in-process cache."),
+    default=8 * 1024 * 1024,
+    editable=False,
+)
+
+register_setting(
+    name="SURVEYS_PURCHASE_CODE_ATTEMPTS",
+    description=_("Maximum number of failed purchase code attempts per IP address and user "
+                  "in SURVEYS_PURCHASE_CODE_ATTEMPTS_PERIOD. Attempts are counted in the "
+                  "default cache. Use 0 to disable the limit."),
+    default=10,
+    editable=False,
+)
+
+register_setting(
+    name="SURVEYS_PURCHASE_CODE_ATTEMPTS_PERIOD",
+    description=_("Seconds failed purchase code attempts are counted for."),
+    default=60 * 60,
+    editable=False,
+)
+
+register_setting(
+    name="SURVEYS_PURCHASE_CODE_IP_HEADER",
+    description=_("Key of request.META holding the client address that failed purchase code "
+                  "attempts are counted by. Only change it to a header set by your reverse "
+                  "proxy, clients can send any other header."),
+    default="REMOTE_ADDR",
+    editable=False,
+)
+
+register_setting(
+    name="SURVEYS_RESPONSE_CREATE_VIEW",
+    description=_("View used by respondents to take a survey. Use "
+                  "surveys.views.AsyncSurveyResponseCreate when serving the site with ASGI."),
+    default="surveys.views.SurveyResponseCreate",
+    editable=False,
+)
+
+register_setting(
+    name="SURVEYS_RESPONSE_COMPLETE_VIEW",
+    description=_("View displayed after a survey has been completed. Use "
+                  "surveys.views.AsyncSurveyResponseComplete when serving the site with ASGI."),
+    default="surveys.views.SurveyResponseComplete",
+    editable=False,
+)
+
+register_setting(
+    name="SURVEYS_RESPONSE_BUFFER",
+    description=_("Path of a local SQLite file where survey submissions are buffered before "
+                  "being moved to the database by the flush_response_buffer command. Leave "
+                  "empty to save submissions directly."),
+    default="",
+    editable=False,
+)
+
+register_setting(
+    name="SURVEYS_RESPONSE_BUFFER_BATCH_SIZE",
+    description=_("Maximum number of buffered submissions moved to the database in one "
+                  "transaction."),
+    default=5000,
+    editable=False,
+)
+
+register_setting(
+    name="SURVEYS_INGEST_MAX_RESPONSES",
+    description=_("Maximum number of responses accepted in a single JSON upload."),
+    default=10000,
+    editable=False,
+)
+
+register_setting(
+    name="SURVEYS_REPORT_ASYNC",
+    description=_("Generate survey reports in a background worker instead of during the request."),
+    default=False,
+    editable=False,
+)
+
+register_setting(
+    name="SURVEYS_REPORT_WORKERS",
+    description=_("Number of worker threads used to generate reports when SURVEYS_REPORT_ASYNC "
+                  "is enabled. Use 0 to run report jobs in the thread that enqueues them."),
+    default=1,
+    editable=False,
+)
+
+register_setting(
+    name="SURVEYS_REPORT_TIMEOUT",
+    description=_("Seconds after which a report job that's still pending or running is "
+                  "considered lost (e.g. its process was restarted) and can be enqueued again."),
+    default=60 * 60,
+    editable=False,
+)
+
+register_setting(
+    name="SURVEYS_REPORT_CACHE_SIZE",
+    description=_("Maximum size in bytes of the parsed reports kept in memory by each process. "
+                  "Use 0 to disable the in-process cache."),
+    default=32 * 1024 * 1024,
+    editable=False,
+)
+
+register_setting(
+    name="SURVEYS_READ_REPLICA",
+    description=_("Alias of the database report pages and the purchases admin read from. "
+                  "Requires surveys.routers.ReplicaRouter in DATABASE_ROUTERS. Leave empty to "
+                  "read everything from the default database."),
+    default="",
+    editable=False,
+)
+
+register_setting(
+    name="SURVEYS_READ_REPLICA_PIN_SECONDS",
+    description=_("Seconds a client reads from the default database after a write, so it "
+                  "sees its changes while the replica catches up."),
+    default=15,
+    editable=False,
+)
+
+register_setting(
+    name="SURVEYS_REPORT_CACHE_BACKEND",
+    description=_("Alias of a Django cache backend used to share parsed reports and survey "
+                  "form schemas between processes. Leave empty to only use the in-process "
+                  "caches."),
+    default="",
+    editable=False,
+)
+
+register_setting(
+    name="SURVEYS_FORM_SCHEMA_CACHE_SIZE",
+    description=_("Maximum number of compiled survey form schemas kept in memory by each "
+                  "process. Use 0 to disable the in-process cache."),
+    default=128,
+    editable=False,
+)
+
+register_setting(
+    name="SURVEYS_REPORT_STATISTICS",
+    description=_("Add median, standard deviation, percentiles, top/bottom 2 box and NPS to "
+                  "every node of the report. Requires numpy."),
+    default=False,
+    editable=False,
+)
+
+register_setting(
+    name="SURVEYS_REPORT_FRAGMENT_TIMEOUT",
+    description=_("Seconds to cache the rendered report results. Use 0 to disable fragment "
+                  "caching or None to cache them until the cache evicts them."),
+    default=7 * 24 * 60 * 60,
+    editable=False,
+)
@@ -0,0 +1,83 @@
+from __future__ import absolute_import, unicode_literals
+
+import csv
+import json
+
+from itertools import chain
+
+from .archive import iter_archived_values
+
+EXPORT_FIELDS = [
+    ("response_id", "response_id"),
+    ("created", "response__created"),
+    ("category", "question__subcategory__category__title"),
+    ("subcategory", "question__subcategory__title"),
+    ("question_id", "question_id"),
+    ("prompt", "question__prompt"),
+    ("rating", "rating"),
+    ("text_response", "text_response"),
+]
+
+PURCHASE_CODE_FIELDS = ["code", "uses_remaining"]
+
+
+class Echo(object):
+    """
+    File-like object that returns what's written to it instead of buffering it.
+    """
+
+    def write(self, value):
+        return value
+
+
+def iter_responses(purchase, chunk_size=2000):
+    """
+    Iterate over the QuestionResponses of a purchase as tuples of EXPORT_FIELDS.
+    Rows are fetched in chunks (with server-side cursors where the DB supports them),
+    so memory usage doesn't depend on the number of responses. Archived responses come
+    first and are decompressed as they're read.
+    """
+    from .models import QuestionResponse
+    lookups = [lookup for name, lookup in EXPORT_FIELDS]
+    rows = QuestionResponse.objects \
+        .filter(purchase=purchase) \
+        .order_by("response_id", "pk") \
+        .values_list(*lookups) \
+        .iterator(chunk_size=chunk_size)
+    return chain(iter_archived_values(purchase, lookups), rows)
+
+
+def iter_csv(rows):
+    """
+    Serialize rows as CSV, one line at a time, starting with a header.
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow([name for name, lookup in EXPORT_FIELDS])
+    for row in rows:
+        yield writer.writerow([value.isoformat() if hasattr(value, "isoformat") else value
+                               for value in row])
+
+
+def iter_purchase_codes_csv(codes):
+    """
+    Serialize SurveyPurchaseCodes as CSV, one line at a time, starting with a header.
+    """
+    writer = csv.writer(Echo())
+    yield writer.writerow(PURCHASE_CODE_FIELDS)
+    for code in codes:
+        yield writer.writerow([code.code, code.uses_remaining])
+
+
+def iter_ndjson(rows):
+    """
+    Serialize rows as newline delimited JSON objects.
+    """
+    names = [name for name, lookup in EXPORT_FIELDS]
+    for row in rows:
+        yield json.dumps(dict(zip(names, row)), default=lambda value: value.isoformat()) + "\n"
+
+
+EXPORT_FORMATS = {
+    "csv": (iter_csv, "text/csv"),
+    "ndjson": (iter_ndjson, "application/x-ndjson"),
+}
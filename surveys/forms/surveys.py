@@ -1,11 +1,16 @@
 from __future__ import absolute_import, unicode_literals
 
+from uuid import uuid4
+
 from django import forms
+from django.db import IntegrityError, transaction
+from django.utils.timezone import now
 from django.utils.translation import gettext_lazy as _
 
 from mezzy.utils.forms import UXFormMixin
 
-from ..models import SurveyPurchase, SurveyResponse, Question, QuestionResponse
+from ..models import SurveyPurchase, SurveyResponse, Question, QuestionResponse, RatingCounter
+from ..schema import get_form_schema
 
 
 class SurveyPurchaseForm(UXFormMixin, forms.ModelForm):
@@ -19,10 +24,23 @@ class SurveyPurchaseForm(UXFormMixin, forms.ModelForm):
         fields = []  # No model fields are user-editable
 
 
+class PurchaseCodeGenerationForm(forms.Form):
+    """
+    Number of purchase codes to generate in bulk from the admin.
+    """
+    count = forms.IntegerField(label=_("Number of codes"), min_value=1)
+    uses_remaining = forms.IntegerField(label=_("Uses per code"), min_value=1, initial=1)
+
+
 class SurveyResponseForm(forms.ModelForm):
     """
     Allows users to answer survey questions.
+    Every rendered form gets a one-time submission token, so the same submission is only
+    saved once no matter how many times it's posted.
+    The token is optional so responses can be submitted without a rendered form (see
+    `ingest.validate_response`). Submissions posted without it are never deduplicated.
     """
+    submission_token = forms.UUIDField(widget=forms.HiddenInput, required=False)
 
     class Meta:
         model = SurveyResponse
@@ -30,51 +48,105 @@ class SurveyResponseForm(forms.ModelForm):
 
     def __init__(self, *args, **kwargs):
         """
-        Create dynamic fields for each question in the SurveyPage.
+        Create dynamic fields for each question in the SurveyPage, or only for the questions
+        of one category if a `step` is given.
+        The fields are built from the cached form schema of the survey, without queries.
+        Views that already have the schema can pass it as `schema`.
         """
         self.purchase = kwargs.pop("purchase")
-        self.questions = self.purchase.survey.get_questions().order_by("field_type")
+        self.step = kwargs.pop("step", None)
+        self.schema = kwargs.pop("schema", None) or get_form_schema(self.purchase.survey)
         super(SurveyResponseForm, self).__init__(*args, **kwargs)
+        if not self.is_bound:
+            self.initial.setdefault("submission_token", uuid4())
 
-        for question in self.questions:
-            field_key = "question_%s" % question.pk
+        specs = self.schema.fields
+        if self.step is not None:
+            specs = self.schema.get_step_fields(self.step)
+        for spec in specs:
+            field_key = "question_%s" % spec.question_id
 
-            if question.field_type == Question.RATING_FIELD:
+            if spec.field_type == Question.RATING_FIELD:
                 field = forms.ChoiceField(
-                    label=question.prompt,
+                    label=spec.prompt,
                     widget=forms.RadioSelect,
-                    choices=((i, i) for i in self.purchase.survey.get_rating_choices()))
+                    choices=[(i, i) for i in self.schema.rating_choices])
                 field.type = "choicefield"  # Required to apply the right CSS rules
-            elif question.field_type == Question.TEXT_FIELD:
-                field = forms.CharField(label=question.prompt, widget=forms.Textarea)
+            elif spec.field_type == Question.TEXT_FIELD:
+                field = forms.CharField(label=spec.prompt, widget=forms.Textarea)
 
             # Use the HTML5 required attribute
-            if question.required:
+            if spec.required:
                 field.widget.attrs["required"] = ""
 
             self.fields[field_key] = field
 
-    def save(self, *args, **kwargs):
+    def get_question_responses(self, survey_response):
         """
-        Create a QuestionResponse for each Question.
+        Build an unsaved QuestionResponse for each Question from the cleaned data.
+        Inverted ratings are normalized in one batch.
         """
-        self.instance.purchase = self.purchase
-        survey_response = super(SurveyResponseForm, self).save(*args, **kwargs)
-
-        if survey_response.pk is None:
-            return survey_response  # Bail if the SurveyResponse wasn't saved to the DB
-
         question_responses = []
-        for question in self.questions:
-            value = self.cleaned_data.get("question_%s" % question.pk)
-            response = QuestionResponse(
+        for spec in self.schema.fields:
+            value = self.cleaned_data.get("question_%s" % spec.question_id)
+            question_responses.append(QuestionResponse(
                 response=survey_response,
-                question=question,
-                rating=value if question.field_type == Question.RATING_FIELD else None,
-                text_response=value if question.field_type == Question.TEXT_FIELD else ""
-            )
-            response.normalize_rating()
-            question_responses.append(response)
-        QuestionResponse.objects.bulk_create(question_responses)
+                question_id=spec.question_id,
+                purchase_id=self.purchase.pk,
+                field_type=spec.field_type,
+                rating=value if spec.field_type == Question.RATING_FIELD else None,
+                text_response=value if spec.field_type == Question.TEXT_FIELD else ""
+            ))
+
+        QuestionResponse.objects.normalize_ratings(
+            question_responses, self.schema.max_rating, self.schema.get_inverted_question_ids())
+        return question_responses
+
+    def save(self, *args, **kwargs):
+        """
+        Create a QuestionResponse for each Question.
+        The rating counters of the purchase are updated in the same transaction.
+        If the submission token has already been used for this purchase the original
+        SurveyResponse is returned and nothing is saved.
+        """
+        with transaction.atomic():
+            self.instance.purchase = self.purchase
+            self.instance.submission_token = self.cleaned_data.get("submission_token")
+            try:
+                with transaction.atomic():
+                    survey_response = super(SurveyResponseForm, self).save(*args, **kwargs)
+            except IntegrityError:
+                if self.instance.submission_token is None:
+                    raise
+                # Tokens are unique per purchase, so this is a retry of the same submission
+                survey_response = SurveyResponse.objects.filter(
+                    purchase=self.purchase,
+                    submission_token=self.instance.submission_token).first()
+                if survey_response is None:
+                    raise
+                return survey_response
+
+            if survey_response.pk is None:
+                return survey_response  # Bail if the SurveyResponse wasn't saved to the DB
+
+            question_responses = self.get_question_responses(survey_response)
+            QuestionResponse.objects.bulk_create(question_responses)
+
+            rating_question_ids = self.schema.get_rating_question_ids()
+            RatingCounter.objects.increment(self.purchase, [
+                r for r in question_responses if r.question_id in rating_question_ids])
 
         return survey_response
+
+    def save_to_buffer(self, buffer):
+        """
+        Append the responses to a ResponseBuffer instead of saving them to the database.
+        """
+        token = self.cleaned_data.get("submission_token")
+        rating_question_ids = self.schema.get_rating_question_ids()
+        buffer.append(self.purchase.pk, now(), token.hex if token else None, [
+            (r.question_id,
+             int(r.rating) if r.rating is not None else None,
+             r.text_response,
+             r.question_id in rating_question_ids)
+            for r in self.get_question_responses(None)])
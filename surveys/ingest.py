@@ -0,0 +1,96 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.db import connection, transaction
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import is_naive, make_aware, now
+
+from mezzanine.conf import settings
+
+
+def get_form_data(answers):
+    """
+    Convert the answers of an uploaded response, keyed by question id, into form data.
+    """
+    return dict(("question_%s" % question_id, "" if value is None else value)
+                for question_id, value in answers.items())
+
+
+def validate_response(purchase, item):
+    """
+    Validate an uploaded response against the survey definition.
+    Returns a tuple of (form, created, errors). Uploaded responses are objects in the form of
+    {"answers": {question_id: answer}, "created": "ISO 8601 date (optional)"}.
+    """
+    from .forms.surveys import SurveyResponseForm
+    if not isinstance(item, dict) or not isinstance(item.get("answers"), dict):
+        return None, None, {"__all__": ["Each response must be an object with answers."]}
+
+    created = now()
+    if item.get("created"):
+        try:
+            created = parse_datetime(item["created"])
+        except (TypeError, ValueError):
+            created = None
+        if created is None:
+            return None, None, {"created": ["Enter a valid date/time."]}
+        if settings.USE_TZ and is_naive(created):
+            created = make_aware(created)
+
+    form = SurveyResponseForm(data=get_form_data(item["answers"]), purchase=purchase)
+    errors = dict((field, list(messages)) for field, messages in form.errors.items())
+    unknown = set(form.data) - set(form.fields)
+    if unknown:
+        errors["__all__"] = ["Unknown questions: %s." % ", ".join(
+            sorted(key.replace("question_", "", 1) for key in unknown))]
+    return form, created, errors
+
+
+def save_responses(purchase, responses, batch_size=1000):
+    """
+    Save a batch of unsaved SurveyResponses of `purchase` with bulk inserts.
+    `responses` is a list of (survey_response, question_responses, rating_responses) where
+    the QuestionResponses point to their survey_response and rating_responses are the ones
+    added to the rating counters. Must be called in a transaction.
+    """
+    from .models import QuestionResponse, RatingCounter, SurveyResponse
+    survey_responses = [survey_response for survey_response, _, _ in responses]
+    if connection.features.can_return_rows_from_bulk_insert:
+        SurveyResponse.objects.bulk_create(survey_responses, batch_size=batch_size)
+    else:
+        # The primary keys are needed below. save_base() keeps the given created date,
+        # TimeStamped.save() would replace it.
+        for survey_response in survey_responses:
+            survey_response.save_base()
+
+    QuestionResponse.objects.bulk_create(
+        [r for _, question_responses, _ in responses for r in question_responses],
+        batch_size=batch_size)
+    RatingCounter.objects.increment(
+        purchase, [r for _, _, rating_responses in responses for r in rating_responses])
+
+
+def ingest_responses(purchase, items, batch_size=1000):
+    """
+    Validate and save a batch of uploaded responses for `purchase`.
+    Valid responses are saved together with bulk inserts and a single rating counter update;
+    invalid ones are skipped. Returns a tuple of (created, errors) where errors is a list of
+    {"index": position in `items`, "errors": {field: [messages]}}.
+    """
+    from .models import SurveyResponse
+    responses = []
+    errors = []
+    for index, item in enumerate(items):
+        form, created, item_errors = validate_response(purchase, item)
+        if item_errors:
+            errors.append({"index": index, "errors": item_errors})
+            continue
+        survey_response = SurveyResponse(purchase=purchase, created=created, updated=now())
+        question_responses = form.get_question_responses(survey_response)
+        rating_question_ids = form.schema.get_rating_question_ids()
+        responses.append((survey_response, question_responses, [
+            r for r in question_responses if r.question_id in rating_question_ids]))
+
+    if responses:
+        with transaction.atomic():
+            save_responses(purchase, responses, batch_size=batch_size)
+    return len(responses), errors
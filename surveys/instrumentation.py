@@ -0,0 +1,179 @@
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import time
+
+from contextlib import contextmanager
+
+from asgiref.sync import sync_to_async
+
+from django.db import connections
+from django.template.response import TemplateResponse
+
+from mezzanine.conf import settings
+
+logger = logging.getLogger("surveys.metrics")
+
+
+class RequestMetrics(object):
+    """
+    Query count, DB time and render time of a single request to a view.
+    Instances are installed as DB execute wrappers to record every query.
+    Queries run while rendering the template (menus, template tags, etc.) are counted
+    separately, only the queries run by the view itself are checked against the budget.
+    """
+
+    def __init__(self, view_name, query_budget=None):
+        self.view_name = view_name
+        self.query_budget = query_budget
+        self.queries = 0
+        self.render_queries = 0
+        self.db_time = 0
+        self.render_time = 0
+        self.rendering = False
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            if self.rendering:
+                self.render_queries += 1
+            else:
+                self.queries += 1
+            self.db_time += time.perf_counter() - start
+
+    def as_dict(self):
+        return {
+            "view": self.view_name,
+            "queries": self.queries,
+            "query_budget": self.query_budget,
+            "render_queries": self.render_queries,
+            "db_time": self.db_time,
+            "render_time": self.render_time,
+        }
+
+    def over_budget(self):
+        return self.query_budget is not None and self.queries > self.query_budget
+
+    def finish(self, response):
+        """
+        Log the metrics and add them to the response headers when DEBUG is enabled.
+        """
+        data = self.as_dict()
+        log = logger.warning if self.over_budget() else logger.info
+        log("%(view)s: %(queries)s queries (budget %(query_budget)s), "
+            "%(render_queries)s queries rendering, %(db_time).4fs in DB, "
+            "%(render_time).4fs rendering", data,
+            extra={"surveys_metrics": data})
+
+        if settings.DEBUG:
+            response["X-Surveys-Queries"] = str(self.queries)
+            response["X-Surveys-Query-Budget"] = str(self.query_budget)
+            response["X-Surveys-Render-Queries"] = str(self.render_queries)
+            response["X-Surveys-DB-Time"] = "%.6f" % self.db_time
+            response["X-Surveys-Render-Time"] = "%.6f" % self.render_time
+
+
+def add_execute_wrapper(wrapper):
+    for connection in connections.all():
+        connection.execute_wrappers.append(wrapper)
+
+
+def remove_execute_wrapper(wrapper):
+    for connection in connections.all():
+        connection.execute_wrappers.remove(wrapper)
+
+
+@contextmanager
+def execute_wrapper(wrapper):
+    """
+    Install `wrapper` on the connection of every database, like connection.execute_wrapper()
+    does for the default one, so queries sent to the read replica are recorded too.
+    """
+    add_execute_wrapper(wrapper)
+    try:
+        yield
+    finally:
+        remove_execute_wrapper(wrapper)
+
+
+class InstrumentedTemplateResponse(TemplateResponse):
+    """
+    Template response that adds the queries and time spent rendering to the view metrics.
+    """
+    metrics = None
+
+    def render(self):
+        if self.metrics is None or self.is_rendered:
+            return super(InstrumentedTemplateResponse, self).render()
+
+        start = time.perf_counter()
+        self.metrics.rendering = True
+        try:
+            with execute_wrapper(self.metrics):
+                response = super(InstrumentedTemplateResponse, self).render()
+        finally:
+            self.metrics.rendering = False
+        self.metrics.render_time = time.perf_counter() - start
+        self.metrics.finish(self)
+        return response
+
+
+class QueryBudgetMixin(object):
+    """
+    Records query count, DB time and render time for every request to a view.
+    Views declare the maximum number of queries a request should take in `query_budget`;
+    requests over budget are logged as warnings and fail QueryBudgetTestMixin assertions.
+    The metrics are available as `response.surveys_metrics`.
+    """
+    query_budget = None
+    response_class = InstrumentedTemplateResponse
+
+    def dispatch(self, request, *args, **kwargs):
+        metrics = RequestMetrics(self.__class__.__name__, self.query_budget)
+        if getattr(self, "view_is_async", False):
+            return self.dispatch_async(metrics, request, *args, **kwargs)
+
+        with execute_wrapper(metrics):
+            response = super(QueryBudgetMixin, self).dispatch(request, *args, **kwargs)
+        return self.add_metrics(metrics, response)
+
+    async def dispatch_async(self, metrics, request, *args, **kwargs):
+        """
+        The queries of async views run in a worker thread with its own DB connections,
+        so the metrics are installed on those connections.
+        """
+        await sync_to_async(add_execute_wrapper)(metrics)
+        try:
+            response = await super(QueryBudgetMixin, self).dispatch(request, *args, **kwargs)
+        finally:
+            await sync_to_async(remove_execute_wrapper)(metrics)
+        return self.add_metrics(metrics, response)
+
+    def add_metrics(self, metrics, response):
+        response.surveys_metrics = metrics
+        if isinstance(response, InstrumentedTemplateResponse) and not response.is_rendered:
+            response.metrics = metrics  # Metrics will be finished after rendering
+        else:
+            metrics.finish(response)
+        return response
+
+
+class QueryBudgetTestMixin(object):
+    """
+    Test helpers to check views stay within their query budget.
+    """
+
+    def assertWithinQueryBudget(self, response):
+        """
+        Check the queries run by the view that returned `response`.
+        """
+        metrics = response.surveys_metrics
+        self.assertIsNotNone(
+            metrics.query_budget, "%s doesn't declare a query budget" % metrics.view_name)
+        self.assertLessEqual(
+            metrics.queries, metrics.query_budget,
+            "%s ran %s queries, over its budget of %s" % (
+                metrics.view_name, metrics.queries, metrics.query_budget))
+        return metrics
@@ -0,0 +1,91 @@
+from __future__ import absolute_import, unicode_literals
+
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.db import connections, transaction
+from django.utils.timezone import now
+
+from mezzanine.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """
+    Lazily create the process wide thread pool used to run report jobs.
+    Returns None if jobs should run in the calling thread (SURVEYS_REPORT_WORKERS = 0).
+    """
+    global _executor
+    workers = settings.SURVEYS_REPORT_WORKERS
+    if not workers:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=workers)
+    return _executor
+
+
+def enqueue_report(purchase):
+    """
+    Mark the report of `purchase` as pending and schedule its generation.
+    The job is submitted once the current transaction commits, so the worker
+    always sees the pending status. Returns False if a job is already in progress.
+    Jobs started more than SURVEYS_REPORT_TIMEOUT seconds ago were lost and are replaced.
+    """
+    from .models import SurveyPurchase
+    in_progress = [SurveyPurchase.REPORT_PENDING, SurveyPurchase.REPORT_RUNNING]
+    started = now()
+    timeout = started - timedelta(seconds=settings.SURVEYS_REPORT_TIMEOUT)
+    updated = SurveyPurchase.objects \
+        .filter(pk=purchase.pk) \
+        .exclude(report_status__in=in_progress, report_started__gte=timeout) \
+        .update(report_status=SurveyPurchase.REPORT_PENDING, report_started=started)
+    if not updated:
+        return False
+
+    purchase.report_status = SurveyPurchase.REPORT_PENDING
+    purchase.report_started = started
+    transaction.on_commit(lambda: submit_report(purchase.pk))
+    return True
+
+
+def submit_report(purchase_id):
+    """
+    Run the report job in the thread pool, or right away if there are no workers.
+    """
+    executor = get_executor()
+    if executor is None:
+        return run_report(purchase_id)
+    return executor.submit(run_worker_report, purchase_id)
+
+
+def run_worker_report(purchase_id):
+    """
+    Worker threads get their own DB connections, close them once the job is done.
+    """
+    try:
+        run_report(purchase_id)
+    finally:
+        connections.close_all()
+
+
+def run_report(purchase_id):
+    """
+    Generate the report of a purchase and keep track of the job status.
+    Errors are logged and stored as a failed status instead of being raised.
+    """
+    from .models import SurveyPurchase
+    purchases = SurveyPurchase.objects.filter(pk=purchase_id)
+    try:
+        purchases.update(report_status=SurveyPurchase.REPORT_RUNNING, report_started=now())
+        purchases.select_related("survey").get().generate_report()
+    except Exception:
+        logger.exception("Failed to generate the report of purchase %s", purchase_id)
+        purchases.update(report_status=SurveyPurchase.REPORT_FAILED)
@@ -0,0 +1,38 @@
+from __future__ import absolute_import, unicode_literals
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+
+from ...archive import archive_purchase
+from ...models import SurveyPurchase
+
+
+class Command(BaseCommand):
+    """
+    Move the responses of closed purchases to their compressed archives.
+    """
+    help = ("Move the responses of closed purchases out of the responses table into "
+            "compressed per purchase archives.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=0,
+                            help="Only archive purchases closed at least DAYS days ago")
+        parser.add_argument("--chunk-size", type=int, default=2000,
+                            help="Responses read from the database in each query")
+
+    def handle(self, *args, **options):
+        purchases = SurveyPurchase.objects.closed() \
+            .filter(report_generated__lte=now() - timedelta(days=options["days"]),
+                    pk__in=SurveyPurchase.objects.filter(question_responses__isnull=False)) \
+            .only("pk", "survey", "public_id") \
+            .order_by("pk")
+
+        total = 0
+        for purchase in list(purchases):
+            moved = archive_purchase(purchase, chunk_size=options["chunk_size"])
+            total += moved
+            self.stdout.write("Archived %s response(s) of purchase %s" % (
+                moved, purchase.public_id))
+        self.stdout.write("Archived %s response(s)" % total)
@@ -0,0 +1,45 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from ...performance import run_benchmarks, write_results
+
+
+class Command(BaseCommand):
+    """
+    Measure wall time and query count of the survey hot paths against synthetic data.
+    """
+    help = ("Benchmark report generation, survey forms, and views with a synthetic survey. "
+            "All data is rolled back once the benchmarks finish.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--categories", type=int, default=5)
+        parser.add_argument("--subcategories", type=int, default=5,
+                            help="Subcategories per category")
+        parser.add_argument("--questions", type=int, default=10,
+                            help="Questions per subcategory")
+        parser.add_argument("--responses", type=int, default=100,
+                            help="Survey responses stored before running the benchmarks")
+        parser.add_argument("--repeat", type=int, default=3,
+                            help="Number of times each benchmark is run")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--no-render", action="store_false", dest="render",
+                            help="Don't render the templates of the views")
+        parser.add_argument("--output", default="surveys-benchmarks.json",
+                            help="Path of the JSON file where results are written")
+
+    def handle(self, *args, **options):
+        results = run_benchmarks(
+            categories=options["categories"],
+            subcategories=options["subcategories"],
+            questions=options["questions"],
+            responses=options["responses"],
+            repeat=options["repeat"],
+            render=options["render"],
+            seed=options["seed"])
+        write_results(results, options["output"])
+
+        for name, result in sorted(results["results"].items()):
+            self.stdout.write("%-20s %8.2f ms %6s queries" % (
+                name, result["median"] * 1000, result["queries"]))
+        self.stdout.write("Results written to %s" % options["output"])
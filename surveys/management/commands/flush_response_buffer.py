@@ -0,0 +1,38 @@
+from __future__ import absolute_import, unicode_literals
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...buffer import flush_buffer, get_response_buffer
+
+
+class Command(BaseCommand):
+    """
+    Move the survey submissions buffered in SURVEYS_RESPONSE_BUFFER to the database.
+    """
+    help = ("Flush the buffered survey submissions to the database in batches. "
+            "Run it on every host that buffers submissions.")
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=None,
+                            help="Submissions moved to the database in each transaction")
+        parser.add_argument("--interval", type=float, default=None,
+                            help="Keep running and flush the buffer every INTERVAL seconds")
+
+    def handle(self, *args, **options):
+        buffer = get_response_buffer()
+        if buffer is None:
+            raise CommandError("SURVEYS_RESPONSE_BUFFER is not set")
+
+        while True:
+            total = 0
+            flushed = flush_buffer(buffer, options["batch_size"])
+            while flushed:
+                total += flushed
+                flushed = flush_buffer(buffer, options["batch_size"])
+            self.stdout.write("Flushed %s submission(s)" % total)
+
+            if options["interval"] is None:
+                break
+            time.sleep(options["interval"])
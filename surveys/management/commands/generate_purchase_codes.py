@@ -0,0 +1,39 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...exports import iter_purchase_codes_csv
+from ...models import SurveyPage, SurveyPurchaseCode
+
+
+class Command(BaseCommand):
+    """
+    Generate purchase codes in bulk for a survey.
+    """
+    help = "Generate purchase codes for a survey and write them to stdout as CSV."
+
+    def add_arguments(self, parser):
+        parser.add_argument("survey", help="Slug or ID of the survey")
+        parser.add_argument("count", type=int, help="Number of codes to generate")
+        parser.add_argument("--uses", type=int, default=1,
+                            help="Number of times each code can be used")
+        parser.add_argument("--batch-size", type=int, default=500,
+                            help="Codes checked for collisions and inserted in each query")
+
+    def handle(self, *args, **options):
+        if options["count"] < 1 or options["uses"] < 1:
+            raise CommandError("The number of codes and uses must be positive")
+        surveys = SurveyPage.objects.all()
+        try:
+            if options["survey"].isdigit():
+                survey = surveys.get(pk=options["survey"])
+            else:
+                survey = surveys.get(slug=options["survey"])
+        except SurveyPage.DoesNotExist:
+            raise CommandError("Survey %s doesn't exist" % options["survey"])
+
+        codes = SurveyPurchaseCode.objects.generate(
+            survey, options["count"], uses_remaining=options["uses"],
+            batch_size=options["batch_size"])
+        for line in iter_purchase_codes_csv(codes):
+            self.stdout.write(line, ending="")
@@ -0,0 +1,35 @@
+from __future__ import absolute_import, unicode_literals
+
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils.timezone import now
+
+from ...models import SurveyResponseDraft
+
+
+class Command(BaseCommand):
+    """
+    Delete the drafts of paged surveys that respondents abandoned.
+    """
+    help = "Delete survey response drafts that haven't been updated in a number of days."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=7,
+                            help="Delete drafts last updated at least DAYS days ago")
+        parser.add_argument("--batch-size", type=int, default=1000,
+                            help="Drafts deleted in each query")
+
+    def handle(self, *args, **options):
+        drafts = SurveyResponseDraft.objects \
+            .filter(updated__lte=now() - timedelta(days=options["days"])) \
+            .order_by("pk")
+
+        total = 0
+        while True:
+            # Delete one batch at a time so the table isn't locked for long
+            pks = list(drafts.values_list("pk", flat=True)[:options["batch_size"]])
+            if not pks:
+                break
+            total += SurveyResponseDraft.objects.filter(pk__in=pks).delete()[0]
+        self.stdout.write("Deleted %s draft(s)" % total)
@@ -0,0 +1,42 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.core.management.base import BaseCommand, CommandError
+
+from ...archive import get_response_histogram
+from ...models import RatingCounter, SurveyPurchase
+
+
+class Command(BaseCommand):
+    """
+    Rebuild the RatingCounters of each purchase from its raw QuestionResponses.
+    """
+    help = "Rebuild rating counters from the stored responses and report any mismatches."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "public_ids", nargs="*", metavar="public_id",
+            help="Public IDs of the purchases to process (all purchases by default)")
+        parser.add_argument(
+            "--check", action="store_true", dest="check",
+            help="Only compare the counters, exit with an error if they don't match")
+
+    def handle(self, *args, **options):
+        purchases = SurveyPurchase.objects.order_by("pk")
+        if options["public_ids"]:
+            purchases = purchases.filter(public_id__in=options["public_ids"])
+
+        mismatches = 0
+        for purchase in purchases.iterator():
+            expected = get_response_histogram(purchase)
+            stored = RatingCounter.objects.filter(purchase=purchase).get_histogram()
+
+            if expected != stored:
+                mismatches += 1
+                self.stderr.write("Counters for purchase %s don't match" % purchase.public_id)
+                if not options["check"]:
+                    RatingCounter.objects.rebuild(purchase)
+                    self.stdout.write("Rebuilt counters for purchase %s" % purchase.public_id)
+
+        if options["check"] and mismatches:
+            raise CommandError("%s purchase(s) have mismatched counters" % mismatches)
+        self.stdout.write("Processed counters, %s mismatch(es) found" % mismatches)
@@ -1,6 +1,11 @@
 from __future__ import absolute_import, unicode_literals
 
-from django.db.models import QuerySet, Avg, Count
+from collections import defaultdict
+from functools import reduce
+from operator import or_
+
+from django.db import IntegrityError, transaction
+from django.db.models import QuerySet, Avg, Count, F, Q
 
 
 class SurveyPurchaseQuerySet(QuerySet):
@@ -18,17 +23,50 @@ class SurveyPurchaseQuerySet(QuerySet):
         return self.filter(report_generated__isnull=False)
 
 
+class SurveyPurchaseCodeQuerySet(QuerySet):
+
+    def generate(self, survey, count, uses_remaining=1, batch_size=500):
+        """
+        Create `count` new codes for `survey` with bulk inserts.
+        Codes are generated in memory and checked against the existing codes of the survey
+        one batch at a time, the ones that collide are replaced. Returns the created codes.
+        """
+        from .codes import invalidate_code_filter
+        codes = []
+        seen = set()
+        while len(codes) < count:
+            candidates = set()
+            while len(candidates) < min(batch_size, count - len(codes)):
+                code = self.model.generate_code()
+                if code not in seen:
+                    candidates.add(code)
+            candidates -= set(self.filter(survey=survey, code__in=candidates)
+                              .values_list("code", flat=True))
+            seen.update(candidates)
+            codes.extend(self.model(survey=survey, code=code, uses_remaining=uses_remaining)
+                         for code in candidates)
+
+        with transaction.atomic():
+            self.bulk_create(codes, batch_size=batch_size)
+            invalidate_code_filter(survey.pk)
+        return codes
+
+
 class RatingDataQuerySet(QuerySet):
     """
     Provides convenience methods for models that retrieve rating data.
     """
 
-    def get_rating_data(self, purchase):
+    def get_rating_data(self, purchase, histogram=None):
         """
         Generate rating data for all instances in the queryset.
         Instances that return None will be skipped.
+        Pass the `histogram` of the purchase to count its responses only once.
         """
-        nodes = (instance.get_rating_data(purchase) for instance in self)
+        if histogram is None:
+            from .archive import get_response_histogram
+            histogram = get_response_histogram(purchase)
+        nodes = (instance.get_rating_data(purchase, histogram) for instance in self)
         return list(n for n in nodes if n is not None)
 
 
@@ -50,3 +88,191 @@ class QuestionResponseQuerySet(QuerySet):
         """
         frequencies = dict(self.values_list("rating").annotate(Count("rating")))
         return [(choice, frequencies.get(choice, 0)) for choice in rating_choices]
+
+    def get_histogram(self):
+        """
+        Count responses grouped by question and rating in a single query.
+        Returns a dict in the form of {question_id: {rating: count}}.
+        Responses without a rating are counted under the None key.
+        """
+        rows = self.values_list("question", "rating").annotate(Count("pk")).order_by()
+        histogram = defaultdict(dict)
+        for question_id, rating, count in rows:
+            histogram[question_id][rating] = count
+        return histogram
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        self.denormalize(objs)
+        return super(QuestionResponseQuerySet, self).bulk_create(objs, *args, **kwargs)
+
+    def denormalize(self, question_responses):
+        """
+        Fill the purchase and field type copied onto a batch of unsaved QuestionResponses.
+        Values the caller already knows are kept, the rest are looked up in one query each.
+        """
+        from .models import Question, SurveyResponse
+        model = self.model
+        missing_responses = set()
+        missing_questions = set()
+        for response in question_responses:
+            if response.purchase_id is None:
+                if model.response.is_cached(response):
+                    response.purchase_id = response.response.purchase_id
+                else:
+                    missing_responses.add(response.response_id)
+            if response.field_type is None:
+                if model.question.is_cached(response):
+                    response.field_type = response.question.field_type
+                else:
+                    missing_questions.add(response.question_id)
+
+        purchase_ids = dict(SurveyResponse.objects.filter(pk__in=missing_responses)
+                            .values_list("pk", "purchase")) if missing_responses else {}
+        field_types = dict(Question.objects.filter(pk__in=missing_questions)
+                           .values_list("pk", "field_type")) if missing_questions else {}
+        for response in question_responses:
+            if response.purchase_id is None:
+                response.purchase_id = purchase_ids.get(response.response_id)
+            if response.field_type is None:
+                response.field_type = field_types.get(response.question_id)
+
+    def normalize_ratings(self, question_responses, max_rating, inverted_question_ids):
+        """
+        Invert the ratings of a batch of unsaved QuestionResponses in place.
+        `max_rating` and the ids of the questions with inverted ratings are resolved once
+        by the caller, so no related objects are loaded for each response.
+        """
+        for response in question_responses:
+            if response.rating is not None and response.question_id in inverted_question_ids:
+                response.rating = max_rating - int(response.rating) + 1
+
+
+class CounterQuerySet(QuerySet):
+    """
+    Maintains counters of ratings given to each question.
+    """
+
+    def get_histogram(self):
+        """
+        Returns the counters in the same shape as QuestionResponseQuerySet.get_histogram().
+        """
+        histogram = defaultdict(dict)
+        for question_id, rating, count in self.values_list("question", "rating", "count"):
+            if count:
+                histogram[question_id][rating] = histogram[question_id].get(rating, 0) + count
+        return histogram
+
+    def add_amounts(self, amounts, **fields):
+        """
+        Add `amounts` in the form of {(question_id, rating): amount} to the counters
+        that match `fields` (the purchase or survey the counters belong to).
+        Existing counters are incremented with one UPDATE per distinct amount,
+        missing counters are inserted with a single bulk_create.
+        """
+        amounts = dict((key, amount) for key, amount in amounts.items() if amount)
+        if not amounts:
+            return
+
+        with transaction.atomic():
+            counters = self.filter(**fields)
+            existing = set(counters
+                           .filter(question__in=set(key[0] for key in amounts))
+                           .values_list("question", "rating"))
+            missing = [key for key in amounts if key not in existing and amounts[key] > 0]
+
+            if missing:
+                try:
+                    with transaction.atomic():
+                        self.bulk_create([
+                            self.model(question_id=question_id, rating=rating,
+                                       count=amounts[(question_id, rating)], **fields)
+                            for question_id, rating in missing])
+                except IntegrityError:
+                    # Another transaction created some of the counters in the meantime
+                    for question_id, rating in missing:
+                        counter, created = self.get_or_create(
+                            question_id=question_id, rating=rating,
+                            defaults={"count": amounts[(question_id, rating)]}, **fields)
+                        if not created:
+                            existing.add((question_id, rating))
+
+            conditions = defaultdict(list)
+            for (question_id, rating), amount in amounts.items():
+                if (question_id, rating) in existing:
+                    conditions[amount].append(Q(question_id=question_id, rating=rating))
+            for amount, condition_list in conditions.items():
+                counters.filter(reduce(or_, condition_list)).update(count=F("count") + amount)
+
+
+class RatingCounterQuerySet(CounterQuerySet):
+    """
+    Maintains the per purchase rating counters.
+    """
+
+    def increment(self, purchase, question_responses):
+        """
+        Add a batch of QuestionResponses to the counters of `purchase`.
+        """
+        amounts = defaultdict(int)
+        for response in question_responses:
+            rating = int(response.rating) if response.rating is not None else None
+            amounts[(response.question_id, rating)] += 1
+        self.add_amounts(amounts, purchase=purchase)
+
+    def rebuild(self, purchase):
+        """
+        Replace the counters of `purchase` with fresh values calculated from its QuestionResponses.
+        The amounts already added to the survey benchmarks are kept, so the next time the
+        purchase is closed only the difference is added to them.
+        Returns the new histogram.
+        """
+        from .archive import get_response_histogram
+        histogram = get_response_histogram(purchase)
+
+        with transaction.atomic():
+            counters = self.filter(purchase=purchase)
+            benchmarked = dict(((question_id, rating), count) for question_id, rating, count in
+                               counters.values_list("question", "rating", "benchmarked_count"))
+            counts = dict(((question_id, rating), count)
+                          for question_id, ratings in histogram.items()
+                          for rating, count in ratings.items())
+            keys = set(counts) | set(key for key, count in benchmarked.items() if count)
+            counters.delete()
+            self.bulk_create([
+                self.model(purchase=purchase, question_id=question_id, rating=rating,
+                           count=counts.get((question_id, rating), 0),
+                           benchmarked_count=benchmarked.get((question_id, rating), 0))
+                for question_id, rating in keys])
+        return histogram
+
+
+class BenchmarkCounterQuerySet(CounterQuerySet):
+    """
+    Maintains the rating counters of all closed purchases of each survey.
+    """
+
+    def add_purchase(self, purchase):
+        """
+        Add the rating counters of `purchase` to the benchmarks of its survey.
+        Only the difference since the last time the purchase was added is counted,
+        so reports can be generated more than once for the same purchase.
+        """
+        from .models import RatingCounter
+        with transaction.atomic():
+            rating_counters = list(RatingCounter.objects
+                                   .select_for_update()
+                                   .filter(purchase=purchase)
+                                   .exclude(count=F("benchmarked_count"))
+                                   .values_list("pk", "question", "rating", "count",
+                                                "benchmarked_count"))
+            if not rating_counters:
+                return
+
+            self.add_amounts(dict(
+                ((question_id, rating), count - benchmarked_count)
+                for pk, question_id, rating, count, benchmarked_count in rating_counters),
+                survey_id=purchase.survey_id)
+            RatingCounter.objects \
+                .filter(pk__in=[counter[0] for counter in rating_counters]) \
+                .update(benchmarked_count=F("count"))
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models, transaction
+from django.db.models import Count, Max
+import django.db.models.deletion
+
+BATCH_SIZE = 1000
+RATING_FIELD = 1
+
+
+def backfill(apps, schema_editor):
+    """
+    Count the ratings of existing responses, one primary key range of purchases at a time
+    so every batch is a short transaction that writes all the counters of its purchases.
+    """
+    SurveyPurchase = apps.get_model("surveys", "SurveyPurchase")
+    QuestionResponse = apps.get_model("surveys", "QuestionResponse")
+    RatingCounter = apps.get_model("surveys", "RatingCounter")
+    db_alias = schema_editor.connection.alias
+    last_pk = SurveyPurchase.objects.using(db_alias).aggregate(Max("pk"))["pk__max"] or 0
+
+    for start in range(0, last_pk + 1, BATCH_SIZE):
+        with transaction.atomic(using=db_alias):
+            rows = QuestionResponse.objects.using(db_alias) \
+                .filter(response__purchase__gte=start,
+                        response__purchase__lt=start + BATCH_SIZE,
+                        question__field_type=RATING_FIELD) \
+                .values_list("response__purchase", "question", "rating") \
+                .annotate(Count("pk")) \
+                .order_by()
+            RatingCounter.objects.using(db_alias).bulk_create([
+                RatingCounter(purchase_id=purchase_id, question_id=question_id, rating=rating,
+                              count=count)
+                for purchase_id, question_id, rating, count in rows])
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('surveys', '0002_question_invert_rating'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RatingCounter',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('rating', models.PositiveSmallIntegerField(verbose_name='Rating', blank=True, null=True)),
+                ('count', models.PositiveIntegerField(verbose_name='Count', default=0)),
+                ('purchase', models.ForeignKey(related_name='rating_counters', to='surveys.SurveyPurchase', on_delete=django.db.models.deletion.CASCADE)),
+                ('question', models.ForeignKey(related_name='rating_counters', to='surveys.Question', on_delete=django.db.models.deletion.CASCADE)),
+            ],
+            options={
+                'verbose_name': 'rating counter',
+                'verbose_name_plural': 'rating counters',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='ratingcounter',
+            unique_together=set([('purchase', 'question', 'rating')]),
+        ),
+        migrations.AddConstraint(
+            model_name='ratingcounter',
+            constraint=models.UniqueConstraint(fields=['purchase', 'question'], condition=models.Q(rating__isnull=True), name='surveys_ratingcounter_null_rating_uniq'),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop, atomic=False),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0003_ratingcounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='surveypurchase',
+            name='report_status',
+            field=models.CharField(blank=True, choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], max_length=10, verbose_name='Report status'),
+        ),
+    ]
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models, transaction
+from django.db.models import F, Max, Sum
+import django.db.models.deletion
+
+BATCH_SIZE = 100
+
+
+def backfill(apps, schema_editor):
+    """
+    Add the rating counters of the purchases that are already closed to the benchmarks of
+    their survey, one primary key range of surveys at a time so every batch is a short
+    transaction that writes all the benchmarks of its surveys.
+    """
+    SurveyPage = apps.get_model("surveys", "SurveyPage")
+    RatingCounter = apps.get_model("surveys", "RatingCounter")
+    BenchmarkCounter = apps.get_model("surveys", "BenchmarkCounter")
+    db_alias = schema_editor.connection.alias
+    last_pk = SurveyPage.objects.using(db_alias).aggregate(Max("pk"))["pk__max"] or 0
+
+    for start in range(0, last_pk + 1, BATCH_SIZE):
+        with transaction.atomic(using=db_alias):
+            # Closed purchases are the ones with a generated report
+            counters = RatingCounter.objects.using(db_alias).filter(
+                purchase__survey__gte=start, purchase__survey__lt=start + BATCH_SIZE,
+                purchase__report_generated__isnull=False)
+            rows = counters \
+                .values_list("purchase__survey", "question", "rating") \
+                .annotate(Sum("count")) \
+                .order_by()
+            BenchmarkCounter.objects.using(db_alias).bulk_create([
+                BenchmarkCounter(survey_id=survey_id, question_id=question_id, rating=rating,
+                                 count=count)
+                for survey_id, question_id, rating, count in rows if count])
+            counters.update(benchmarked_count=F("count"))
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('surveys', '0004_surveypurchase_report_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ratingcounter',
+            name='benchmarked_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='Count added to benchmarks'),
+        ),
+        migrations.CreateModel(
+            name='BenchmarkCounter',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('rating', models.PositiveSmallIntegerField(verbose_name='Rating', blank=True, null=True)),
+                ('count', models.PositiveIntegerField(verbose_name='Count', default=0)),
+                ('question', models.ForeignKey(related_name='benchmark_counters', to='surveys.Question', on_delete=django.db.models.deletion.CASCADE)),
+                ('survey', models.ForeignKey(related_name='benchmark_counters', to='surveys.SurveyPage', on_delete=django.db.models.deletion.CASCADE)),
+            ],
+            options={
+                'verbose_name': 'benchmark counter',
+                'verbose_name_plural': 'benchmark counters',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='benchmarkcounter',
+            unique_together=set([('survey', 'question', 'rating')]),
+        ),
+        migrations.AddConstraint(
+            model_name='benchmarkcounter',
+            constraint=models.UniqueConstraint(fields=['survey', 'question'], condition=models.Q(rating__isnull=True), name='surveys_benchmarkcounter_null_rating_uniq'),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop, atomic=False),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0005_benchmarkcounter'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResponseBufferCheckpoint',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('buffer_id', models.CharField(verbose_name='Buffer ID', max_length=32, unique=True)),
+                ('last_entry', models.BigIntegerField(verbose_name='Last entry', default=0)),
+                ('updated', models.DateTimeField(verbose_name='Updated', auto_now=True)),
+            ],
+            options={
+                'verbose_name': 'response buffer checkpoint',
+                'verbose_name_plural': 'response buffer checkpoints',
+            },
+        ),
+    ]
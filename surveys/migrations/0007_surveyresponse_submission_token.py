@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0006_responsebuffercheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='surveyresponse',
+            name='submission_token',
+            field=models.UUIDField(verbose_name='Submission token', unique=True, null=True, blank=True, editable=False),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0007_surveyresponse_submission_token'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PurchaseCodeShard',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('index', models.PositiveSmallIntegerField(verbose_name='Index')),
+                ('uses_remaining', models.PositiveIntegerField(verbose_name='Remaining uses', default=0)),
+                ('code', models.ForeignKey(related_name='shards', to='surveys.SurveyPurchaseCode', on_delete=django.db.models.deletion.CASCADE)),
+            ],
+            options={
+                'verbose_name': 'purchase code shard',
+                'verbose_name_plural': 'purchase code shards',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='purchasecodeshard',
+            unique_together=set([('code', 'index')]),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0008_purchasecodeshard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SurveyResponseDraft',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('submission_token', models.UUIDField(verbose_name='Submission token', unique=True)),
+                ('answers', models.TextField(verbose_name='Answers', default='{}')),
+                ('updated', models.DateTimeField(verbose_name='Updated', auto_now=True)),
+                ('purchase', models.ForeignKey(related_name='drafts', to='surveys.SurveyPurchase', on_delete=django.db.models.deletion.CASCADE)),
+            ],
+            options={
+                'verbose_name': 'survey response draft',
+                'verbose_name_plural': 'survey response drafts',
+            },
+        ),
+    ]
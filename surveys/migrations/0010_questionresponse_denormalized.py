@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models, transaction
+from django.db.models import Max, OuterRef, Subquery
+import django.db.models.deletion
+
+BATCH_SIZE = 10000
+
+
+def backfill(apps, schema_editor):
+    """
+    Copy the purchase and field type onto existing responses, one primary key range at a
+    time so every batch is a short transaction.
+    """
+    QuestionResponse = apps.get_model("surveys", "QuestionResponse")
+    SurveyResponse = apps.get_model("surveys", "SurveyResponse")
+    Question = apps.get_model("surveys", "Question")
+    db_alias = schema_editor.connection.alias
+    responses = QuestionResponse.objects.using(db_alias)
+    last_pk = responses.aggregate(Max("pk"))["pk__max"] or 0
+
+    for start in range(0, last_pk + 1, BATCH_SIZE):
+        with transaction.atomic(using=db_alias):
+            responses.filter(pk__gte=start, pk__lt=start + BATCH_SIZE).update(
+                purchase_id=Subquery(SurveyResponse.objects.filter(
+                    pk=OuterRef("response_id")).values("purchase_id")[:1]),
+                field_type=Subquery(Question.objects.filter(
+                    pk=OuterRef("question_id")).values("field_type")[:1]))
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('surveys', '0009_surveyresponsedraft'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='questionresponse',
+            name='purchase',
+            field=models.ForeignKey(related_name='question_responses', to='surveys.SurveyPurchase', on_delete=django.db.models.deletion.CASCADE, null=True, blank=True, editable=False, db_index=False),
+        ),
+        migrations.AddField(
+            model_name='questionresponse',
+            name='field_type',
+            field=models.IntegerField(verbose_name='Question type', choices=[(1, 'Rating'), (2, 'Text')], null=True, blank=True, editable=False),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop, atomic=False),
+        migrations.AddIndex(
+            model_name='questionresponse',
+            index=models.Index(fields=['purchase', 'field_type', 'question', 'rating'], name='surveys_response_rating_idx'),
+        ),
+    ]
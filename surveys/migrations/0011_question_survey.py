@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models, transaction
+from django.db.models import Max, OuterRef, Subquery
+import django.db.models.deletion
+
+BATCH_SIZE = 10000
+
+
+def backfill(apps, schema_editor):
+    """
+    Copy the survey of each question's category, one primary key range at a time.
+    """
+    Question = apps.get_model("surveys", "Question")
+    Category = apps.get_model("surveys", "Category")
+    db_alias = schema_editor.connection.alias
+    questions = Question.objects.using(db_alias)
+    last_pk = questions.aggregate(Max("pk"))["pk__max"] or 0
+
+    for start in range(0, last_pk + 1, BATCH_SIZE):
+        with transaction.atomic(using=db_alias):
+            questions.filter(pk__gte=start, pk__lt=start + BATCH_SIZE).update(
+                survey_id=Subquery(Category.objects.filter(
+                    subcategories=OuterRef("subcategory_id")).values("survey_id")[:1]))
+
+
+class Migration(migrations.Migration):
+
+    atomic = False
+
+    dependencies = [
+        ('surveys', '0010_questionresponse_denormalized'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='question',
+            name='survey',
+            field=models.ForeignKey(related_name='questions', to='surveys.SurveyPage', on_delete=django.db.models.deletion.CASCADE, null=True, blank=True, editable=False),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop, atomic=False),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0011_question_survey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResponseArchive',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('data', models.BinaryField(verbose_name='Data')),
+                ('count', models.PositiveIntegerField(verbose_name='Responses', default=0)),
+                ('updated', models.DateTimeField(verbose_name='Updated', auto_now=True)),
+                ('purchase', models.OneToOneField(related_name='response_archive', to='surveys.SurveyPurchase', on_delete=django.db.models.deletion.CASCADE)),
+            ],
+            options={
+                'verbose_name': 'response archive',
+                'verbose_name_plural': 'response archives',
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0012_responsearchive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='surveypage',
+            name='codes_updated',
+            field=models.DateTimeField(null=True, editable=False, verbose_name='Codes updated'),
+        ),
+    ]
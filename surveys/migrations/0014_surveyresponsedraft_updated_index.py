@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0013_surveypage_codes_updated'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='surveyresponsedraft',
+            name='updated',
+            field=models.DateTimeField(verbose_name='Updated', auto_now=True, db_index=True),
+        ),
+    ]
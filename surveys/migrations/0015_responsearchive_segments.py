@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0014_surveyresponsedraft_updated_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='responsearchive',
+            name='purchase',
+            field=models.ForeignKey(related_name='response_archives', to='surveys.SurveyPurchase', on_delete=django.db.models.deletion.CASCADE),
+        ),
+    ]
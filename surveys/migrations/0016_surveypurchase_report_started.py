@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0015_responsearchive_segments'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='surveypurchase',
+            name='report_started',
+            field=models.DateTimeField(blank=True, null=True, editable=False, verbose_name='Report started'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0016_surveypurchase_report_started'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='surveypurchase',
+            name='ingest_token',
+            field=models.CharField(blank=True, help_text="Lets machine clients upload responses without logging in. Leave blank to only allow uploads from the purchaser's session", max_length=64, verbose_name='Ingest token'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0017_surveypurchase_ingest_token'),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='surveyresponse',
+            constraint=models.UniqueConstraint(fields=('purchase', 'submission_token'), name='surveys_surveyresponse_token_uniq'),
+        ),
+        migrations.AlterField(
+            model_name='surveyresponse',
+            name='submission_token',
+            field=models.UUIDField(verbose_name='Submission token', null=True, blank=True, editable=False),
+        ),
+    ]
@@ -1,4 +1,6 @@
 # flake8: noqa
 
-from .surveys import SurveyPage, SurveyPurchase, SurveyPurchaseCode
-from .questions import Category, Question, SurveyResponse, QuestionResponse, Subcategory
+from .surveys import SurveyPage, SurveyPurchase, SurveyPurchaseCode, PurchaseCodeShard
+from .questions import (
+    Category, Question, SurveyResponse, QuestionResponse, Subcategory, RatingCounter,
+    BenchmarkCounter, ResponseBufferCheckpoint, SurveyResponseDraft, ResponseArchive)
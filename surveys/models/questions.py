@@ -2,6 +2,8 @@
 
 from __future__ import absolute_import, unicode_literals
 
+import json
+
 from django.db import models
 
 from django.utils.translation import gettext_lazy as _
@@ -11,7 +13,26 @@ from mezzanine.core.models import Orderable, TimeStamped
 
 from mezzy.utils.models import TitledInline
 
-from ..managers import RatingDataQuerySet, QuestionResponseQuerySet
+from ..managers import (
+    RatingDataQuerySet, QuestionResponseQuerySet, RatingCounterQuerySet, BenchmarkCounterQuerySet)
+
+
+def get_purchase_histogram(purchase, histogram=None):
+    """
+    Count the rating responses of `purchase`, archived or not, unless the caller already did.
+    """
+    from ..archive import get_response_histogram
+    return histogram if histogram is not None else get_response_histogram(purchase)
+
+
+def get_rating(purchase, histogram, question_ids):
+    """
+    Merge the rating histograms of `question_ids` like PurchaseReport does.
+    Returns None if none of the questions have responses.
+    """
+    from ..reports import PurchaseReport
+    rating = PurchaseReport(purchase).get_rating(histogram.get(pk, {}) for pk in question_ids)
+    return rating if rating["count"] else None
 
 
 class Category(TitledInline):
@@ -28,30 +49,22 @@ class Category(TitledInline):
         verbose_name = _("category")
         verbose_name_plural = _("categories")
 
-    def get_rating_data(self, purchase):
+    def get_rating_data(self, purchase, histogram=None):
         """
         Returns a serializable object with rating data for this category.
         """
-        rating_responses = QuestionResponse.objects.filter(
-            question__subcategory__category=self,
-            question__field_type=Question.RATING_FIELD,
-            response__purchase=purchase)
-
-        count = rating_responses.count()
-        if not count:
+        histogram = get_purchase_histogram(purchase, histogram)
+        rating = get_rating(purchase, histogram, Question.objects.filter(
+            subcategory__category=self).values_list("pk", flat=True))
+        if rating is None:
             return None  # Don't return data if no rating responses exist
 
         return {
             "id": self.pk,
             "title": self.title,
             "description": self.description,
-            "rating": {
-                "count": count,
-                "average": rating_responses.get_average(),
-                "frequencies":
-                    rating_responses.get_frequencies(purchase.survey.get_rating_choices()),
-            },
-            "subcategories": self.subcategories.get_rating_data(purchase),
+            "rating": rating,
+            "subcategories": self.subcategories.get_rating_data(purchase, histogram),
         }
 
 
@@ -68,30 +81,21 @@ class Subcategory(TitledInline):
         verbose_name = _("subcategory")
         verbose_name_plural = _("subcategories")
 
-    def get_rating_data(self, purchase):
+    def get_rating_data(self, purchase, histogram=None):
         """
         Returns a serializable object with rating data for this subcategory.
         """
-        rating_responses = QuestionResponse.objects.filter(
-            question__subcategory=self,
-            question__field_type=Question.RATING_FIELD,
-            response__purchase=purchase)
-
-        count = rating_responses.count()
-        if not count:
+        histogram = get_purchase_histogram(purchase, histogram)
+        rating = get_rating(purchase, histogram, self.questions.values_list("pk", flat=True))
+        if rating is None:
             return None  # Don't return data if no rating responses exist
 
         return {
             "id": self.pk,
             "title": self.title,
             "description": self.description,
-            "rating": {
-                "count": count,
-                "average": rating_responses.get_average(),
-                "frequencies":
-                    rating_responses.get_frequencies(purchase.survey.get_rating_choices()),
-            },
-            "questions": self.questions.get_rating_data(purchase),
+            "rating": rating,
+            "questions": self.questions.get_rating_data(purchase, histogram),
         }
 
 
@@ -99,6 +103,8 @@ class Subcategory(TitledInline):
 class Question(Orderable):
     """
     A question on a SurveyPage.
+    The survey of the subcategory is copied here so survey-wide lookups don't need to join
+    the subcategory and category tables. It's kept in sync when either of them is moved.
     """
     RATING_FIELD = 1
     TEXT_FIELD = 2
@@ -113,6 +119,9 @@ class Question(Orderable):
     prompt = models.CharField(_("Prompt"), max_length=300)
     required = models.BooleanField(_("Required"), default=True)
     invert_rating = models.BooleanField(_("Invert rating"), default=False)
+    survey = models.ForeignKey(
+        "surveys.SurveyPage", related_name="questions", on_delete=models.CASCADE, null=True,
+        blank=True, editable=False)
 
     objects = RatingDataQuerySet.as_manager()
 
@@ -123,29 +132,24 @@ class Question(Orderable):
     def __str__(self):
         return self.prompt
 
-    def get_rating_data(self, purchase):
+    def save(self, *args, **kwargs):
+        self.survey_id = self.subcategory.category.survey_id
+        super(Question, self).save(*args, **kwargs)
+
+    def get_rating_data(self, purchase, histogram=None):
         """
         Returns a serializable object with rating data for this question.
         """
-        rating_responses = QuestionResponse.objects.filter(
-            question=self,
-            question__field_type=Question.RATING_FIELD,
-            response__purchase=purchase)
-
-        count = rating_responses.count()
-        if not count:
+        histogram = get_purchase_histogram(purchase, histogram)
+        rating = get_rating(purchase, histogram, [self.pk])
+        if rating is None:
             return None  # Don't return data if no rating responses exist
 
         return {
             "id": self.pk,
             "prompt": self.prompt,
             "invert_rating": self.invert_rating,
-            "rating": {
-                "count": count,
-                "average": rating_responses.get_average(),
-                "frequencies":
-                    rating_responses.get_frequencies(purchase.survey.get_rating_choices()),
-            },
+            "rating": rating,
         }
 
 
@@ -153,36 +157,191 @@ class Question(Orderable):
 class SurveyResponse(TimeStamped):
     """
     Collection of all responses related to a Purchase.
+    The submission token is set by SurveyResponseForm, its unique index per purchase makes
+    sure a submission that's retried (double clicks, flaky networks) is only saved once.
     """
     purchase = models.ForeignKey(
         "surveys.SurveyPurchase", related_name="responses", on_delete=models.CASCADE)
+    submission_token = models.UUIDField(
+        _("Submission token"), null=True, blank=True, editable=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["purchase", "submission_token"],
+                                    name="surveys_surveyresponse_token_uniq"),
+        ]
 
     def __str__(self):
         return str(self.created)
 
 
+# @python_2_unicode_compatible
+class SurveyResponseDraft(models.Model):
+    """
+    Answers given so far to a survey that's being taken one step at a time.
+    Drafts are identified by the submission token of the SurveyResponse they'll become.
+    Abandoned drafts are deleted by the purge_response_drafts command.
+    """
+    purchase = models.ForeignKey(
+        "surveys.SurveyPurchase", related_name="drafts", on_delete=models.CASCADE)
+    submission_token = models.UUIDField(_("Submission token"), unique=True)
+    answers = models.TextField(_("Answers"), default="{}")  # JSON {question_id: answer}
+    updated = models.DateTimeField(_("Updated"), auto_now=True, db_index=True)
+
+    class Meta:
+        verbose_name = _("survey response draft")
+        verbose_name_plural = _("survey response drafts")
+
+    def __str__(self):
+        return str(self.submission_token)
+
+    def get_answers(self):
+        return json.loads(self.answers)
+
+    def set_answers(self, answers):
+        self.answers = json.dumps(answers, separators=(",", ":"))
+
+
 # @python_2_unicode_compatible
 class QuestionResponse(models.Model):
     """
     Response to a single Question.
+    The purchase of the SurveyResponse and the field type of the Question are copied here
+    so reports can filter and aggregate responses without joining those tables.
     """
     response = models.ForeignKey(
         SurveyResponse, related_name="responses", on_delete=models.CASCADE)
     question = models.ForeignKey(Question, related_name="responses", on_delete=models.CASCADE)
     rating = models.PositiveSmallIntegerField(_("Rating"), blank=True, null=True)
     text_response = models.TextField(_("Text response"), blank=True)
+    purchase = models.ForeignKey(
+        "surveys.SurveyPurchase", related_name="question_responses", on_delete=models.CASCADE,
+        null=True, blank=True, editable=False, db_index=False)  # Covered by the index below
+    field_type = models.IntegerField(
+        _("Question type"), choices=Question.QUESTION_TYPES, null=True, blank=True,
+        editable=False)
 
     objects = QuestionResponseQuerySet.as_manager()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["purchase", "field_type", "question", "rating"],
+                         name="surveys_response_rating_idx"),
+        ]
+
     def __str__(self):
         if self.rating is not None:
             return str(self.rating)
         return self.text_response
 
+    def save(self, *args, **kwargs):
+        self.purchase_id = self.response.purchase_id
+        self.field_type = self.question.field_type
+        super(QuestionResponse, self).save(*args, **kwargs)
+
     def normalize_rating(self):
         """
         Invert the rating if the question requires it.
         """
         if self.rating is not None and self.question.invert_rating:
             max_rating = self.question.subcategory.category.survey.max_rating
-            self.rating = max_rating - int(self.rating) + 1
+            QuestionResponse.objects.normalize_ratings([self], max_rating, {self.question_id})
+
+
+# @python_2_unicode_compatible
+class ResponseArchive(models.Model):
+    """
+    Segment of the QuestionResponses of a closed purchase, moved out of the QuestionResponse
+    table into a compressed blob by `archive.archive_purchase`. Every run adds a segment.
+    """
+    purchase = models.ForeignKey(
+        "surveys.SurveyPurchase", related_name="response_archives", on_delete=models.CASCADE)
+    data = models.BinaryField(_("Data"))  # zlib compressed JSON lines of ARCHIVE_FIELDS
+    count = models.PositiveIntegerField(_("Responses"), default=0)
+    updated = models.DateTimeField(_("Updated"), auto_now=True)
+
+    class Meta:
+        verbose_name = _("response archive")
+        verbose_name_plural = _("response archives")
+
+    def __str__(self):
+        return "%s: %s" % (self.purchase_id, self.count)
+
+
+# @python_2_unicode_compatible
+class ResponseBufferCheckpoint(models.Model):
+    """
+    Last entry of a ResponseBuffer moved to the database.
+    Updated in the same transaction as the flushed responses so they're never saved twice.
+    """
+    buffer_id = models.CharField(_("Buffer ID"), max_length=32, unique=True)
+    last_entry = models.BigIntegerField(_("Last entry"), default=0)
+    updated = models.DateTimeField(_("Updated"), auto_now=True)
+
+    class Meta:
+        verbose_name = _("response buffer checkpoint")
+        verbose_name_plural = _("response buffer checkpoints")
+
+    def __str__(self):
+        return "%s: %s" % (self.buffer_id, self.last_entry)
+
+
+# @python_2_unicode_compatible
+class RatingCounter(models.Model):
+    """
+    Number of times a rating has been given to a Question in a Purchase.
+    Maintained by SurveyResponseForm so reports don't need to scan every QuestionResponse.
+    """
+    purchase = models.ForeignKey(
+        "surveys.SurveyPurchase", related_name="rating_counters", on_delete=models.CASCADE)
+    question = models.ForeignKey(
+        Question, related_name="rating_counters", on_delete=models.CASCADE)
+    rating = models.PositiveSmallIntegerField(_("Rating"), blank=True, null=True)
+    count = models.PositiveIntegerField(_("Count"), default=0)
+    benchmarked_count = models.PositiveIntegerField(
+        _("Count added to benchmarks"), default=0, editable=False)
+
+    objects = RatingCounterQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = _("rating counter")
+        verbose_name_plural = _("rating counters")
+        unique_together = ("purchase", "question", "rating")
+        constraints = [
+            # NULLs are distinct in unique indexes, the counter of unanswered ratings needs its own
+            models.UniqueConstraint(fields=["purchase", "question"],
+                                    condition=models.Q(rating__isnull=True),
+                                    name="surveys_ratingcounter_null_rating_uniq"),
+        ]
+
+    def __str__(self):
+        return "%s: %s" % (self.rating, self.count)
+
+
+# @python_2_unicode_compatible
+class BenchmarkCounter(models.Model):
+    """
+    Number of times a rating has been given to a Question across all closed Purchases.
+    Updated when a purchase report is generated and used to compare purchases of a survey.
+    """
+    survey = models.ForeignKey(
+        "surveys.SurveyPage", related_name="benchmark_counters", on_delete=models.CASCADE)
+    question = models.ForeignKey(
+        Question, related_name="benchmark_counters", on_delete=models.CASCADE)
+    rating = models.PositiveSmallIntegerField(_("Rating"), blank=True, null=True)
+    count = models.PositiveIntegerField(_("Count"), default=0)
+
+    objects = BenchmarkCounterQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = _("benchmark counter")
+        verbose_name_plural = _("benchmark counters")
+        unique_together = ("survey", "question", "rating")
+        constraints = [
+            models.UniqueConstraint(fields=["survey", "question"],
+                                    condition=models.Q(rating__isnull=True),
+                                    name="surveys_benchmarkcounter_null_rating_uniq"),
+        ]
+
+    def __str__(self):
+        return "%s: %s" % (self.rating, self.count)
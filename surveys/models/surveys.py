@@ -3,11 +3,14 @@
 from __future__ import unicode_literals
 
 import json
+import random
 import uuid
 
 from builtins import range
+from datetime import timedelta
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 from django.urls import reverse
 from django.core.validators import MinValueValidator, MaxValueValidator
 # from django.utils.encoding import python_2_unicode_compatible
@@ -19,7 +22,9 @@ from mezzanine.core.fields import RichTextField
 from mezzanine.core.models import RichText, TimeStamped
 from mezzanine.pages.models import Page
 
-from ..managers import SurveyPurchaseQuerySet
+from ..cache import get_parsed_report
+from ..managers import SurveyPurchaseCodeQuerySet, SurveyPurchaseQuerySet
+from ..reports import PurchaseReport
 
 
 class SurveyPage(Page, RichText):
@@ -40,13 +45,15 @@ class SurveyPage(Page, RichText):
     report_explanation = RichTextField(
         _("Explanation"),
         help_text=_("Helping content shown before the results' detail"))
+    # Version of the filter of usable purchase codes, see `codes.get_code_filter`
+    codes_updated = models.DateTimeField(_("Codes updated"), null=True, editable=False)
 
     def get_questions(self):
         """
         Collect all questions related to this survey.
         """
         from .questions import Question
-        return Question.objects.filter(subcategory__category__survey=self)
+        return Question.objects.filter(survey=self)
 
     def get_rating_choices(self):
         return range(1, self.max_rating + 1)
@@ -70,6 +77,8 @@ class SurveyPurchaseCode(models.Model):
         help_text=_("If left blank it will be automatically generated"))
     uses_remaining = models.PositiveIntegerField(_("Remaining uses"), default=0)
 
+    objects = SurveyPurchaseCodeQuerySet.as_manager()
+
     class Meta:
         verbose_name = _("purchase code")
         verbose_name_plural = _("purchase codes")
@@ -83,15 +92,103 @@ class SurveyPurchaseCode(models.Model):
         Generate a UUID if the code hasn't been defined
         """
         if not self.code:
-            self.code = str(uuid.uuid4()).strip("-")[4:23]
+            self.code = self.generate_code()
         super(SurveyPurchaseCode, self).save(*args, **kwargs)
 
+    @staticmethod
+    def generate_code():
+        return str(uuid.uuid4()).strip("-")[4:23]
+
+    def get_uses_remaining(self):
+        """
+        Uses of the code that haven't been handed out to shards plus the ones left in them.
+        """
+        return self.uses_remaining + sum(self.shards.values_list("uses_remaining", flat=True))
+
+    def redeem(self):
+        """
+        Use the code once. Returns False if the code has no uses left.
+        Codes with many uses hand them out in chunks to SURVEYS_PURCHASE_CODE_SHARDS shards
+        and every redemption decrements a random shard, so concurrent redemptions update
+        different rows. The code itself is only locked when a shard runs out.
+        Codes with few uses are decremented in place, and once the code has nothing left the
+        uses still held by its shards are handed out without touching the code row.
+        """
+        shard_count = settings.SURVEYS_PURCHASE_CODE_SHARDS
+        if shard_count > 1 and self.uses_remaining >= 2 * shard_count:
+            index = random.randrange(shard_count)
+            if self.shards.filter(index=index, uses_remaining__gt=0).update(
+                    uses_remaining=F("uses_remaining") - 1):
+                return True
+            if self.refill_shard(index):
+                return True
+        elif self.uses_remaining and SurveyPurchaseCode.objects.filter(
+                pk=self.pk, uses_remaining__gt=0).update(uses_remaining=F("uses_remaining") - 1):
+            return True
+
+        # Nothing left to hand out, use up what's left in the other shards
+        for index in self.shards.filter(uses_remaining__gt=0).values_list("index", flat=True):
+            if self.shards.filter(index=index, uses_remaining__gt=0).update(
+                    uses_remaining=F("uses_remaining") - 1):
+                return True
+        return False
+
+    def refill_shard(self, index):
+        """
+        Move a chunk of the uses of the code to a shard, using one of them right away.
+        Chunks get smaller as the code runs out so the uses stay spread between shards.
+        Returns False if the code has no uses left to hand out.
+        """
+        with transaction.atomic():
+            codes = SurveyPurchaseCode.objects.filter(pk=self.pk)
+            uses_remaining = codes.select_for_update() \
+                .values_list("uses_remaining", flat=True).get()
+            chunk = min(uses_remaining,
+                        max(1, uses_remaining // settings.SURVEYS_PURCHASE_CODE_SHARDS))
+            if not chunk:
+                return False
+            codes.update(uses_remaining=F("uses_remaining") - chunk)
+            if chunk > 1 and not self.shards.filter(index=index).update(
+                    uses_remaining=F("uses_remaining") + chunk - 1):
+                self.shards.create(index=index, uses_remaining=chunk - 1)
+        self.uses_remaining = uses_remaining - chunk
+        return True
+
+
+# @python_2_unicode_compatible
+class PurchaseCodeShard(models.Model):
+    """
+    Part of the remaining uses of a SurveyPurchaseCode, see `SurveyPurchaseCode.redeem`.
+    """
+    code = models.ForeignKey(SurveyPurchaseCode, related_name="shards", on_delete=models.CASCADE)
+    index = models.PositiveSmallIntegerField(_("Index"))
+    uses_remaining = models.PositiveIntegerField(_("Remaining uses"), default=0)
+
+    class Meta:
+        verbose_name = _("purchase code shard")
+        verbose_name_plural = _("purchase code shards")
+        unique_together = ("code", "index")
+
+    def __str__(self):
+        return "%s #%s" % (self.code, self.index)
+
 
 # @python_2_unicode_compatible
 class SurveyPurchase(TimeStamped):
     """
     A record of a user purchasing a Survey.
     """
+    REPORT_PENDING = "pending"
+    REPORT_RUNNING = "running"
+    REPORT_DONE = "done"
+    REPORT_FAILED = "failed"
+    REPORT_STATUSES = (
+        (REPORT_PENDING, "Pending"),
+        (REPORT_RUNNING, "Running"),
+        (REPORT_DONE, "Done"),
+        (REPORT_FAILED, "Failed"),
+    )
+
     survey = models.ForeignKey(SurveyPage, on_delete=models.CASCADE, related_name="purchases")
     purchaser = models.ForeignKey(
         settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="survey_purchases")
@@ -105,6 +202,14 @@ class SurveyPurchase(TimeStamped):
 
     report_generated = models.DateTimeField(_("Report generated"), blank=True, null=True)
     report_cache = models.TextField(_("Report (cached)"), default="[]")
+    report_status = models.CharField(
+        _("Report status"), max_length=10, choices=REPORT_STATUSES, blank=True)
+    report_started = models.DateTimeField(
+        _("Report started"), blank=True, null=True, editable=False)
+    ingest_token = models.CharField(
+        _("Ingest token"), max_length=64, blank=True,
+        help_text=_("Lets machine clients upload responses without logging in. "
+                    "Leave blank to only allow uploads from the purchaser's session"))
 
     objects = SurveyPurchaseQuerySet.as_manager()
 
@@ -127,41 +232,54 @@ class SurveyPurchase(TimeStamped):
     def get_report_url(self):
         return reverse("surveys:purchase_report", args=[self.public_id])
 
+    def get_report_status_url(self):
+        return reverse("surveys:purchase_report_status", args=[self.public_id])
+
+    def get_export_url(self, format="csv"):
+        return reverse("surveys:purchase_export", args=[self.public_id, format])
+
+    def get_ingest_url(self):
+        return reverse("surveys:purchase_ingest", args=[self.public_id])
+
+    @staticmethod
+    def generate_ingest_token():
+        return uuid.uuid4().hex + uuid.uuid4().hex
+
+    def get_report_in_progress(self):
+        return self.report_status in (self.REPORT_PENDING, self.REPORT_RUNNING) \
+            and not self.get_report_stale()
+
+    def get_report_stale(self):
+        """
+        Report jobs that didn't finish within SURVEYS_REPORT_TIMEOUT were lost with their
+        worker, they're shown as failed and can be enqueued again.
+        """
+        if self.report_status not in (self.REPORT_PENDING, self.REPORT_RUNNING):
+            return False
+        timeout = timedelta(seconds=settings.SURVEYS_REPORT_TIMEOUT)
+        return self.report_started is None or self.report_started < now() - timeout
+
     def generate_report(self):
         """
         Generate a report of all responses related to this purchase.
         A cached copy will be stored in self.report_cache.
         The report includes nested data in the shape of Category / Subcategory / Question.
+        Rating data is aggregated from a single histogram query (see PurchaseReport).
+        The purchase ratings are also added to the benchmarks shared by all purchases.
         """
-        from .questions import Question, QuestionResponse
-        rating_responses = QuestionResponse.objects.filter(
-            response__purchase=self, question__field_type=Question.RATING_FIELD)
-
-        text_questions = []
-        for question in self.survey.get_questions().filter(field_type=Question.TEXT_FIELD):
-            responses = question.responses.filter(response__purchase=self)
-            text_questions.append({
-                "id": question.pk,
-                "prompt": question.prompt,
-                "responses": list(responses.values_list("text_response", flat=True)),
-            })
-
-        report = {
-            "rating": {
-                "count": rating_responses.count(),
-                "average": rating_responses.get_average(),
-                "frequencies": rating_responses.get_frequencies(self.survey.get_rating_choices()),
-            },
-            "categories": self.survey.categories.get_rating_data(purchase=self),
-            "text_questions": text_questions,
-        }
-        self.report_cache = json.dumps(report)
-        self.report_generated = now()
-        self.save()
+        from .questions import BenchmarkCounter
+        with transaction.atomic():
+            BenchmarkCounter.objects.add_purchase(self)
+            report = PurchaseReport(self).build()
+            self.report_cache = json.dumps(report)
+            self.report_generated = now()
+            self.report_status = self.REPORT_DONE
+            self.save()
         return report
 
     def get_report_as_json(self):
         """
         Load the cached report as JSON.
+        Parsed reports are memoized per report version, see surveys.cache.
         """
-        return json.loads(self.report_cache)
+        return get_parsed_report(self)
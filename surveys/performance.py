@@ -0,0 +1,202 @@
+from __future__ import absolute_import, division, unicode_literals
+
+import json
+import random
+import time
+
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.db import connection, transaction
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
+
+from . import __version__
+
+
+class SurveyDataGenerator(object):
+    """
+    Creates synthetic surveys and responses of a configurable size.
+    Every `text_every` questions one of them is a text question, the rest are rating questions.
+    """
+
+    def __init__(self, categories=5, subcategories=5, questions=10, text_every=10, seed=0):
+        self.categories = categories
+        self.subcategories = subcategories
+        self.questions = questions
+        self.text_every = text_every
+        self.random = random.Random(seed)
+
+    def create_survey(self):
+        from .models import SurveyPage, Category, Subcategory, Question
+        survey = SurveyPage.objects.create(title="Benchmark survey", max_rating=5)
+
+        Category.objects.bulk_create([
+            Category(survey=survey, title="Category %s" % i, _order=i)
+            for i in range(self.categories)])
+        categories = Category.objects.filter(survey=survey)
+
+        Subcategory.objects.bulk_create([
+            Subcategory(category=category, title="Subcategory %s" % i, _order=i)
+            for category in categories for i in range(self.subcategories)])
+        subcategories = Subcategory.objects.filter(category__survey=survey)
+
+        order = 0
+        questions = []
+        for subcategory in subcategories:
+            for i in range(self.questions):
+                field_type = Question.RATING_FIELD
+                if self.text_every and order % self.text_every == self.text_every - 1:
+                    field_type = Question.TEXT_FIELD
+                questions.append(Question(
+                    subcategory=subcategory, survey=survey, field_type=field_type, _order=order,
+                    prompt="Question %s" % order, invert_rating=order % 7 == 0))
+                order += 1
+        Question.objects.bulk_create(questions)
+        return survey
+
+    def create_purchase(self, survey):
+        from .models import SurveyPurchase
+        purchaser = get_user_model().objects.create(
+            username="benchmark-%s" % self.random.getrandbits(32))
+        return SurveyPurchase.objects.create(
+            survey=survey, purchaser=purchaser, transaction_id="Benchmark")
+
+    def get_form_data(self, survey):
+        """
+        Valid POST data for SurveyResponseForm with random answers.
+        """
+        from .models import Question
+        data = {}
+        for pk, field_type in survey.get_questions().values_list("pk", "field_type"):
+            if field_type == Question.RATING_FIELD:
+                data["question_%s" % pk] = str(self.random.randint(1, survey.max_rating))
+            else:
+                data["question_%s" % pk] = "Text response %s" % self.random.random()
+        return data
+
+    def create_responses(self, purchase, count, batch_size=5000):
+        """
+        Bulk create `count` SurveyResponses with an answer to every question.
+        """
+        from .models import Question, QuestionResponse, RatingCounter, SurveyResponse
+        questions = list(purchase.survey.get_questions().values_list("pk", "field_type"))
+        existing = set(purchase.responses.values_list("pk", flat=True))
+        SurveyResponse.objects.bulk_create(
+            [SurveyResponse(purchase=purchase) for i in range(count)], batch_size=batch_size)
+        response_ids = set(purchase.responses.values_list("pk", flat=True)) - existing
+
+        question_responses = []
+        for response_id in response_ids:
+            for question_id, field_type in questions:
+                if field_type == Question.RATING_FIELD:
+                    question_responses.append(QuestionResponse(
+                        response_id=response_id, question_id=question_id,
+                        purchase_id=purchase.pk, field_type=field_type,
+                        rating=self.random.randint(1, purchase.survey.max_rating)))
+                else:
+                    question_responses.append(QuestionResponse(
+                        response_id=response_id, question_id=question_id,
+                        purchase_id=purchase.pk, field_type=field_type,
+                        text_response="Text response %s" % self.random.random()))
+            if len(question_responses) >= batch_size:
+                QuestionResponse.objects.bulk_create(question_responses)
+                question_responses = []
+        QuestionResponse.objects.bulk_create(question_responses)
+        RatingCounter.objects.rebuild(purchase)
+
+
+def measure(func, repeat=3):
+    """
+    Call `func` `repeat` times and return its wall time and query count.
+    """
+    timings = []
+    for i in range(repeat):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+    timings.sort()
+    return {
+        "min": timings[0],
+        "median": timings[len(timings) // 2],
+        "mean": sum(timings) / len(timings),
+        "queries": len(queries),
+    }
+
+
+def call_view(view, user=None, method="get", data=None, render=True, **kwargs):
+    """
+    Call a class-based view with a request built from scratch, rendering its response.
+    """
+    from django.contrib.auth.models import AnonymousUser
+    request = getattr(RequestFactory(), method)("/benchmark/", data or {})
+    request.user = user or AnonymousUser()
+    SessionMiddleware(lambda request: None).process_request(request)
+    request._dont_enforce_csrf_checks = True
+    response = view.as_view()(request, **kwargs)
+    if render and hasattr(response, "render"):
+        response.render()
+    return response
+
+
+def run_benchmarks(categories=5, subcategories=5, questions=10, responses=100, repeat=3,
+                   render=True, seed=0):
+    """
+    Measure the hot paths of the app against a synthetic survey.
+    All data is created inside a transaction that is rolled back at the end.
+    Returns a serializable dict with the parameters and the results of each benchmark.
+    """
+    from .forms.surveys import SurveyResponseForm
+    from .views import SurveyPurchaseReport, SurveyResponseCreate
+
+    params = {
+        "categories": categories,
+        "subcategories": subcategories,
+        "questions": questions,
+        "responses": responses,
+        "repeat": repeat,
+        "seed": seed,
+    }
+    results = {}
+
+    with transaction.atomic():
+        generator = SurveyDataGenerator(categories, subcategories, questions, seed=seed)
+        survey = generator.create_survey()
+        purchase = generator.create_purchase(survey)
+        generator.create_responses(purchase, responses)
+        public_id = str(purchase.public_id)
+        data = generator.get_form_data(survey)
+
+        def save_form():
+            form = SurveyResponseForm(data=data, purchase=purchase)
+            assert form.is_valid(), form.errors
+            form.save()
+
+        results["form_init"] = measure(
+            lambda: SurveyResponseForm(purchase=purchase), repeat)
+        results["form_save"] = measure(save_form, repeat)
+        results["generate_report"] = measure(purchase.generate_report, repeat)
+        results["take_view_get"] = measure(lambda: call_view(
+            SurveyResponseCreate, render=render, public_id=public_id), repeat)
+        results["take_view_post"] = measure(lambda: call_view(
+            SurveyResponseCreate, method="post", data=data, render=render,
+            public_id=public_id), repeat)
+        results["report_view_get"] = measure(lambda: call_view(
+            SurveyPurchaseReport, user=purchase.purchaser, render=render,
+            public_id=public_id), repeat)
+
+        transaction.set_rollback(True)
+
+    return {
+        "version": __version__,
+        "date": now().isoformat(),
+        "database": connection.vendor,
+        "params": params,
+        "results": results,
+    }
+
+
+def write_results(results, path):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
@@ -0,0 +1,176 @@
+from __future__ import absolute_import, division, unicode_literals
+
+from collections import defaultdict
+from itertools import chain
+
+from mezzanine.conf import settings
+
+from .archive import iter_archived_values
+from .tree import load_survey_tree
+
+
+class PurchaseReport(object):
+    """
+    Builds the report of a SurveyPurchase from the histogram kept in its RatingCounters.
+    The histogram is rolled up in memory into the nested Category / Subcategory / Question
+    shape, so the number of queries doesn't depend on the size of the survey.
+    Each node also includes the same rating data for all closed purchases of the survey
+    (the benchmark), read from the BenchmarkCounters.
+    """
+
+    def __init__(self, purchase):
+        self.purchase = purchase
+        self.survey = purchase.survey
+        self.rating_choices = list(self.survey.get_rating_choices())
+
+    def get_histogram(self):
+        """
+        Read the rating counters of the purchase.
+        Returns a dict in the form of {question_id: {rating: count}}.
+        Responses without a rating are counted under the None key.
+        """
+        from .models import Question, RatingCounter
+        return RatingCounter.objects.filter(
+            purchase=self.purchase, question__field_type=Question.RATING_FIELD).get_histogram()
+
+    def get_benchmark_histogram(self):
+        """
+        Read the rating counters of all closed purchases of the survey.
+        """
+        from .models import BenchmarkCounter, Question
+        return BenchmarkCounter.objects.filter(
+            survey=self.survey, question__field_type=Question.RATING_FIELD).get_histogram()
+
+    def add_benchmark(self, question_ids, node):
+        """
+        Add the rating data of all closed purchases for the questions of a node.
+        """
+        node["benchmark"] = self.get_rating(self.benchmark.get(pk, {}) for pk in question_ids)
+        return node
+
+    def get_text_responses(self):
+        """
+        Collect the text responses of the purchase grouped by question, archived ones first.
+        Returns a dict in the form of {question_id: [text_response, ...]}.
+        """
+        from .models import Question, QuestionResponse
+        lookups = ["question", "text_response"]
+        rows = QuestionResponse.objects \
+            .filter(purchase=self.purchase, field_type=Question.TEXT_FIELD) \
+            .values_list(*lookups) \
+            .order_by("pk")
+        archived = iter_archived_values(self.purchase, lookups, field_type=Question.TEXT_FIELD)
+
+        responses = defaultdict(list)
+        for question_id, text_response in chain(archived, rows):
+            responses[question_id].append(text_response)
+        return responses
+
+    def get_rating(self, histograms):
+        """
+        Merge one or more histograms and calculate the count, average, and frequencies.
+        Ratings that don't occur will still be included with a frequency of zero.
+        """
+        merged = defaultdict(int)
+        for histogram in histograms:
+            for rating, count in histogram.items():
+                merged[rating] += count
+
+        rated = [(rating, count) for rating, count in merged.items() if rating is not None]
+        rated_count = sum(count for rating, count in rated)
+        average = None
+        if rated_count:
+            average = sum(rating * count for rating, count in rated) / rated_count
+
+        return {
+            "count": sum(merged.values()),
+            "average": average,
+            "frequencies": [(choice, merged.get(choice, 0)) for choice in self.rating_choices],
+        }
+
+    def build(self):
+        """
+        Generate the report as a serializable object.
+        Nodes that don't have any rating responses are skipped.
+        """
+        from .models import Question
+        histogram = self.get_histogram()
+        self.benchmark = self.get_benchmark_histogram()
+        tree = load_survey_tree(self.survey)
+
+        category_nodes = []
+        for category in tree.categories:
+            category_questions = []
+            subcategory_nodes = []
+            for subcategory in category.subcategories:
+                subcategory_questions = []
+                question_nodes = []
+                for question in subcategory.questions:
+                    if question.field_type != Question.RATING_FIELD:
+                        continue
+                    if not histogram.get(question.id):
+                        continue
+                    subcategory_questions.append(question.id)
+                    question_nodes.append(self.add_benchmark([question.id], {
+                        "id": question.id,
+                        "prompt": question.prompt,
+                        "invert_rating": question.invert_rating,
+                        "rating": self.get_rating([histogram[question.id]]),
+                    }))
+
+                if not subcategory_questions:
+                    continue
+                category_questions.extend(subcategory_questions)
+                subcategory_nodes.append(self.add_benchmark(subcategory_questions, {
+                    "id": subcategory.id,
+                    "title": subcategory.title,
+                    "description": subcategory.description,
+                    "rating": self.get_rating(histogram[pk] for pk in subcategory_questions),
+                    "questions": question_nodes,
+                }))
+
+            if not category_questions:
+                continue
+            category_nodes.append(self.add_benchmark(category_questions, {
+                "id": category.id,
+                "title": category.title,
+                "description": category.description,
+                "rating": self.get_rating(histogram[pk] for pk in category_questions),
+                "subcategories": subcategory_nodes,
+            }))
+
+        text_responses = self.get_text_responses()
+        text_questions = []
+        for category, subcategory, question in tree.iter_questions():
+            if question.field_type != Question.TEXT_FIELD:
+                continue
+            text_questions.append({
+                "id": question.id,
+                "prompt": question.prompt,
+                "responses": text_responses.get(question.id, []),
+            })
+
+        report = self.add_benchmark(histogram.keys(), {
+            "rating": self.get_rating(histogram.values()),
+            "categories": category_nodes,
+            "text_questions": text_questions,
+        })
+        # The purchase being reported is closed once the report is saved
+        report["benchmark_purchases"] = \
+            self.survey.purchases.closed().exclude(pk=self.purchase.pk).count() + 1
+        if settings.SURVEYS_REPORT_STATISTICS:
+            from .statistics import add_statistics
+            add_statistics(self.iter_ratings(report), self.rating_choices)
+        return report
+
+    def iter_ratings(self, report):
+        """
+        Iterate over the rating data of every node in the report.
+        """
+        yield report["rating"]
+        for category in report["categories"]:
+            yield category["rating"]
+            for subcategory in category["subcategories"]:
+                yield subcategory["rating"]
+                for question in subcategory["questions"]:
+                    yield question["rating"]
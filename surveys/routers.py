@@ -0,0 +1,117 @@
+from __future__ import absolute_import, unicode_literals
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from mezzanine.conf import settings
+
+PIN_COOKIE = "surveys_primary"
+
+_use_replica = ContextVar("surveys_use_replica", default=False)
+
+
+@contextmanager
+def use_replica():
+    """
+    Read the models of this app from SURVEYS_READ_REPLICA in the block (or function when
+    used as a decorator). Writes always go to the primary database.
+    """
+    token = _use_replica.set(True)
+    try:
+        yield
+    finally:
+        _use_replica.reset(token)
+
+
+@contextmanager
+def use_primary():
+    """
+    Read from the primary database in the block, even inside `use_replica`.
+    """
+    token = _use_replica.set(False)
+    try:
+        yield
+    finally:
+        _use_replica.reset(token)
+
+
+def get_replica_alias():
+    """
+    Database alias reads are sent to in the current context, or None for the primary.
+    """
+    if not _use_replica.get():
+        return None
+    return settings.SURVEYS_READ_REPLICA or None
+
+
+class ReplicaRouter(object):
+    """
+    Sends the reads of the models of this app made inside `use_replica` to the database
+    in SURVEYS_READ_REPLICA. Everything else is left to the default database.
+    Add "surveys.routers.ReplicaRouter" to DATABASE_ROUTERS to enable it.
+    """
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == "surveys":
+            return get_replica_alias()
+        return None
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        """
+        The replica holds a copy of the primary, objects read from either can be related.
+        """
+        databases = {"default", settings.SURVEYS_READ_REPLICA}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+def is_pinned(request):
+    return PIN_COOKIE in request.COOKIES
+
+
+def pin_to_primary(response):
+    """
+    Make the client read from the primary for SURVEYS_READ_REPLICA_PIN_SECONDS, so it sees
+    its own writes while the replica catches up.
+    """
+    response.set_cookie(PIN_COOKIE, "1", max_age=settings.SURVEYS_READ_REPLICA_PIN_SECONDS,
+                        httponly=True, samesite="Lax")
+
+
+def route_request(request, view, *args, **kwargs):
+    """
+    Call `view` serving safe requests from the read replica, rendering template responses
+    inside `use_replica` so the queries made by templates go there too.
+    Unsafe requests use the primary and pin the client to it (see `pin_to_primary`), so
+    the page they redirect to reads what was just written.
+    """
+    if not settings.SURVEYS_READ_REPLICA:
+        return view(*args, **kwargs)
+
+    if request.method not in ("GET", "HEAD", "OPTIONS"):
+        response = view(*args, **kwargs)
+        pin_to_primary(response)
+        return response
+
+    if is_pinned(request):
+        return view(*args, **kwargs)
+
+    with use_replica():
+        response = view(*args, **kwargs)
+        if hasattr(response, "render") and not response.is_rendered:
+            response.render()
+    return response
+
+
+class ReplicaReadMixin(object):
+    """
+    Class based views that read from the replica, see `route_request`.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        return route_request(
+            request, super(ReplicaReadMixin, self).dispatch, request, *args, **kwargs)
@@ -0,0 +1,108 @@
+from __future__ import absolute_import, unicode_literals
+
+import threading
+
+from collections import namedtuple
+
+from django.utils.timezone import now
+from django.utils.translation import get_language
+
+from mezzanine.conf import settings
+
+from .cache import LRUCache, get_shared_cache
+from .tree import load_survey_tree
+
+# Everything SurveyResponseForm needs to know about a question to build its field
+FieldSpec = namedtuple("FieldSpec", ["question_id", "field_type", "prompt", "required",
+                                     "invert_rating", "category_id"])
+
+# Changes with the shape of FormSchema, so schemas pickled by older versions aren't used
+SCHEMA_VERSION = 3
+
+
+class FormSchema(namedtuple("FormSchema", [
+        "fields", "max_rating", "rating_choices", "steps", "tree"])):
+    """
+    Compiled questions of a survey, immutable so it can be shared between requests.
+    `steps` are the (category_id, title) pairs of the categories with questions, in order.
+    `tree` is the SurveyTree the fields were compiled from.
+    """
+    __slots__ = ()
+
+    def get_step_fields(self, step):
+        """
+        Fields of the questions in the category of `step`, numbered from 0.
+        """
+        category_id = self.steps[step][0]
+        return tuple(spec for spec in self.fields if spec.category_id == category_id)
+
+    def get_rating_question_ids(self):
+        from .models import Question
+        return set(spec.question_id for spec in self.fields
+                   if spec.field_type == Question.RATING_FIELD)
+
+    def get_inverted_question_ids(self):
+        return set(spec.question_id for spec in self.fields if spec.invert_rating)
+
+
+def compile_form_schema(survey):
+    """
+    Collect the questions of `survey` into a FormSchema, loading its tree in one query.
+    Rating questions come first, in the order of the survey tree.
+    """
+    tree = load_survey_tree(survey)
+    steps = tuple((category.id, category.title) for category in tree.categories)
+    fields = tuple(sorted(
+        (FieldSpec(q.id, q.field_type, q.prompt, q.required, q.invert_rating, category.id)
+         for category, subcategory, q in tree.iter_questions()),
+        key=lambda spec: spec.field_type))
+    return FormSchema(fields, survey.max_rating, tuple(survey.get_rating_choices()), steps, tree)
+
+
+_schemas = None
+_schemas_lock = threading.Lock()
+
+
+def get_local_cache():
+    global _schemas
+    with _schemas_lock:
+        if _schemas is None or _schemas.max_size != settings.SURVEYS_FORM_SCHEMA_CACHE_SIZE:
+            _schemas = LRUCache(settings.SURVEYS_FORM_SCHEMA_CACHE_SIZE)
+    return _schemas
+
+
+def get_form_schema(survey):
+    """
+    Get the compiled FormSchema of `survey`, memoized per survey version and language.
+    Versions are identified by (survey.pk, survey.updated), which is bumped whenever the
+    questions of the survey change (see `invalidate_form_schema`). Prompts are translated,
+    so each language gets its own schema.
+    """
+    if survey.pk is None:
+        return compile_form_schema(survey)
+
+    updated = survey.updated.isoformat() if survey.updated else None
+    key = (survey.pk, updated, get_language())
+    local_cache = get_local_cache()
+    schema = local_cache.get(key)
+    if schema is not None:
+        return schema
+
+    shared_cache = get_shared_cache()
+    shared_key = "surveys.form_schema.%s.%s.%s.%s" % ((SCHEMA_VERSION,) + key)
+    schema = shared_cache.get(shared_key) if shared_cache is not None else None
+    if schema is None:
+        schema = compile_form_schema(survey)
+        if shared_cache is not None:
+            shared_cache.set(shared_key, schema)
+
+    local_cache.set(key, schema, 1)
+    return schema
+
+
+def invalidate_form_schema(*args, **filters):
+    """
+    Bump the version of the surveys matching the filters so their schemas are compiled again.
+    """
+    from .models import SurveyPage
+    SurveyPage.objects.filter(*args, **filters).update(updated=now())
@@ -0,0 +1,106 @@
+from __future__ import absolute_import, unicode_literals
+
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .codes import invalidate_code_filter
+from .models import Category, Subcategory, Question, QuestionResponse, SurveyPurchaseCode
+from .schema import invalidate_form_schema
+
+# SurveyPage saves update SurveyPage.updated themselves, which is all the form schema cache
+# needs to notice the change. Changes to the rest of the survey tree bump it here.
+
+# Lookups from each node of the survey tree to its survey
+SURVEY_LOOKUPS = {
+    Category: "survey",
+    Subcategory: "category__survey",
+    Question: "subcategory__category__survey",
+}
+
+
+@receiver(pre_save, sender=Category)
+@receiver(pre_save, sender=Subcategory)
+@receiver(pre_save, sender=Question)
+def node_saving(sender, instance, raw=False, **kwargs):
+    """
+    Remember the survey of a node before it's saved, nodes can be moved to another survey.
+    """
+    if not raw and instance.pk is not None:
+        instance._previous_survey_id = sender.objects.filter(pk=instance.pk) \
+            .values_list(SURVEY_LOOKUPS[sender], flat=True) \
+            .first()
+
+
+def invalidate_node_surveys(instance, **filters):
+    """
+    Invalidate the schema of the survey matching `filters`, and of the survey the node was
+    in before it was saved.
+    """
+    condition = Q(**filters)
+    previous_survey_id = vars(instance).pop("_previous_survey_id", None)
+    if previous_survey_id is not None:
+        condition |= Q(pk=previous_survey_id)
+    invalidate_form_schema(condition)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def category_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        invalidate_node_surveys(instance, pk=instance.survey_id)
+
+
+@receiver(post_save, sender=Category)
+def category_saved(sender, instance, created, raw=False, **kwargs):
+    """
+    Move the questions of the category along with it.
+    """
+    if not raw and not created:
+        Question.objects.filter(subcategory__category=instance) \
+            .exclude(survey=instance.survey_id) \
+            .update(survey=instance.survey_id)
+
+
+@receiver(post_save, sender=Subcategory)
+def subcategory_saved(sender, instance, created, raw=False, **kwargs):
+    """
+    Move the questions of the subcategory along with it.
+    """
+    if not raw and not created:
+        survey_id = instance.category.survey_id
+        Question.objects.filter(subcategory=instance) \
+            .exclude(survey=survey_id) \
+            .update(survey=survey_id)
+
+
+@receiver(post_save, sender=Subcategory)
+@receiver(post_delete, sender=Subcategory)
+def subcategory_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        invalidate_node_surveys(instance, categories=instance.category_id)
+
+
+@receiver(post_save, sender=Question)
+@receiver(post_delete, sender=Question)
+def question_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        invalidate_node_surveys(instance, categories__subcategories=instance.subcategory_id)
+
+
+@receiver(post_save, sender=Question)
+def question_saved(sender, instance, created, raw=False, **kwargs):
+    """
+    Keep the field type copied onto the responses of the question up to date.
+    """
+    if not raw and not created:
+        QuestionResponse.objects.filter(question=instance) \
+            .exclude(field_type=instance.field_type) \
+            .update(field_type=instance.field_type)
+
+
+@receiver(post_save, sender=SurveyPurchaseCode)
+@receiver(post_delete, sender=SurveyPurchaseCode)
+def purchase_code_changed(sender, instance, raw=False, **kwargs):
+    if not raw:
+        invalidate_code_filter(instance.survey_id)
@@ -0,0 +1,75 @@
+from __future__ import absolute_import, division, unicode_literals
+
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import numpy as np
+except ImportError:
+    raise ImproperlyConfigured("Install the numpy package to calculate report statistics")
+
+PERCENTILES = (25, 50, 75, 90)
+
+
+def get_statistics(histograms, rating_choices):
+    """
+    Calculate descriptive statistics for many rating histograms in one vectorized pass.
+    `histograms` is a sequence of rows with the frequency of each rating in `rating_choices`.
+    Returns a list with a dict of statistics for each row (None for rows without ratings).
+
+    - Percentiles (and the median) use the nearest-rank method, so they are always a rating.
+    - The standard deviation is the population standard deviation.
+    - Top and bottom 2 box are the percentage of ratings in the two highest or lowest choices.
+    - NPS maps ratings to a 0-10 scale and subtracts the percentage of detractors (6 or less)
+      from the percentage of promoters (9 or more).
+    """
+    choices = np.asarray(list(rating_choices), dtype=float)
+    counts = np.asarray(histograms, dtype=float).reshape(-1, len(choices))
+    totals = counts.sum(axis=1)
+    rated = totals > 0
+    safe_totals = np.where(rated, totals, 1)
+
+    mean = counts.dot(choices) / safe_totals
+    variance = counts.dot(choices ** 2) / safe_totals - mean ** 2
+    std = np.sqrt(np.clip(variance, 0, None))
+
+    cumulative = np.cumsum(counts, axis=1)
+    percentiles = {}
+    for percentile in PERCENTILES:
+        ranks = np.ceil(totals * percentile / 100)
+        indexes = (cumulative < ranks[:, np.newaxis]).sum(axis=1)
+        percentiles[percentile] = choices[np.minimum(indexes, len(choices) - 1)]
+
+    top_2_box = counts[:, -2:].sum(axis=1) / safe_totals * 100
+    bottom_2_box = counts[:, :2].sum(axis=1) / safe_totals * 100
+
+    scaled = (choices - choices[0]) / (choices[-1] - choices[0]) * 10
+    promoters = counts[:, scaled >= 9].sum(axis=1)
+    detractors = counts[:, scaled <= 6].sum(axis=1)
+    nps = (promoters - detractors) / safe_totals * 100
+
+    statistics = []
+    for i in range(len(counts)):
+        if not rated[i]:
+            statistics.append(None)
+            continue
+        statistics.append({
+            "median": float(percentiles[50][i]),
+            "std": float(std[i]),
+            "percentiles": [(p, float(percentiles[p][i])) for p in PERCENTILES],
+            "top_2_box": float(top_2_box[i]),
+            "bottom_2_box": float(bottom_2_box[i]),
+            "nps": float(nps[i]),
+        })
+    return statistics
+
+
+def add_statistics(ratings, rating_choices):
+    """
+    Add a "statistics" entry to each rating dict of a report, based on its frequencies.
+    """
+    ratings = list(ratings)
+    if not ratings:
+        return
+    histograms = [[count for choice, count in rating["frequencies"]] for rating in ratings]
+    for rating, statistics in zip(ratings, get_statistics(histograms, rating_choices)):
+        rating["statistics"] = statistics
@@ -1,11 +1,43 @@
 from __future__ import absolute_import, unicode_literals
 
+import csv
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from builtins import range
+from importlib import import_module
+from io import StringIO
+from unittest import skipUnless
+from uuid import uuid4
+
+try:
+    from unittest.mock import Mock, patch
+except ImportError:
+    from mock import Mock, patch
+
+from django.apps import apps
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, connection, connections, transaction
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
 
 from django_dynamic_fixture import get
 
-from surveys.models import SurveyPage, SurveyPurchase
+from surveys.buffer import ResponseBuffer, flush_buffer
+from surveys.cache import LRUCache
+from surveys.codes import get_attempt_keys, get_code_filter, invalidate_code_filter
+from surveys.forms.surveys import SurveyResponseForm
+from surveys.models import (
+    SurveyPage, SurveyPurchase, SurveyPurchaseCode, SurveyResponse, Category, Subcategory,
+    Question, QuestionResponse, RatingCounter, BenchmarkCounter)
+from surveys.schema import compile_form_schema, get_form_schema
+from surveys.tree import load_survey_tree
 
 
 class BaseSurveyPageTest(TestCase):
@@ -48,3 +80,734 @@ class SurveyPurchaseTestCase(BaseSurveyPageTest):
         self.assertEqual(SurveyPurchase.objects.closed().count(), 1)
         self.assertEqual(self.USER.survey_purchases.open().count(), 2)
         self.assertEqual(self.USER.survey_purchases.closed()[0], purchases[0])
+
+
+class PurchaseCodeTestCase(BaseSurveyPageTest):
+
+    def redeem(self, code):
+        """
+        Load the code again for every redemption, like SurveyPurchaseCreate does.
+        """
+        return SurveyPurchaseCode.objects.get(pk=code.pk).redeem()
+
+    def test_redeem(self):
+        code = get(SurveyPurchaseCode, survey=self.SURVEY, uses_remaining=3)
+        self.assertTrue(self.redeem(code))
+        self.assertTrue(self.redeem(code))
+        self.assertTrue(self.redeem(code))
+        self.assertFalse(self.redeem(code))
+
+        # Codes with few uses are decremented in place
+        code.refresh_from_db()
+        self.assertEqual(code.uses_remaining, 0)
+        self.assertFalse(code.shards.exists())
+
+    @override_settings(SURVEYS_PURCHASE_CODE_SHARDS=4)
+    def test_redeem_sharded(self):
+        """
+        Codes with many uses are spread across shards and never oversold.
+        """
+        code = get(SurveyPurchaseCode, survey=self.SURVEY, uses_remaining=500)
+        with CaptureQueriesContext(connection) as context:
+            for i in range(0, 500):
+                self.assertTrue(self.redeem(code))
+        self.assertFalse(self.redeem(code))
+        code.refresh_from_db()
+        self.assertEqual(code.get_uses_remaining(), 0)
+        self.assertEqual(code.shards.count(), 4)
+
+        # The code row is only updated when a shard runs out, each time handing out a quarter
+        # of the uses left, and in place for the last uses that are too few to share
+        refills, uses_remaining = 0, 500
+        while uses_remaining >= 2 * 4:
+            uses_remaining -= max(1, uses_remaining // 4)
+            refills += 1
+        table = SurveyPurchaseCode._meta.db_table
+        code_updates = [query for query in context.captured_queries
+                        if query["sql"].startswith("UPDATE") and table in query["sql"]]
+        self.assertEqual(len(code_updates), refills + uses_remaining)
+
+    def test_generate(self):
+        """
+        Codes are generated in bulk without repeating existing ones.
+        """
+        get(SurveyPurchaseCode, survey=self.SURVEY, code="taken")
+        generated = ["taken", "new-1", "new-1", "new-2", "taken", "new-3"]
+        with patch.object(SurveyPurchaseCode, "generate_code", side_effect=generated):
+            # 3 collision checks, 2 inserts and a new code version in a transaction
+            with self.assertNumQueries(8):
+                codes = SurveyPurchaseCode.objects.generate(
+                    self.SURVEY, 3, uses_remaining=5, batch_size=2)
+        self.assertEqual(sorted(code.code for code in codes), ["new-1", "new-2", "new-3"])
+        self.assertEqual(
+            set(self.SURVEY.purchase_codes.values_list("code", "uses_remaining")),
+            {("taken", 0), ("new-1", 5), ("new-2", 5), ("new-3", 5)})
+
+    def test_code_filter(self):
+        """
+        The filter of usable codes has no false negatives and follows changes to the codes.
+        """
+        codes = SurveyPurchaseCode.objects.generate(self.SURVEY, 1000)
+        survey = SurveyPage.objects.get(pk=self.SURVEY.pk)
+        with self.assertNumQueries(1):
+            code_filter = get_code_filter(survey)
+        with self.assertNumQueries(0):
+            self.assertIs(get_code_filter(survey), code_filter)
+        self.assertTrue(all(code.code in code_filter for code in codes))
+        false_positives = sum(1 for i in range(0, 10000) if "invalid-%s" % i in code_filter)
+        self.assertLess(false_positives, 50)
+
+        # New codes are included once they're saved
+        code = get(SurveyPurchaseCode, survey=self.SURVEY, uses_remaining=1)
+        survey = SurveyPage.objects.get(pk=self.SURVEY.pk)
+        self.assertIn(code.code, get_code_filter(survey))
+
+        # Used up codes are left out when the filter is built again
+        self.assertTrue(code.redeem())
+        invalidate_code_filter(self.SURVEY.pk)
+        survey = SurveyPage.objects.get(pk=self.SURVEY.pk)
+        self.assertNotIn(code.code, get_code_filter(survey))
+
+        # Codes have their own version, the form schema of the survey is kept
+        self.assertEqual(survey.updated, self.SURVEY.updated)
+
+    def test_attempt_keys(self):
+        """
+        Failed attempts are counted by the address of the client, which can't be spoofed.
+        """
+        request = RequestFactory().post(
+            "/", REMOTE_ADDR="10.0.0.1", HTTP_X_FORWARDED_FOR="1.2.3.4, 10.0.0.2")
+        request.user = self.USER
+        self.assertEqual(get_attempt_keys(request), [
+            "surveys.code_attempts.ip.10.0.0.1",
+            "surveys.code_attempts.user.%s" % self.USER.pk])
+
+        # Behind a proxy the address it added to the header is used
+        with override_settings(SURVEYS_PURCHASE_CODE_IP_HEADER="HTTP_X_FORWARDED_FOR"):
+            self.assertEqual(get_attempt_keys(request)[0], "surveys.code_attempts.ip.10.0.0.2")
+
+    def test_generate_command(self):
+        stdout = StringIO()
+        call_command("generate_purchase_codes", str(self.SURVEY.pk), "25", uses=2, stdout=stdout)
+        rows = list(csv.reader(StringIO(stdout.getvalue())))
+        self.assertEqual(rows[0], ["code", "uses_remaining"])
+        codes = self.SURVEY.purchase_codes.values_list("code", flat=True)
+        self.assertEqual(len(rows), 26)
+        self.assertEqual(sorted(rows[1:]), sorted([code, "2"] for code in codes))
+
+        with self.assertRaises(CommandError):
+            call_command("generate_purchase_codes", "missing", "10", stdout=stdout)
+
+
+@skipUnless(connection.vendor != "sqlite", "SQLite doesn't support concurrent writes")
+class PurchaseCodeConcurrencyTestCase(TransactionTestCase):
+
+    @override_settings(SURVEYS_PURCHASE_CODE_SHARDS=4)
+    def test_concurrent_redemptions(self):
+        """
+        Concurrent redemptions use up the code exactly, without errors or lock timeouts.
+        """
+        survey = SurveyPage.objects.create(cost=10, max_rating=4)
+        code = get(SurveyPurchaseCode, survey=survey, uses_remaining=400)
+        redeemed = []
+        errors = []
+
+        def redeem():
+            try:
+                while SurveyPurchaseCode.objects.get(pk=code.pk).redeem():
+                    redeemed.append(1)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=redeem) for i in range(0, 8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(redeemed), 400)
+        code.refresh_from_db()
+        self.assertEqual(code.get_uses_remaining(), 0)
+
+
+class BaseCounterTest(BaseSurveyPageTest):
+    """
+    Create a purchase and a rating question to count responses.
+    """
+
+    def setUp(self):
+        super(BaseCounterTest, self).setUp()
+        self.purchase = get(SurveyPurchase, survey=self.SURVEY, report_generated=None)
+        self.question = get(
+            Question, subcategory__category__survey=self.SURVEY, field_type=Question.RATING_FIELD)
+
+    def add_responses(self, *ratings):
+        survey_response = get(SurveyResponse, purchase=self.purchase)
+        responses = [
+            QuestionResponse(response=survey_response, question=self.question, rating=rating)
+            for rating in ratings]
+        QuestionResponse.objects.bulk_create(responses)
+        return responses
+
+    def run_backfill(self, migration):
+        """
+        Run the data migration of `migration` with the current models.
+        """
+        module = import_module("surveys.migrations.%s" % migration)
+        module.backfill(apps, Mock(connection=connection))
+
+
+class RatingCounterTestCase(BaseCounterTest):
+
+    def test_increment(self):
+        RatingCounter.objects.increment(self.purchase, self.add_responses(1, 1, 3))
+        RatingCounter.objects.increment(self.purchase, self.add_responses(1, 4))
+        histogram = RatingCounter.objects.filter(purchase=self.purchase).get_histogram()
+        self.assertDictEqual(dict(histogram), {self.question.pk: {1: 3, 3: 1, 4: 1}})
+        self.assertEqual(RatingCounter.objects.count(), 3)
+
+    def test_rebuild_command(self):
+        RatingCounter.objects.increment(self.purchase, self.add_responses(1, 2))
+        self.add_responses(2, 3)  # Not counted
+
+        # The check should fail without modifying the counters
+        with self.assertRaises(CommandError):
+            call_command("rebuild_rating_counters", check=True, stdout=StringIO(),
+                         stderr=StringIO())
+        self.assertEqual(RatingCounter.objects.count(), 2)
+
+        # Rebuilding should match the raw responses
+        call_command("rebuild_rating_counters", stdout=StringIO(), stderr=StringIO())
+        histogram = RatingCounter.objects.filter(purchase=self.purchase).get_histogram()
+        self.assertDictEqual(dict(histogram), {self.question.pk: {1: 1, 2: 2, 3: 1}})
+        call_command("rebuild_rating_counters", check=True, stdout=StringIO(), stderr=StringIO())
+
+    def test_backfill(self):
+        """
+        Upgrading counts the responses stored before the counters existed.
+        """
+        self.add_responses(1, 1, None)
+        other = get(SurveyPurchase, survey=self.SURVEY, report_generated=None)
+        text_question = get(Question, subcategory=self.question.subcategory,
+                            field_type=Question.TEXT_FIELD)
+        get(QuestionResponse, response__purchase=other, question=text_question, rating=None)
+        self.run_backfill("0003_ratingcounter")
+        histogram = RatingCounter.objects.filter(purchase=self.purchase).get_histogram()
+        self.assertDictEqual(dict(histogram), {self.question.pk: {1: 2, None: 1}})
+        self.assertFalse(other.rating_counters.exists())
+
+    def test_unique_null_rating(self):
+        RatingCounter.objects.create(purchase=self.purchase, question=self.question, rating=None)
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                RatingCounter.objects.create(
+                    purchase=self.purchase, question=self.question, rating=None)
+
+
+class BenchmarkCounterTestCase(BaseCounterTest):
+
+    def add_purchase_responses(self, purchase, *ratings):
+        self.purchase = purchase
+        RatingCounter.objects.increment(purchase, self.add_responses(*ratings))
+
+    def test_benchmarks(self):
+        first = self.purchase
+        second = get(SurveyPurchase, survey=self.SURVEY, report_generated=None)
+        self.add_purchase_responses(first, 1, 2)
+        self.add_purchase_responses(second, 4, 4)
+
+        # Benchmarks only include closed purchases
+        report = first.generate_report()
+        self.assertEqual(report["benchmark_purchases"], 1)
+        self.assertEqual(report["benchmark"]["count"], 2)
+        self.assertEqual(report["benchmark"]["average"], 1.5)
+
+        report = second.generate_report()
+        self.assertEqual(report["benchmark_purchases"], 2)
+        self.assertEqual(report["rating"]["average"], 4)
+        self.assertEqual(report["benchmark"]["average"], 2.75)
+        question = report["categories"][0]["subcategories"][0]["questions"][0]
+        self.assertEqual(question["benchmark"]["count"], 4)
+
+        # Regenerating a report only adds the new responses
+        self.add_purchase_responses(first, 3)
+        report = first.generate_report()
+        self.assertEqual(report["benchmark_purchases"], 2)
+        self.assertEqual(report["benchmark"]["count"], 5)
+        histogram = BenchmarkCounter.objects.filter(survey=self.SURVEY).get_histogram()
+        self.assertDictEqual(dict(histogram), {self.question.pk: {1: 1, 2: 1, 3: 1, 4: 2}})
+
+        # Rebuilding the rating counters doesn't add the same responses again
+        call_command("rebuild_rating_counters", stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(first.generate_report()["benchmark"]["count"], 5)
+
+    def test_backfill(self):
+        """
+        Upgrading adds the purchases that are already closed to the benchmarks.
+        """
+        closed = self.purchase
+        self.add_purchase_responses(closed, 1, 2, None)
+        SurveyPurchase.objects.filter(pk=closed.pk).update(report_generated=now())
+        self.add_purchase_responses(
+            get(SurveyPurchase, survey=self.SURVEY, report_generated=None), 4)
+        self.run_backfill("0005_benchmarkcounter")
+
+        histogram = BenchmarkCounter.objects.filter(survey=self.SURVEY).get_histogram()
+        self.assertDictEqual(dict(histogram), {self.question.pk: {1: 1, 2: 1, None: 1}})
+        closed.refresh_from_db()
+        self.assertEqual(closed.generate_report()["benchmark"]["count"], 3)
+
+
+class ReportCacheTestCase(BaseSurveyPageTest):
+
+    def test_lru_cache(self):
+        cache = LRUCache(max_size=10)
+        cache.set("a", "A", size=4)
+        cache.set("b", "B", size=4)
+        self.assertEqual(cache.get("a"), "A")  # "b" is now the least recently used
+        cache.set("c", "C", size=4)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "A")
+        self.assertEqual(cache.get("c"), "C")
+        self.assertEqual(cache.size, 8)
+
+        # Values bigger than the cache are never stored
+        cache.set("d", "D", size=11)
+        self.assertIsNone(cache.get("d"))
+        self.assertEqual(len(cache), 2)
+
+    @override_settings(SURVEYS_REPORT_CACHE_SIZE=1024)
+    def test_parsed_report(self):
+        purchase = get(SurveyPurchase, survey=self.SURVEY, report_generated=None)
+        purchase.generate_report()
+        get_purchase = lambda: SurveyPurchase.objects.defer("report_cache").get(pk=purchase.pk)
+
+        # The first access loads the deferred report, the next ones are served from memory
+        first = get_purchase()
+        with self.assertNumQueries(1):
+            report = first.get_report_as_json()
+        second = get_purchase()
+        with self.assertNumQueries(0):
+            self.assertIs(second.get_report_as_json(), report)
+
+        # A new report version is not served from the cache
+        purchase.generate_report()
+        third = get_purchase()
+        with self.assertNumQueries(1):
+            self.assertIsNot(third.get_report_as_json(), report)
+
+    @override_settings(SURVEYS_REPORT_CACHE_SIZE=0, SURVEYS_REPORT_CACHE_BACKEND="default")
+    def test_parsed_report_shared_cache(self):
+        purchase = get(SurveyPurchase, survey=self.SURVEY, report_generated=None)
+        report = purchase.generate_report()
+        purchase.get_report_as_json()
+
+        # Other processes can read the parsed report from the shared cache
+        other = SurveyPurchase.objects.defer("report_cache").get(pk=purchase.pk)
+        with self.assertNumQueries(0):
+            rating = other.get_report_as_json()["rating"]
+        self.assertEqual(rating["count"], report["rating"]["count"])
+
+
+class FormSchemaTestCase(BaseSurveyPageTest):
+
+    def setUp(self):
+        super(FormSchemaTestCase, self).setUp()
+        self.category = get(Category, survey=self.SURVEY)
+        self.subcategory = get(Subcategory, category=self.category)
+        self.text_question = get(
+            Question, subcategory=self.subcategory, field_type=Question.TEXT_FIELD)
+        self.rating_question = get(
+            Question, subcategory=self.subcategory, field_type=Question.RATING_FIELD,
+            invert_rating=True)
+        self.purchase = get(SurveyPurchase, survey=self.SURVEY, report_generated=None)
+
+    def get_purchase(self):
+        return SurveyPurchase.objects.select_related("survey").get(pk=self.purchase.pk)
+
+    def test_form_schema(self):
+        schema = get_form_schema(self.get_purchase().survey)
+        self.assertEqual(schema.max_rating, 4)
+        self.assertEqual(schema.rating_choices, (1, 2, 3, 4))
+
+        # Rating questions come first
+        self.assertEqual(
+            [spec.question_id for spec in schema.fields],
+            [self.rating_question.pk, self.text_question.pk])
+        self.assertTrue(schema.fields[0].invert_rating)
+
+        # Schemas are compiled from the survey tree, loaded in one query
+        survey = SurveyPage.objects.get(pk=self.SURVEY.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(compile_form_schema(survey).fields, schema.fields)
+
+    def test_survey_tree(self):
+        other_category = get(Category, survey=self.SURVEY)
+        other_subcategory = get(Subcategory, category=other_category)
+        other_question = get(
+            Question, subcategory=other_subcategory, field_type=Question.RATING_FIELD)
+        Category.objects.filter(pk=self.category.pk).update(_order=2)
+        Question.objects.filter(pk=self.text_question.pk).update(_order=5)
+
+        with self.assertNumQueries(1):
+            tree = load_survey_tree(self.SURVEY)
+        self.assertEqual([category.id for category in tree.categories],
+                         [other_category.pk, self.category.pk])
+        self.assertEqual(
+            [question.id for category, subcategory, question in tree.iter_questions()],
+            [other_question.pk, self.rating_question.pk, self.text_question.pk])
+        self.assertTrue(tree.categories[1].subcategories[0].questions[0].invert_rating)
+
+        # Nodes are immutable so the tree can be shared
+        with self.assertRaises(AttributeError):
+            tree.categories[0].title = "Changed"
+        with self.assertRaises(AttributeError):
+            tree.categories[0].__dict__
+
+    def test_form_without_queries(self):
+        for i in range(0, 300):
+            get(Question, subcategory=self.subcategory, field_type=Question.RATING_FIELD)
+
+        # The schema is compiled once and cached for the next forms
+        purchase = self.get_purchase()
+        with self.assertNumQueries(1):
+            self.assertEqual(len(SurveyResponseForm(purchase=purchase).fields), 303)
+        purchase = self.get_purchase()
+        with self.assertNumQueries(0):
+            self.assertEqual(len(SurveyResponseForm(purchase=purchase).fields), 303)
+
+    def test_invalidation(self):
+        schema = get_form_schema(self.get_purchase().survey)
+
+        # Every change to the survey tree produces a new schema
+        self.rating_question.prompt = "Changed"
+        self.rating_question.save()
+        changed = get_form_schema(self.get_purchase().survey)
+        self.assertEqual(changed.fields[0].prompt, "Changed")
+
+        subcategory = get(Subcategory, category=self.category)
+        self.assertIsNot(get_form_schema(self.get_purchase().survey), changed)
+        changed = get_form_schema(self.get_purchase().survey)
+
+        get(Question, subcategory=subcategory, field_type=Question.TEXT_FIELD)
+        self.assertEqual(len(get_form_schema(self.get_purchase().survey).fields), 3)
+
+        self.text_question.delete()
+        self.assertEqual(len(get_form_schema(self.get_purchase().survey).fields), 2)
+
+        self.category.delete()
+        self.assertEqual(get_form_schema(self.get_purchase().survey).fields, ())
+
+        SurveyPage.objects.filter(pk=self.SURVEY.pk).update(max_rating=5)
+        self.SURVEY.refresh_from_db()
+        self.SURVEY.save()
+        self.assertEqual(get_form_schema(self.get_purchase().survey).max_rating, 5)
+        self.assertEqual(len(schema.fields), 2)  # Old schemas are never modified
+
+    def test_invalidation_move(self):
+        """
+        Nodes moved to another survey are removed from the schema of their old survey.
+        """
+        other_survey = SurveyPage.objects.create(cost=10, max_rating=4)
+        other_subcategory = get(Subcategory, category__survey=other_survey)
+
+        def get_question_ids(survey):
+            survey = SurveyPage.objects.get(pk=survey.pk)
+            return [spec.question_id for spec in get_form_schema(survey).fields]
+
+        self.assertEqual(len(get_question_ids(self.SURVEY)), 2)
+        self.assertEqual(get_question_ids(other_survey), [])
+
+        self.text_question.subcategory = other_subcategory
+        self.text_question.save()
+        self.assertEqual(get_question_ids(self.SURVEY), [self.rating_question.pk])
+        self.assertEqual(get_question_ids(other_survey), [self.text_question.pk])
+
+        self.subcategory.category = other_subcategory.category
+        self.subcategory.save()
+        self.assertEqual(get_question_ids(self.SURVEY), [])
+        self.assertEqual(len(get_question_ids(other_survey)), 2)
+
+        other_subcategory.category.survey = self.SURVEY
+        other_subcategory.category.save()
+        self.assertEqual(len(get_question_ids(self.SURVEY)), 2)
+        self.assertEqual(get_question_ids(other_survey), [])
+
+    def save_form(self, rating):
+        purchase = self.get_purchase()
+        data = {"question_%s" % spec.question_id: rating
+                for spec in get_form_schema(purchase.survey).fields}
+        form = SurveyResponseForm(data=data, purchase=purchase)
+        self.assertTrue(form.is_valid())
+        with CaptureQueriesContext(connection) as context:
+            survey_response = form.save()
+        return survey_response, len(context)
+
+    def test_save_queries(self):
+        """
+        Saving a response takes a fixed number of queries whatever the number of inverted
+        questions, and inverted ratings are stored normalized.
+        """
+        num_queries = self.save_form(rating=1)[1]
+        for i in range(0, 20):
+            get(Question, subcategory=self.subcategory, field_type=Question.RATING_FIELD,
+                invert_rating=True)
+        self.purchase = get(SurveyPurchase, survey=self.SURVEY, report_generated=None)
+        survey_response, queries = self.save_form(rating=1)
+        self.assertEqual(queries, num_queries)
+
+        ratings = set(survey_response.responses.filter(question__invert_rating=True)
+                      .values_list("rating", flat=True))
+        self.assertEqual(ratings, {4})
+
+    def test_normalize_ratings(self):
+        responses = [
+            QuestionResponse(question_id=self.rating_question.pk, rating="1"),
+            QuestionResponse(question_id=self.rating_question.pk, rating=None),
+            QuestionResponse(question_id=self.text_question.pk, rating=2),
+        ]
+        QuestionResponse.objects.normalize_ratings(responses, 4, {self.rating_question.pk})
+        self.assertEqual([r.rating for r in responses], [4, None, 2])
+
+        # Single responses resolve the question and survey themselves
+        response = QuestionResponse(question=self.rating_question, rating=3)
+        response.normalize_rating()
+        self.assertEqual(response.rating, 2)
+
+    def test_denormalized_fields(self):
+        survey_response = get(SurveyResponse, purchase=self.purchase)
+        other_response = get(SurveyResponse, purchase=self.purchase)
+
+        # Unknown values are looked up in one query each
+        with self.assertNumQueries(3):
+            QuestionResponse.objects.bulk_create([
+                QuestionResponse(response=survey_response, question=self.rating_question),
+                QuestionResponse(response_id=other_response.pk,
+                                 question_id=self.text_question.pk)])
+        get(QuestionResponse, response=survey_response, question=self.text_question)
+        self.assertEqual(
+            sorted(QuestionResponse.objects.values_list("purchase", "field_type")),
+            [(self.purchase.pk, Question.RATING_FIELD), (self.purchase.pk, Question.TEXT_FIELD),
+             (self.purchase.pk, Question.TEXT_FIELD)])
+
+        # Changing the type of a question updates its responses
+        self.text_question.field_type = Question.RATING_FIELD
+        self.text_question.save()
+        self.assertEqual(
+            QuestionResponse.objects.filter(field_type=Question.RATING_FIELD).count(), 3)
+
+    def test_question_survey(self):
+        self.assertEqual(set(self.SURVEY.get_questions()),
+                         {self.text_question, self.rating_question})
+
+        # Questions follow their subcategory and category when they're moved
+        other_survey = SurveyPage.objects.create(max_rating=4)
+        other_category = get(Category, survey=other_survey)
+        self.subcategory.category = other_category
+        self.subcategory.save()
+        self.assertEqual(set(other_survey.get_questions()),
+                         {self.text_question, self.rating_question})
+
+        other_category.survey = self.SURVEY
+        other_category.save()
+        self.assertEqual(self.SURVEY.get_questions().count(), 2)
+        self.assertFalse(other_survey.get_questions().exists())
+
+    @override_settings(SURVEYS_FORM_SCHEMA_CACHE_SIZE=0, SURVEYS_REPORT_CACHE_BACKEND="default")
+    def test_shared_cache(self):
+        schema = get_form_schema(self.get_purchase().survey)
+
+        # Other processes can read the schema from the shared cache
+        survey = SurveyPage.objects.get(pk=self.SURVEY.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(get_form_schema(survey), schema)
+
+
+class ResponseBufferTestCase(BaseSurveyPageTest):
+
+    def setUp(self):
+        super(ResponseBufferTestCase, self).setUp()
+        subcategory = get(Subcategory, category=get(Category, survey=self.SURVEY))
+        self.rating_question = get(
+            Question, subcategory=subcategory, field_type=Question.RATING_FIELD,
+            invert_rating=True)
+        self.text_question = get(
+            Question, subcategory=subcategory, field_type=Question.TEXT_FIELD)
+        self.purchase = get(SurveyPurchase, survey=self.SURVEY, report_generated=None)
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, "buffer.sqlite3")
+        self.buffer = self.open_buffer()
+
+    def open_buffer(self):
+        buffer = ResponseBuffer(self.path)
+        self.addCleanup(buffer.close)
+        return buffer
+
+    def submit(self, buffer, count=1, token=None):
+        data = {
+            "question_%s" % self.rating_question.pk: 1,
+            "question_%s" % self.text_question.pk: "Text",
+            "submission_token": token or "",
+        }
+        for i in range(0, count):
+            form = SurveyResponseForm(data=data, purchase=self.purchase)
+            self.assertTrue(form.is_valid())
+            form.save_to_buffer(buffer)
+
+    def test_flush(self):
+        self.submit(self.buffer, count=3)
+        self.assertEqual(len(self.buffer), 3)
+        self.assertFalse(SurveyResponse.objects.exists())
+
+        # Buffered submissions are durable and survive a restart of the process
+        buffer = self.open_buffer()
+        self.assertEqual(buffer.buffer_id, self.buffer.buffer_id)
+        self.assertEqual(flush_buffer(buffer, batch_size=2), 2)
+        self.assertEqual(flush_buffer(buffer, batch_size=2), 1)
+        self.assertEqual(flush_buffer(buffer, batch_size=2), 0)
+        self.assertEqual(len(buffer), 0)
+
+        self.assertEqual(self.purchase.responses.count(), 3)
+        self.assertEqual(
+            set(QuestionResponse.objects.values_list("question", "rating", "text_response")),
+            {(self.rating_question.pk, 4, ""), (self.text_question.pk, None, "Text")})
+        counters = RatingCounter.objects.filter(purchase=self.purchase).get_histogram()
+        self.assertDictEqual(dict(counters), {self.rating_question.pk: {4: 3}})
+
+        # Responses to deleted purchases and questions are dropped
+        self.submit(self.buffer)
+        other_purchase = get(SurveyPurchase, survey=self.SURVEY, report_generated=None)
+        self.buffer.append(
+            other_purchase.pk, now(), None, [(self.text_question.pk, None, "", False)])
+        other_purchase.delete()
+        self.text_question.delete()
+        self.assertEqual(flush_buffer(self.buffer), 2)
+        self.assertEqual(self.purchase.responses.count(), 4)
+
+    def test_closed_purchase(self):
+        """
+        Responses buffered before the report of their purchase was generated are dropped.
+        """
+        self.submit(self.buffer, count=2)
+        other_purchase = get(SurveyPurchase, survey=self.SURVEY, report_generated=None)
+        self.buffer.append(
+            other_purchase.pk, now(), None, [(self.text_question.pk, None, "Text", False)])
+        self.purchase.generate_report()
+
+        with self.assertLogs("surveys.buffer", "WARNING"):
+            self.assertEqual(flush_buffer(self.buffer), 3)
+        self.assertEqual(len(self.buffer), 0)
+        self.assertFalse(self.purchase.responses.exists())
+        self.assertFalse(RatingCounter.objects.filter(purchase=self.purchase).exists())
+        self.assertEqual(other_purchase.responses.count(), 1)
+
+    def test_duplicates(self):
+        """
+        Retried submissions are only flushed once, in the same batch or in later ones.
+        """
+        token = uuid4()
+        self.submit(self.buffer, count=2, token=token)
+        self.submit(self.buffer)
+        self.assertEqual(flush_buffer(self.buffer), 3)
+        self.assertEqual(self.purchase.responses.count(), 2)
+
+        self.submit(self.buffer, token=token)
+        self.assertEqual(flush_buffer(self.buffer), 1)
+        self.assertEqual(self.purchase.responses.filter(submission_token=token).count(), 1)
+        counters = RatingCounter.objects.filter(purchase=self.purchase).get_histogram()
+        self.assertDictEqual(dict(counters), {self.rating_question.pk: {4: 2}})
+
+    def test_recovery(self):
+        """
+        Submissions are flushed exactly once when the flusher dies at any point.
+        """
+        self.submit(self.buffer, count=2)
+
+        # The database transaction fails, submissions stay in the buffer
+        with patch("surveys.buffer.save_responses", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                flush_buffer(self.buffer)
+        self.assertFalse(SurveyResponse.objects.exists())
+        self.assertEqual(len(self.buffer), 2)
+
+        # The process dies after saving the responses but before discarding them
+        with patch.object(ResponseBuffer, "discard", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                flush_buffer(self.buffer)
+        self.assertEqual(SurveyResponse.objects.count(), 2)
+        self.assertEqual(len(self.buffer), 2)
+
+        # The next flush skips the submissions that were already saved
+        self.submit(self.buffer)
+        self.assertEqual(flush_buffer(self.open_buffer()), 1)
+        self.assertEqual(SurveyResponse.objects.count(), 3)
+        self.assertEqual(len(self.buffer), 0)
+
+        # A new buffer file starts over
+        self.buffer.close()
+        os.remove(self.path)
+        self.submit(self.buffer)
+        self.assertEqual(flush_buffer(self.buffer), 1)
+        self.assertEqual(SurveyResponse.objects.count(), 4)
+
+    @skipUnless(connection.features.can_return_rows_from_bulk_insert,
+                "SurveyResponses are inserted one by one without bulk insert RETURNING")
+    def test_flush_queries(self):
+        """
+        Flushing takes the same number of queries whatever the number of submissions.
+        """
+        self.submit(self.buffer)
+        flush_buffer(self.buffer)  # Create the checkpoint and rating counters
+        self.submit(self.buffer, count=2)
+        with CaptureQueriesContext(connection) as context:
+            flush_buffer(self.buffer)
+        num_queries = len(context)
+
+        # Small enough for SQLite to insert every table in a single query
+        self.submit(self.buffer, count=80)
+        with self.assertNumQueries(num_queries):
+            self.assertEqual(flush_buffer(self.buffer), 80)
+
+    def test_flush_command(self):
+        with self.assertRaises(CommandError):
+            call_command("flush_response_buffer", stdout=StringIO())
+
+        self.submit(self.buffer, count=3)
+        stdout = StringIO()
+        with override_settings(SURVEYS_RESPONSE_BUFFER=self.path):
+            call_command("flush_response_buffer", batch_size=2, stdout=stdout)
+        self.assertIn("Flushed 3 submission(s)", stdout.getvalue())
+        self.assertEqual(SurveyResponse.objects.count(), 3)
+
+
+class PerformanceBenchmarksTestCase(TestCase):
+
+    def test_benchmark_command(self):
+        """
+        Run the benchmarks with a tiny survey to make sure they keep working.
+        Templates aren't rendered since the test project doesn't include Mezzanine's URLs.
+        """
+        fd, path = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+
+        call_command(
+            "benchmark_surveys", categories=2, subcategories=2, questions=3, responses=5,
+            repeat=1, render=False, output=path, stdout=StringIO())
+        with open(path) as f:
+            results = json.load(f)
+
+        self.assertEqual(results["params"]["responses"], 5)
+        self.assertSetEqual(set(results["results"]), {
+            "form_init", "form_save", "generate_report", "take_view_get", "take_view_post",
+            "report_view_get"})
+        for result in results["results"].values():
+            self.assertGreater(result["queries"], 0)
+
+        # Benchmark data is rolled back
+        self.assertFalse(SurveyPage.objects.exists())
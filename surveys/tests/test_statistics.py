@@ -0,0 +1,118 @@
+from __future__ import absolute_import, unicode_literals
+
+from unittest import skipUnless
+
+from django.template.loader import render_to_string
+from django.test import TestCase, override_settings
+
+from django_dynamic_fixture import get
+
+try:
+    import numpy  # noqa
+    NUMPY_INSTALLED = True
+except ImportError:
+    NUMPY_INSTALLED = False
+
+from surveys.models import (
+    SurveyPage, SurveyPurchase, SurveyResponse, Category, Subcategory, Question,
+    QuestionResponse, RatingCounter)
+
+
+@skipUnless(NUMPY_INSTALLED, "numpy not installed")
+class StatisticsTestCase(TestCase):
+    """
+    Test statistics are calculated from the rating histograms.
+    """
+
+    def setUp(self):
+        """
+        Execute the imports here so they don't run if numpy is not installed.
+        """
+        super(StatisticsTestCase, self).setUp()
+        from surveys.statistics import get_statistics
+        self.get_statistics = get_statistics
+
+    def test_get_statistics(self):
+        histograms = [
+            [1, 1, 1, 1, 1],  # 1, 2, 3, 4, 5
+            [0, 0, 0, 2, 2],  # 4, 4, 5, 5
+            [0, 0, 0, 0, 0],  # No ratings
+        ]
+        uniform, positive, empty = self.get_statistics(histograms, range(1, 6))
+
+        self.assertEqual(uniform["median"], 3)
+        self.assertAlmostEqual(uniform["std"], 2 ** 0.5)
+        self.assertListEqual(uniform["percentiles"], [(25, 2), (50, 3), (75, 4), (90, 5)])
+        self.assertAlmostEqual(uniform["top_2_box"], 40)
+        self.assertAlmostEqual(uniform["bottom_2_box"], 40)
+        self.assertAlmostEqual(uniform["nps"], -40)  # 1 promoter (5), 3 detractors (1, 2, 3)
+
+        self.assertEqual(positive["median"], 4)
+        self.assertAlmostEqual(positive["std"], 0.5)
+        self.assertAlmostEqual(positive["top_2_box"], 100)
+        self.assertAlmostEqual(positive["nps"], 50)
+
+        self.assertIsNone(empty)
+
+
+@skipUnless(NUMPY_INSTALLED, "numpy not installed")
+@override_settings(SURVEYS_REPORT_STATISTICS=True)
+class ReportStatisticsTestCase(TestCase):
+    """
+    Test statistics are added to every rating node of generated reports.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        """
+        Create 2 categories with 3 rating questions and a text question, and 2 responses.
+        """
+        super(ReportStatisticsTestCase, cls).setUpTestData()
+        survey = SurveyPage.objects.create(cost=10, max_rating=4)
+        cls.purchase = get(SurveyPurchase, survey=survey, report_generated=None,
+                           report_status="")
+
+        subcategory1 = get(Subcategory, category=get(Category, survey=survey))
+        subcategory2 = get(Subcategory, category=get(Category, survey=survey))
+        questions = [
+            get(Question, subcategory=subcategory1, field_type=Question.RATING_FIELD),
+            get(Question, subcategory=subcategory1, field_type=Question.RATING_FIELD),
+            get(Question, subcategory=subcategory2, field_type=Question.RATING_FIELD),
+            get(Question, subcategory=subcategory2, field_type=Question.TEXT_FIELD),
+        ]
+        for values in [[1, 3, 2, "Text 1"], [1, 4, 2, "Text 2"]]:
+            survey_response = get(SurveyResponse, purchase=cls.purchase)
+            QuestionResponse.objects.bulk_create([
+                QuestionResponse(
+                    question=question, response=survey_response,
+                    rating=value if question.field_type == Question.RATING_FIELD else None,
+                    text_response=value if question.field_type == Question.TEXT_FIELD else "")
+                for question, value in zip(questions, values)])
+        RatingCounter.objects.rebuild(cls.purchase)
+
+    def test_statistics(self):
+        report = self.purchase.generate_report()
+        self.assertEqual(report["rating"]["statistics"]["median"], 2)  # 1, 1, 2, 2, 3, 4
+
+        category1, category2 = report["categories"]
+        self.assertEqual(category1["rating"]["statistics"]["median"], 1)  # 1, 1, 3, 4
+        self.assertEqual(category1["rating"]["statistics"]["top_2_box"], 50)
+        self.assertEqual(category2["rating"]["statistics"]["median"], 2)
+
+        q1, q2 = category1["subcategories"][0]["questions"]
+        self.assertEqual(q1["rating"]["statistics"]["median"], 1)
+        self.assertEqual(q1["rating"]["statistics"]["std"], 0)
+        self.assertEqual(q1["rating"]["statistics"]["bottom_2_box"], 100)
+        self.assertEqual(q2["rating"]["statistics"]["top_2_box"], 100)
+        self.assertEqual(q2["rating"]["statistics"]["percentiles"][-1], (90, 4))
+
+        # Statistics are rendered in the report table
+        html = render_to_string("surveys/includes/category_row.html", {
+            "report": report, "category": category1})
+        self.assertIn("<td>50.0%</td>", html)  # Top 2 box of category 1
+
+    def test_disabled(self):
+        with override_settings(SURVEYS_REPORT_STATISTICS=False):
+            report = self.purchase.generate_report()
+        self.assertNotIn("statistics", report["rating"])
+        self.assertNotIn("statistics", report["categories"][0]["rating"])
@@ -1,9 +1,37 @@
 from __future__ import absolute_import, unicode_literals
 
-from builtins import range, zip
+import csv
+import json
+import os
+import shutil
+import tempfile
 
-from django.contrib.auth.models import User
-from django.test import TestCase
+from builtins import range, zip
+from datetime import timedelta
+from inspect import iscoroutine
+from io import StringIO
+from unittest import skipUnless
+from uuid import uuid4
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from asgiref.sync import async_to_sync
+
+from django.conf import settings as django_settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.exceptions import PermissionDenied
+from django.db import connection
+from django.db.models import QuerySet
+from django.middleware.csrf import get_token
+from django.template.loader import render_to_string
+from django.test import Client, RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
 
 from django_dynamic_fixture import get
 
@@ -11,15 +39,23 @@ from mezzanine.core.models import CONTENT_STATUS_DRAFT, CONTENT_STATUS_PUBLISHED
 
 from mezzy.utils.tests import ViewTestMixin
 
+from surveys.archive import archive_purchase
+from surveys.buffer import flush_buffer, get_response_buffer
+from surveys.forms.surveys import SurveyResponseForm
+from surveys.instrumentation import QueryBudgetTestMixin, RequestMetrics, execute_wrapper
+from surveys.routers import PIN_COOKIE, use_primary, use_replica
+
 from surveys.models import (
-    SurveyPage, SurveyPurchase, SurveyPurchaseCode, SurveyResponse, Category, Subcategory,
-    Question, QuestionResponse)
+    SurveyPage, SurveyPurchase, SurveyPurchaseCode, SurveyResponse, SurveyResponseDraft,
+    Category, Subcategory, Question, QuestionResponse, RatingCounter)
 from surveys.views import (
     SurveyPurchaseCreate, SurveyPurchaseDetail, SurveyResponseCreate, SurveyResponseComplete,
-    SurveyPurchaseReport)
+    SurveyPurchaseReport, SurveyPurchaseReportStatus, SurveyPurchaseExport,
+    SurveyPurchaseIngest, AsyncSurveyResponseCreate, AsyncSurveyResponseComplete,
+    SurveyResponsePagedCreate)
 
 
-class SurveyPageTestCase(ViewTestMixin, TestCase):
+class SurveyPageTestCase(QueryBudgetTestMixin, ViewTestMixin, TestCase):
     """
     Create a SurveyPage and user as fixtures.
     """
@@ -34,6 +70,10 @@ class SurveyPageTestCase(ViewTestMixin, TestCase):
 class SurveyPurchaseCreateTestCase(SurveyPageTestCase):
     view = SurveyPurchaseCreate
 
+    def setUp(self):
+        super(SurveyPurchaseCreateTestCase, self).setUp()
+        cache.clear()  # Failed purchase code attempts
+
     def test_access(self):
         survey = SurveyPage.objects.create()
 
@@ -48,7 +88,8 @@ class SurveyPurchaseCreateTestCase(SurveyPageTestCase):
         # Logged in users can access surveys
         survey.status = CONTENT_STATUS_PUBLISHED
         survey.save()
-        self.assert200(self.view, slug=survey.slug, user=self.USER)
+        response = self.assert200(self.view, slug=survey.slug, user=self.USER)
+        self.assertWithinQueryBudget(response)
 
     def test_purchase_code(self):
         """
@@ -74,6 +115,7 @@ class SurveyPurchaseCreateTestCase(SurveyPageTestCase):
         data["purchase_code"] = valid_code.code
         response = self.post(self.view, slug=self.SURVEY.slug, user=self.USER, data=data)
         purchase = SurveyPurchase.objects.get()
+        self.assertWithinQueryBudget(response)
         self.assertEqual(response["location"], purchase.get_absolute_url())
         self.assertEqual(purchase.purchaser, self.USER)
         self.assertEqual(purchase.survey, self.SURVEY)
@@ -85,6 +127,34 @@ class SurveyPurchaseCreateTestCase(SurveyPageTestCase):
         valid_code.refresh_from_db()
         self.assertEqual(valid_code.uses_remaining, 9)
 
+    def test_invalid_purchase_codes(self):
+        """
+        Invalid codes are rejected without looking them up and clients get limited attempts.
+        """
+        valid_code = get(SurveyPurchaseCode, survey=self.SURVEY, uses_remaining=10)
+        data = {"purchase_code": "invalid"}
+        self.post(self.view, slug=self.SURVEY.slug, user=self.USER, data=data)  # Builds filter
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.post(self.view, slug=self.SURVEY.slug, user=self.USER, data=data)
+        self.assertFalse(any(SurveyPurchaseCode._meta.db_table in query["sql"]
+                             for query in context.captured_queries))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("not valid", str(response.context_data["form"].errors))
+
+        # After too many failed attempts even valid codes are rejected
+        with override_settings(SURVEYS_PURCHASE_CODE_ATTEMPTS=3):
+            self.post(self.view, slug=self.SURVEY.slug, user=self.USER, data=data)
+            data["purchase_code"] = valid_code.code
+            response = self.post(self.view, slug=self.SURVEY.slug, user=self.USER, data=data)
+        self.assertIn("Too many", str(response.context_data["form"].errors))
+        self.assertEqual(SurveyPurchase.objects.count(), 0)
+
+        # The limit only applies to recent attempts
+        cache.clear()
+        self.post(self.view, slug=self.SURVEY.slug, user=self.USER, data=data)
+        self.assertEqual(SurveyPurchase.objects.count(), 1)
+
     def test_payment(self):
         """
         Purchases completed via the default payment method (doesn't do anything).
@@ -122,9 +192,12 @@ class SurveyPurchaseDetailTestCase(SurveyPageTestCase):
         # Owner can access the purchase
         response = self.assert200(SurveyPurchaseDetail, public_id=self.PURCHASE_ID, user=self.USER)
         self.assertEqual(response.context_data["purchase"], self.PURCHASE)
+        self.assertWithinQueryBudget(response)
 
 
 class SurveyResponseCreateTestCase(SurveyPageTestCase):
+    view = SurveyResponseCreate
+    complete_view = SurveyResponseComplete
 
     @classmethod
     def setUpTestData(cls):
@@ -152,14 +225,16 @@ class SurveyResponseCreateTestCase(SurveyPageTestCase):
             get(Question, subcategory__category__survey=self.SURVEY)
 
         # Anon users can access the survey
-        self.assert200(SurveyResponseCreate, public_id=self.PURCHASE_ID)
+        self.assert200(self.view, public_id=self.PURCHASE_ID)
 
         # Logged-in users can access the survey
-        response = self.assert200(SurveyResponseCreate, public_id=self.PURCHASE_ID, user=self.USER)
+        response = self.assert200(self.view, public_id=self.PURCHASE_ID, user=self.USER)
 
-        # A form is present in the context with our 5 questions
+        # A form is present in the context with our 5 questions and the submission token
         fields = response.context_data["form"].fields
-        self.assertEqual(len(fields), 5)
+        self.assertEqual(len(fields), 6)
+        self.assertIn("submission_token", fields)
+        self.assertWithinQueryBudget(response)
 
     def test_survey_response(self):
         """
@@ -181,38 +256,39 @@ class SurveyResponseCreateTestCase(SurveyPageTestCase):
         }
 
         # Rating field should provide choices according to the "max_rating" of the survey
-        response = self.assert200(SurveyResponseCreate, public_id=self.PURCHASE_ID)
+        response = self.assert200(self.view, public_id=self.PURCHASE_ID)
         choices = response.context_data["form"].fields[rating_field_key].choices
         self.assertEqual(len(choices), self.SURVEY.max_rating)
 
         # Required rating question should fail validation if not provided
         data[rating_field_key] = ""
-        response = self.post(SurveyResponseCreate, public_id=self.PURCHASE_ID, data=data)
+        response = self.post(self.view, public_id=self.PURCHASE_ID, data=data)
         self.assertFieldError(response, rating_field_key)
         self.assertEqual(SurveyResponse.objects.count(), 0)
 
         # Rating question should fail validation if value is above max_rating
         data[rating_field_key] = self.SURVEY.max_rating + 1
-        response = self.post(SurveyResponseCreate, public_id=self.PURCHASE_ID, data=data)
+        response = self.post(self.view, public_id=self.PURCHASE_ID, data=data)
         self.assertFieldError(response, rating_field_key)
         self.assertEqual(SurveyResponse.objects.count(), 0)
 
         # Rating question should fail validation if value is below 1
         data[rating_field_key] = 0
-        response = self.post(SurveyResponseCreate, public_id=self.PURCHASE_ID, data=data)
+        response = self.post(self.view, public_id=self.PURCHASE_ID, data=data)
         self.assertFieldError(response, rating_field_key)
         self.assertEqual(SurveyResponse.objects.count(), 0)
 
         # Rating question should fail validation if value is not numeric
         data[rating_field_key] = "abcd"
-        response = self.post(SurveyResponseCreate, public_id=self.PURCHASE_ID, data=data)
+        response = self.post(self.view, public_id=self.PURCHASE_ID, data=data)
         self.assertFieldError(response, rating_field_key)
         self.assertEqual(SurveyResponse.objects.count(), 0)
 
         # Rating question should pass validation if value is correct
         data[rating_field_key] = self.SURVEY.max_rating
-        response = self.post(SurveyResponseCreate, public_id=self.PURCHASE_ID, data=data)
+        response = self.post(self.view, public_id=self.PURCHASE_ID, data=data)
         survey_response = SurveyResponse.objects.get()
+        self.assertWithinQueryBudget(response)
 
         # Verify the inverted rating question was in fact inverted
         inverted_response = QuestionResponse.objects.get(question=inv_rating_question)
@@ -235,11 +311,354 @@ class SurveyResponseCreateTestCase(SurveyPageTestCase):
         # Verify we've been redirected to the confirmation message
         self.assertEqual(response["location"], self.PURCHASE.get_complete_url())
 
+        # Verify the rating counters were updated with the normalized ratings
+        counters = RatingCounter.objects.filter(purchase=self.PURCHASE).get_histogram()
+        self.assertDictEqual(dict(counters), {
+            rating_question.pk: {self.SURVEY.max_rating: 1},
+            inv_rating_question.pk: {1: 1},
+        })
+
+        # A second submission increments the existing counters
+        self.post(self.view, public_id=self.PURCHASE_ID, data=data)
+        counters = RatingCounter.objects.filter(purchase=self.PURCHASE).get_histogram()
+        self.assertDictEqual(dict(counters), {
+            rating_question.pk: {self.SURVEY.max_rating: 2},
+            inv_rating_question.pk: {1: 2},
+        })
+
+    def test_duplicate_submission(self):
+        """
+        Posting the same form more than once only saves the first submission.
+        """
+        question = get(
+            Question, subcategory__category__survey=self.SURVEY, field_type=Question.RATING_FIELD)
+        response = self.assert200(self.view, public_id=self.PURCHASE_ID)
+        token = response.context_data["form"].initial["submission_token"]
+        data = {"question_%s" % question.pk: 1, "submission_token": token}
+
+        for i in range(0, 3):
+            response = self.post(self.view, public_id=self.PURCHASE_ID, data=data)
+            self.assertEqual(response["location"], self.PURCHASE.get_complete_url())
+        survey_response = SurveyResponse.objects.get()
+        self.assertEqual(survey_response.submission_token, token)
+        self.assertEqual(QuestionResponse.objects.count(), 1)
+        counters = RatingCounter.objects.filter(purchase=self.PURCHASE).get_histogram()
+        self.assertDictEqual(dict(counters), {question.pk: {1: 1}})
+
+        # A new form gets a new token
+        response = self.assert200(self.view, public_id=self.PURCHASE_ID)
+        self.assertNotEqual(response.context_data["form"].initial["submission_token"], token)
+
+        # Tokens are unique per purchase, replaying one on another purchase doesn't return
+        # the first purchase's response and it's only saved once there too
+        other_purchase = get(SurveyPurchase, survey=self.SURVEY, report_generated=None)
+        for i in range(0, 2):
+            form = SurveyResponseForm(data=data, purchase=other_purchase)
+            self.assertTrue(form.is_valid())
+            other_response = form.save()
+            self.assertEqual(other_response.purchase, other_purchase)
+            self.assertNotEqual(other_response.pk, survey_response.pk)
+        self.assertEqual(other_purchase.responses.get(), other_response)
+        self.assertEqual(self.PURCHASE.responses.get(), survey_response)
+
+    def test_buffered_response(self):
+        """
+        Submissions are appended to the response buffer when it's enabled.
+        """
+        question = get(
+            Question, subcategory__category__survey=self.SURVEY, field_type=Question.TEXT_FIELD)
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "buffer.sqlite3")
+
+        with override_settings(SURVEYS_RESPONSE_BUFFER=path):
+            response = self.post(
+                self.view, public_id=self.PURCHASE_ID,
+                data={"question_%s" % question.pk: "TEST"})
+            buffer = get_response_buffer()
+        self.addCleanup(buffer.close)
+        self.assertEqual(response["location"], self.PURCHASE.get_complete_url())
+        self.assertFalse(SurveyResponse.objects.exists())
+        self.assertEqual(len(buffer), 1)
+
+        flush_buffer(buffer)
+        self.assertEqual(
+            QuestionResponse.objects.get(response__purchase=self.PURCHASE).text_response, "TEST")
+
     def test_survey_response_complete(self):
-        response = self.assert200(SurveyResponseComplete, public_id=self.PURCHASE.public_id)
+        response = self.assert200(self.complete_view, public_id=self.PURCHASE.public_id)
         self.assertEqual(response.context_data["survey"], self.SURVEY)
 
 
+@skipUnless(hasattr(QuerySet, "aget"), "The async ORM requires Django 4.1 or newer")
+class AsyncSurveyResponseCreateTestCase(SurveyResponseCreateTestCase):
+    """
+    Run the respondent view tests against the async views.
+    """
+    view = AsyncSurveyResponseCreate
+    complete_view = AsyncSurveyResponseComplete
+
+    def execute(self, method, cls_or_func, *args, **kwargs):
+        response = super(AsyncSurveyResponseCreateTestCase, self).execute(
+            method, cls_or_func, *args, **kwargs)
+        if iscoroutine(response):
+            async def get_response():
+                return await response
+            response = async_to_sync(get_response)()
+        return response
+
+    def test_not_found(self):
+        self.assert404(self.view, public_id=str(uuid4()))
+        self.assert404(self.complete_view, public_id=str(uuid4()))
+
+
+class SurveyResponsePagedCreateTestCase(SurveyPageTestCase):
+    view = SurveyResponsePagedCreate
+
+    @classmethod
+    def setUpTestData(cls):
+        super(SurveyResponsePagedCreateTestCase, cls).setUpTestData()
+        cls.PURCHASE = get(
+            SurveyPurchase, survey=cls.SURVEY, purchaser=cls.USER, purchased_with_code=None,
+            report_generated=None)
+        cls.PURCHASE_ID = str(cls.PURCHASE.public_id)
+        cls.FIRST = get(Subcategory, category=get(Category, survey=cls.SURVEY, title="First"))
+        cls.SECOND = get(Subcategory, category=get(Category, survey=cls.SURVEY, title="Second"))
+        cls.RATING_1 = get(Question, subcategory=cls.FIRST, field_type=Question.RATING_FIELD)
+        cls.RATING_2 = get(Question, subcategory=cls.SECOND, field_type=Question.RATING_FIELD)
+        cls.TEXT_2 = get(Question, subcategory=cls.SECOND, field_type=Question.TEXT_FIELD)
+
+    def post_step(self, step, data):
+        """
+        Post a step, which is part of the query string of the form's action.
+        """
+        request = RequestFactory().post("/custom-request/?step=%s" % step, data)
+        request.user = AnonymousUser()
+        self.middleware.process_request(request)
+        request.session.save()
+        return self.view.as_view()(request, public_id=self.PURCHASE_ID)
+
+    def test_steps(self):
+        # The first step only has the questions of the first category
+        response = self.assert200(self.view, public_id=self.PURCHASE_ID)
+        form = response.context_data["form"]
+        token = form.initial["submission_token"]
+        self.assertEqual(set(form.fields), {"question_%s" % self.RATING_1.pk, "submission_token"})
+        self.assertEqual(response.context_data["step_title"], "First")
+
+        # Answers are kept in a draft until the last step
+        response = self.post_step(0, {
+            "question_%s" % self.RATING_1.pk: 2, "submission_token": token})
+        draft = SurveyResponseDraft.objects.get(submission_token=token)
+        self.assertEqual(response["location"], "%s?draft=%s&step=1" % (
+            self.PURCHASE.get_response_create_url(), token))
+        self.assertEqual(draft.get_answers(), {str(self.RATING_1.pk): "2"})
+        self.assertFalse(SurveyResponse.objects.exists())
+
+        # Drafts are loaded back in the form of every step
+        response = self.assert200(
+            self.view, public_id=self.PURCHASE_ID, data={"draft": token, "step": 1})
+        form = response.context_data["form"]
+        self.assertEqual(set(form.fields), {
+            "question_%s" % self.RATING_2.pk, "question_%s" % self.TEXT_2.pk,
+            "submission_token"})
+        self.assertEqual(form.initial["submission_token"], token)
+        self.assertTrue(response.context_data["is_last_step"])
+        self.assertIn("step=0", response.context_data["previous_step_url"])
+        response = self.assert200(
+            self.view, public_id=self.PURCHASE_ID, data={"draft": token, "step": 0})
+        initial = response.context_data["form"].initial
+        self.assertEqual(initial["question_%s" % self.RATING_1.pk], "2")
+
+        # Invalid steps don't lose the draft
+        data = {"question_%s" % self.TEXT_2.pk: "Text", "submission_token": token}
+        response = self.post_step(1, data)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(SurveyResponseDraft.objects.filter(submission_token=token).exists())
+
+        # The last step saves the complete response and removes the draft
+        data["question_%s" % self.RATING_2.pk] = 3
+        response = self.post_step(1, data)
+        self.assertEqual(response["location"], self.PURCHASE.get_complete_url())
+        survey_response = SurveyResponse.objects.get(submission_token=token)
+        self.assertEqual(
+            set(survey_response.responses.values_list("question", "rating", "text_response")), {
+                (self.RATING_1.pk, 2, ""), (self.RATING_2.pk, 3, ""),
+                (self.TEXT_2.pk, None, "Text")})
+        self.assertFalse(SurveyResponseDraft.objects.exists())
+
+    def test_changed_survey(self):
+        """
+        Questions added while a draft is in progress send the respondent back to their step.
+        """
+        token = uuid4()
+        self.post_step(0, {"question_%s" % self.RATING_1.pk: 2, "submission_token": token})
+        question = get(Question, subcategory=self.FIRST, field_type=Question.RATING_FIELD)
+        response = self.post_step(1, {
+            "question_%s" % self.RATING_2.pk: 3, "question_%s" % self.TEXT_2.pk: "Text",
+            "submission_token": token})
+        self.assertEqual(response["location"], "%s?draft=%s&step=0" % (
+            self.PURCHASE.get_response_create_url(), token))
+        self.assertFalse(SurveyResponse.objects.exists())
+
+        response = self.post_step(0, {
+            "question_%s" % self.RATING_1.pk: 2, "question_%s" % question.pk: 1,
+            "submission_token": token})
+        self.assertIn("step=1", response["location"])
+        response = self.post_step(1, {
+            "question_%s" % self.RATING_2.pk: 3, "question_%s" % self.TEXT_2.pk: "Text",
+            "submission_token": token})
+        self.assertEqual(SurveyResponse.objects.get().responses.count(), 4)
+
+    def test_purge_drafts(self):
+        """
+        Drafts of abandoned surveys are deleted once they're old enough.
+        """
+        for i in range(0, 3):
+            get(SurveyResponseDraft, purchase=self.PURCHASE, submission_token=uuid4())
+        recent = get(SurveyResponseDraft, purchase=self.PURCHASE, submission_token=uuid4())
+        SurveyResponseDraft.objects.exclude(pk=recent.pk) \
+            .update(updated=now() - timedelta(days=8))
+
+        stdout = StringIO()
+        call_command("purge_response_drafts", batch_size=2, stdout=stdout)
+        self.assertIn("Deleted 3 draft(s)", stdout.getvalue())
+        self.assertEqual(list(SurveyResponseDraft.objects.all()), [recent])
+
+        call_command("purge_response_drafts", days=0, stdout=stdout)
+        self.assertFalse(SurveyResponseDraft.objects.exists())
+
+
+class SurveyPurchaseIngestTestCase(SurveyPageTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super(SurveyPurchaseIngestTestCase, cls).setUpTestData()
+        cls.PURCHASE = get(
+            SurveyPurchase, survey=cls.SURVEY, purchaser=cls.USER, purchased_with_code=None,
+            report_generated=None)
+        cls.PURCHASE_ID = str(cls.PURCHASE.public_id)
+        subcategory = get(Subcategory, category=get(Category, survey=cls.SURVEY))
+        cls.RATING = get(Question, subcategory=subcategory, field_type=Question.RATING_FIELD)
+        cls.INVERTED = get(
+            Question, subcategory=subcategory, field_type=Question.RATING_FIELD,
+            invert_rating=True)
+        cls.TEXT = get(Question, subcategory=subcategory, field_type=Question.TEXT_FIELD)
+
+    def upload(self, responses, user=None):
+        request = RequestFactory().post(
+            "/custom-request/", json.dumps({"responses": responses}),
+            content_type="application/json")
+        request.user = user or self.USER
+        request._dont_enforce_csrf_checks = True  # Like the test client
+        return SurveyPurchaseIngest.as_view()(request, public_id=self.PURCHASE_ID)
+
+    def get_answers(self, rating=1, inverted=1, text="Text"):
+        return {self.RATING.pk: rating, self.INVERTED.pk: inverted, self.TEXT.pk: text}
+
+    def test_access(self):
+        # Only the purchaser can upload responses
+        with self.assertRaises(PermissionDenied):
+            self.upload([], user=AnonymousUser())
+        with self.assertRaises(PermissionDenied):
+            self.upload([], user=get(User, is_active=True))
+
+        # Malformed uploads are rejected as a whole
+        request = RequestFactory().post(
+            "/custom-request/", "not json", content_type="application/json")
+        request.user = self.USER
+        request._dont_enforce_csrf_checks = True
+        response = SurveyPurchaseIngest.as_view()(request, public_id=self.PURCHASE_ID)
+        self.assertEqual(response.status_code, 400)
+        with override_settings(SURVEYS_INGEST_MAX_RESPONSES=1):
+            self.assertEqual(self.upload([{}, {}]).status_code, 400)
+
+        # Closed purchases don't accept responses
+        SurveyPurchase.objects.filter(pk=self.PURCHASE.pk).update(report_generated=now())
+        response = self.upload([{"answers": self.get_answers()}])
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(self.PURCHASE.responses.exists())
+
+    def test_token(self):
+        """
+        Machine clients upload with the ingest token and without a session or CSRF token.
+        """
+        client = Client(enforce_csrf_checks=True)
+        data = json.dumps({"responses": [{"answers": self.get_answers()}]})
+        upload = lambda **extra: client.post(
+            self.PURCHASE.get_ingest_url(), data, content_type="application/json", **extra)
+
+        # Purchases without a token don't accept any
+        self.assertEqual(upload(HTTP_AUTHORIZATION="Token ").status_code, 403)
+        token = SurveyPurchase.generate_ingest_token()
+        SurveyPurchase.objects.filter(pk=self.PURCHASE.pk).update(ingest_token=token)
+        self.assertEqual(upload(HTTP_AUTHORIZATION="Token invalid").status_code, 403)
+        self.assertFalse(self.PURCHASE.responses.exists())
+
+        response = upload(HTTP_AUTHORIZATION="Token %s" % token)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.PURCHASE.responses.count(), 1)
+
+        # The purchaser's session still needs the CSRF token
+        client.force_login(self.USER)
+        self.assertEqual(upload().status_code, 403)
+        request = RequestFactory().get("/")
+        csrf_token = get_token(request)
+        client.cookies[django_settings.CSRF_COOKIE_NAME] = request.META["CSRF_COOKIE"]
+        response = upload(HTTP_X_CSRFTOKEN=csrf_token)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.PURCHASE.responses.count(), 2)
+
+    def test_ingest(self):
+        response = self.upload([
+            {"answers": self.get_answers(rating=4, inverted=4)},
+            {"answers": self.get_answers(rating=5)},  # Above max_rating
+            {"answers": self.get_answers(inverted=2), "created": "2020-01-02T03:04:05Z"},
+            {"answers": dict(self.get_answers(), **{"0": 1})},  # Unknown question
+            {"answers": self.get_answers(), "created": "yesterday"},
+            "not a response",
+        ])
+        self.assertEqual(response.status_code, 201)
+        data = json.loads(response.content.decode("utf-8"))
+        self.assertEqual(data["created"], 2)
+        self.assertEqual([error["index"] for error in data["errors"]], [1, 3, 4, 5])
+        self.assertIn("question_%s" % self.RATING.pk, data["errors"][0]["errors"])
+        self.assertIn("created", data["errors"][2]["errors"])
+
+        # Responses are stored with normalized ratings and the uploaded dates
+        survey_responses = SurveyResponse.objects.filter(purchase=self.PURCHASE).order_by("pk")
+        self.assertEqual(survey_responses[1].created.year, 2020)
+        self.assertEqual(
+            list(QuestionResponse.objects.filter(question=self.INVERTED).values_list(
+                "rating", flat=True).order_by("pk")), [1, 3])
+        counters = RatingCounter.objects.filter(purchase=self.PURCHASE).get_histogram()
+        self.assertDictEqual(dict(counters), {
+            self.RATING.pk: {4: 1, 1: 1},
+            self.INVERTED.pk: {1: 1, 3: 1},
+        })
+
+        # Uploads without any valid responses fail
+        response = self.upload([{"answers": {}}])
+        self.assertEqual(response.status_code, 400)
+
+    @skipUnless(connection.features.can_return_rows_from_bulk_insert,
+                "SurveyResponses are inserted one by one without bulk insert RETURNING")
+    def test_ingest_queries(self):
+        """
+        The number of queries doesn't depend on the number of responses in the upload.
+        """
+        with CaptureQueriesContext(connection) as context:
+            self.upload([{"answers": self.get_answers()}] * 2)
+        num_queries = len(context)
+
+        # Small enough for SQLite to insert every table in a single query
+        self.PURCHASE.rating_counters.all().delete()
+        with self.assertNumQueries(num_queries):
+            response = self.upload([{"answers": self.get_answers()}] * 50)
+        self.assertEqual(json.loads(response.content.decode("utf-8"))["created"], 50)
+        self.assertEqual(self.PURCHASE.responses.count(), 52)
+
+
 class SurveyPurchaseReportTestCase(SurveyPageTestCase):
 
     def setUp(self):
@@ -250,7 +669,7 @@ class SurveyPurchaseReportTestCase(SurveyPageTestCase):
         super(SurveyPurchaseReportTestCase, self).setUp()
         self.purchase = get(
             SurveyPurchase, survey=self.SURVEY, purchaser=self.USER, purchased_with_code=None,
-            report_generated=None)
+            report_generated=None, report_status="")
         self.purchase_id = str(self.purchase.public_id)
 
         # Create 6 rating questions and 2 text questions
@@ -296,6 +715,9 @@ class SurveyPurchaseReportTestCase(SurveyPageTestCase):
                 question__subcategory__category__survey=self.SURVEY,
                 response__purchase__survey=self.SURVEY)
 
+        # Responses were created directly, update the rating counters read by the report
+        RatingCounter.objects.rebuild(self.purchase)
+
     def test_access(self):
         # Anon users cannot access the report
         self.assertLoginRequired(SurveyPurchaseReport, public_id=self.purchase_id)
@@ -305,6 +727,7 @@ class SurveyPurchaseReportTestCase(SurveyPageTestCase):
 
         # The report should be empty
         self.assertEqual(response.context_data["purchase"].get_report_as_json(), [])
+        self.assertWithinQueryBudget(response)
 
     def test_report(self):
         """
@@ -314,6 +737,7 @@ class SurveyPurchaseReportTestCase(SurveyPageTestCase):
         # POST the form to generate the report
         response = self.post(SurveyPurchaseReport, public_id=self.purchase_id, user=self.USER)
         self.assertEqual(response["location"], self.purchase.get_report_url())
+        self.assertWithinQueryBudget(response)
 
         # GET the page and verify all the report data
         # The report data is based on the QuestionResponses added in setUp()
@@ -402,3 +826,286 @@ class SurveyPurchaseReportTestCase(SurveyPageTestCase):
         # Question 8
         q8 = report["text_questions"][1]
         self.assertListEqual(q8["responses"], ["Text 2", "Text 4", "Text 6"])
+
+    def test_report_fragment_cache(self):
+        """
+        The rendered results should be cached until a new report is generated.
+        """
+        self.purchase.generate_report()
+        response = self.assert200(SurveyPurchaseReport, public_id=self.purchase_id, user=self.USER)
+        context = response.context_data
+        self.assertTrue(context["report_fragment_timeout"])
+
+        render = lambda: render_to_string("surveys/includes/report_results.html", context)
+        with patch.object(SurveyPurchase, "get_report_as_json", autospec=True,
+                          side_effect=SurveyPurchase.get_report_as_json) as get_report:
+            html = render()
+            self.assertIn("results-table", html)
+            self.assertEqual(render(), html)
+            self.assertEqual(get_report.call_count, 1)
+
+            # A new report version is rendered again
+            context["purchase"].generate_report()
+            render()
+            self.assertEqual(get_report.call_count, 2)
+
+    def test_export(self):
+        """
+        All responses of the purchase should be streamed in the requested format.
+        """
+        self.assertLoginRequired(SurveyPurchaseExport, public_id=self.purchase_id, format="csv")
+
+        response = self.get(
+            SurveyPurchaseExport, public_id=self.purchase_id, format="csv", user=self.USER)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["content-type"], "text/csv")
+        rows = list(csv.DictReader(line.decode() for line in response.streaming_content))
+        self.assertEqual(len(rows), 24)
+        ratings = [r["rating"] for r in rows[:8]]
+        self.assertListEqual(ratings, ["1", "2", "3", "4", "1", "4", "", ""])
+        self.assertListEqual([r["text_response"] for r in rows[6:8]], ["Text 1", "Text 2"])
+
+        response = self.get(
+            SurveyPurchaseExport, public_id=self.purchase_id, format="ndjson", user=self.USER)
+        self.assertEqual(response["content-type"], "application/x-ndjson")
+        rows = [json.loads(line) for line in response.streaming_content]
+        self.assertEqual(len(rows), 24)
+        self.assertEqual(rows[23]["text_response"], "Text 6")
+        self.assertIsNone(rows[23]["rating"])
+
+    def test_archive(self):
+        """
+        Archived responses should be read transparently by reports, exports and counters.
+        """
+        export = lambda: list(self.get(
+            SurveyPurchaseExport, public_id=self.purchase_id, format="csv",
+            user=self.USER).streaming_content)
+        report = self.purchase.generate_report()
+        rows = export()
+        category = Category.objects.filter(survey=self.SURVEY).first()
+        rating_data = category.get_rating_data(self.purchase)
+
+        out = StringIO()
+        call_command("archive_responses", stdout=out)
+        self.assertIn("Archived 24 response(s)", out.getvalue())
+        self.assertFalse(QuestionResponse.objects.filter(purchase=self.purchase).exists())
+        segment = self.purchase.response_archives.get()
+        self.assertEqual(segment.count, 24)
+        self.assertEqual(export(), rows)
+        self.assertEqual(self.purchase.generate_report(), report)
+        self.assertIsNotNone(rating_data)
+        self.assertEqual(category.get_rating_data(self.purchase), rating_data)
+        counters = set(RatingCounter.objects.values_list("question", "rating", "count"))
+        RatingCounter.objects.rebuild(self.purchase)
+        self.assertEqual(
+            set(RatingCounter.objects.values_list("question", "rating", "count")), counters)
+
+        # Responses added later are appended to the archive
+        survey_response = get(SurveyResponse, purchase=self.purchase)
+        question = self.SURVEY.get_questions().filter(field_type=Question.TEXT_FIELD).first()
+        get(QuestionResponse, response=survey_response, question=question, text_response="New")
+        self.assertEqual(archive_purchase(self.purchase), 1)
+        self.assertEqual(len(export()), len(rows) + 1)
+        self.assertEqual(self.purchase.response_archives.count(), 2)
+        self.assertEqual(  # Archived segments aren't rewritten
+            bytes(self.purchase.response_archives.get(pk=segment.pk).data), bytes(segment.data))
+        text_questions = self.purchase.generate_report()["text_questions"]
+        self.assertEqual(text_questions[0]["responses"][-1], "New")
+
+        # Responses to deleted questions are skipped
+        question.delete()
+        self.assertEqual(len(export()), len(rows) - 3)
+
+    @override_settings(SURVEYS_REPORT_ASYNC=True, SURVEYS_REPORT_WORKERS=0)
+    def test_report_async(self):
+        """
+        The report should be enqueued when POSTing and its status should be available via GET.
+        """
+        get_status = lambda: json.loads(self.assert200(
+            SurveyPurchaseReportStatus, public_id=self.purchase_id, user=self.USER).content)
+        self.assertLoginRequired(SurveyPurchaseReportStatus, public_id=self.purchase_id)
+        self.assertEqual(get_status(), {"status": None, "report_generated": None})
+
+        # The job should only run once the request's transaction has been committed
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            response = self.post(SurveyPurchaseReport, public_id=self.purchase_id, user=self.USER)
+            self.assertEqual(response["location"], self.purchase.get_report_url())
+            self.assertEqual(get_status()["status"], SurveyPurchase.REPORT_PENDING)
+
+            # Enqueuing again while the job is pending does nothing
+            self.post(SurveyPurchaseReport, public_id=self.purchase_id, user=self.USER)
+        self.assertEqual(len(callbacks), 1)
+
+        status = get_status()
+        self.assertEqual(status["status"], SurveyPurchase.REPORT_DONE)
+        self.assertIsNotNone(status["report_generated"])
+        self.purchase.refresh_from_db()
+        self.assertEqual(self.purchase.get_report_as_json()["rating"]["count"], 18)
+
+    @override_settings(SURVEYS_REPORT_ASYNC=True, SURVEYS_REPORT_WORKERS=0)
+    def test_report_async_failed(self):
+        with patch.object(SurveyPurchase, "generate_report", side_effect=ValueError):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.post(SurveyPurchaseReport, public_id=self.purchase_id, user=self.USER)
+        self.purchase.refresh_from_db()
+        self.assertEqual(self.purchase.report_status, SurveyPurchase.REPORT_FAILED)
+        self.assertIsNone(self.purchase.report_generated)
+
+    @override_settings(SURVEYS_REPORT_ASYNC=True, SURVEYS_REPORT_WORKERS=0,
+                       SURVEYS_REPORT_TIMEOUT=60)
+    def test_report_async_lost_worker(self):
+        # A job that's running is not enqueued twice
+        SurveyPurchase.objects.filter(pk=self.purchase.pk).update(
+            report_status=SurveyPurchase.REPORT_RUNNING, report_started=now())
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.post(SurveyPurchaseReport, public_id=self.purchase_id, user=self.USER)
+        self.assertEqual(callbacks, [])
+        self.purchase.refresh_from_db()
+        self.assertTrue(self.purchase.get_report_in_progress())
+
+        # The worker was lost, the job is shown as failed and enqueued again
+        SurveyPurchase.objects.filter(pk=self.purchase.pk).update(
+            report_started=now() - timedelta(seconds=61))
+        self.purchase.refresh_from_db()
+        self.assertFalse(self.purchase.get_report_in_progress())
+        response = self.assert200(
+            SurveyPurchaseReportStatus, public_id=self.purchase_id, user=self.USER)
+        self.assertEqual(json.loads(response.content)["status"], SurveyPurchase.REPORT_FAILED)
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.post(SurveyPurchaseReport, public_id=self.purchase_id, user=self.USER)
+        self.assertEqual(len(callbacks), 1)
+        self.purchase.refresh_from_db()
+        self.assertEqual(self.purchase.report_status, SurveyPurchase.REPORT_DONE)
+        self.assertIsNotNone(self.purchase.report_generated)
+
+    def test_report_queries(self):
+        """
+        The number of queries to generate a report doesn't depend on the size of the survey.
+        """
+        with CaptureQueriesContext(connection) as context:
+            self.purchase.generate_report()
+        num_queries = len(context)
+
+        # Add another category with more rating and text responses
+        subcategory = get(Subcategory, category__survey=self.SURVEY)
+        survey_response = get(SurveyResponse, purchase=self.purchase)
+        for i in range(0, 5):
+            rating_question = get(
+                Question, subcategory=subcategory, field_type=Question.RATING_FIELD)
+            text_question = get(Question, subcategory=subcategory, field_type=Question.TEXT_FIELD)
+            get(QuestionResponse, response=survey_response, question=rating_question, rating=1)
+            get(QuestionResponse, response=survey_response, question=text_question, rating=None)
+        RatingCounter.objects.rebuild(self.purchase)
+
+        with self.assertNumQueries(num_queries):
+            report = self.purchase.generate_report()
+        self.assertEqual(report["rating"]["count"], 23)
+        self.assertEqual(len(report["categories"]), 3)
+        self.assertEqual(len(report["text_questions"]), 7)
+
+    def test_response_budget(self):
+        """
+        Submitting a response takes the same number of queries regardless of the survey size.
+        """
+        data = {"question_%s" % question.pk: 1 for question in self.SURVEY.get_questions()}
+        response = self.post(SurveyResponseCreate, public_id=self.purchase_id, data=data)
+        num_queries = self.assertWithinQueryBudget(response).queries
+
+        subcategory = get(Subcategory, category__survey=self.SURVEY)
+        for i in range(0, 10):
+            question = get(Question, subcategory=subcategory, field_type=Question.RATING_FIELD)
+            data["question_%s" % question.pk] = 2
+        response = self.post(SurveyResponseCreate, public_id=self.purchase_id, data=data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.assertWithinQueryBudget(response).queries, num_queries)
+
+    def test_metrics(self):
+        """
+        View metrics are logged and added to the response headers when debugging.
+        """
+        with self.assertLogs("surveys.metrics", "INFO") as logs:
+            response = self.post(SurveyPurchaseReport, public_id=self.purchase_id, user=self.USER)
+        metrics = logs.records[0].surveys_metrics
+        self.assertEqual(metrics["view"], "SurveyPurchaseReport")
+        self.assertEqual(metrics["queries"], response.surveys_metrics.queries)
+        self.assertGreater(metrics["db_time"], 0)
+        self.assertNotIn("X-Surveys-Queries", response)
+
+        with override_settings(DEBUG=True):
+            response = self.post(SurveyPurchaseReport, public_id=self.purchase_id, user=self.USER)
+        self.assertEqual(response["X-Surveys-Queries"], str(response.surveys_metrics.queries))
+        self.assertEqual(
+            response["X-Surveys-Query-Budget"], str(SurveyPurchaseReport.query_budget))
+
+        # Requests over budget are logged as warnings
+        with patch.object(SurveyPurchaseReport, "query_budget", 1):
+            with self.assertLogs("surveys.metrics", "WARNING"):
+                response = self.post(
+                    SurveyPurchaseReport, public_id=self.purchase_id, user=self.USER)
+            with self.assertRaises(AssertionError):
+                self.assertWithinQueryBudget(response)
+
+
+@skipUnless("replica" in django_settings.DATABASES, "Needs a second database as the replica")
+@override_settings(SURVEYS_READ_REPLICA="replica")
+class ReplicaRoutingTestCase(SurveyPageTestCase):
+    """
+    The replica is an empty database, so reads sent to it don't find the test data.
+    """
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        super(ReplicaRoutingTestCase, self).setUp()
+        self.purchase = get(
+            SurveyPurchase, survey=self.SURVEY, purchaser=self.USER, report_generated=None,
+            report_status="")
+        self.purchase_id = str(self.purchase.public_id)
+
+    def test_router(self):
+        self.assertEqual(SurveyPurchase.objects.all().db, "default")
+        with use_replica():
+            self.assertEqual(SurveyPurchase.objects.all().db, "replica")
+            self.assertEqual(User.objects.all().db, "default")
+            self.assertEqual(SurveyPurchase.objects.db_manager().get_queryset().db, "replica")
+            with use_primary():
+                self.assertTrue(SurveyPurchase.objects.filter(pk=self.purchase.pk).exists())
+            self.assertFalse(SurveyPurchase.objects.filter(pk=self.purchase.pk).exists())
+
+            # Writes go to the primary
+            self.purchase.notes = "Changed"
+            self.purchase.save()
+        self.purchase.refresh_from_db()
+        self.assertEqual(self.purchase.notes, "Changed")
+
+        with override_settings(SURVEYS_READ_REPLICA=""), use_replica():
+            self.assertEqual(SurveyPurchase.objects.all().db, "default")
+
+    def test_metrics(self):
+        """
+        Queries sent to the replica count towards the query budget of views.
+        """
+        metrics = RequestMetrics("SurveyPurchaseReport")
+        with execute_wrapper(metrics), use_replica():
+            self.assertFalse(SurveyPurchase.objects.exists())
+        with execute_wrapper(metrics):
+            self.assertTrue(SurveyPurchase.objects.exists())
+        self.assertEqual(metrics.queries, 2)
+
+    def test_report(self):
+        self.assert404(SurveyPurchaseReport, public_id=self.purchase_id, user=self.USER)
+        self.assert404(SurveyPurchaseReportStatus, public_id=self.purchase_id, user=self.USER)
+
+        # Clients that just wrote to the primary read from it
+        response = self.post(SurveyPurchaseReport, public_id=self.purchase_id, user=self.USER)
+        self.assertEqual(response.status_code, 302)
+        self.assertIn(PIN_COOKIE, response.cookies)
+        self.purchase.refresh_from_db()
+        self.assertIsNotNone(self.purchase.report_generated)
+
+        request = RequestFactory().get("/")
+        request.user = self.USER
+        request.COOKIES[PIN_COOKIE] = response.cookies[PIN_COOKIE].value
+        response = SurveyPurchaseReport.as_view()(request, public_id=self.purchase_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context_data["purchase"], self.purchase)
@@ -9,7 +9,8 @@ from mezzanine.core.translation import (
 
 from .models import (
     SurveyPage, SurveyPurchase, SurveyPurchaseCode, Category, Question, SurveyResponse,
-    QuestionResponse, Subcategory,
+    QuestionResponse, Subcategory, RatingCounter, BenchmarkCounter, ResponseBufferCheckpoint,
+    PurchaseCodeShard, SurveyResponseDraft, ResponseArchive,
 )
 
 
@@ -28,6 +29,11 @@ class SurveyPurchaseCodeTranslationOptions(TranslationOptions):
     fields = ()
 
 
+@register(PurchaseCodeShard)
+class PurchaseCodeShardTranslationOptions(TranslationOptions):
+    fields = ()
+
+
 @register(Category)
 class CategoryTranslationOptions(TranslationOptions):
     fields = ("description",)
@@ -43,6 +49,16 @@ class SurveyResponseTranslationOptions(TranslationOptions):
     fields = ()
 
 
+@register(SurveyResponseDraft)
+class SurveyResponseDraftTranslationOptions(TranslationOptions):
+    fields = ()
+
+
+@register(ResponseArchive)
+class ResponseArchiveTranslationOptions(TranslationOptions):
+    fields = ()
+
+
 @register(QuestionResponse)
 class QuestionResponseTranslationOptions(TranslationOptions):
     fields = ("text_response",)
@@ -52,3 +68,17 @@ class QuestionResponseTranslationOptions(TranslationOptions):
 class SubcategoryTranslationOptions(TranslationOptions):
     fields = ("description",)
 
+
+@register(RatingCounter)
+class RatingCounterTranslationOptions(TranslationOptions):
+    fields = ()
+
+
+@register(BenchmarkCounter)
+class BenchmarkCounterTranslationOptions(TranslationOptions):
+    fields = ()
+
+
+@register(ResponseBufferCheckpoint)
+class ResponseBufferCheckpointTranslationOptions(TranslationOptions):
+    fields = ()
@@ -0,0 +1,68 @@
+from __future__ import absolute_import, unicode_literals
+
+from collections import namedtuple
+
+# Immutable nodes of a survey tree, so loaded trees can be shared between requests
+
+
+class QuestionNode(namedtuple("QuestionNode", [
+        "id", "prompt", "field_type", "required", "invert_rating"])):
+    __slots__ = ()
+
+
+class SubcategoryNode(namedtuple("SubcategoryNode", [
+        "id", "title", "description", "questions"])):
+    __slots__ = ()
+
+
+class CategoryNode(namedtuple("CategoryNode", [
+        "id", "title", "description", "subcategories"])):
+    __slots__ = ()
+
+
+class SurveyTree(namedtuple("SurveyTree", ["survey_id", "categories"])):
+    """
+    Categories, subcategories and questions of a survey in the order set in the admin.
+    """
+    __slots__ = ()
+
+    def iter_questions(self):
+        """
+        Iterate over the questions as (category, subcategory, question) tuples.
+        """
+        for category in self.categories:
+            for subcategory in category.subcategories:
+                for question in subcategory.questions:
+                    yield category, subcategory, question
+
+
+def load_survey_tree(survey):
+    """
+    Load the tree of `survey` in one query, joining the questions to their subcategory
+    and category. Categories and subcategories without questions aren't included.
+    """
+    from .models import Question
+    questions = Question.objects.filter(survey=survey) \
+        .select_related("subcategory__category") \
+        .order_by("subcategory__category___order", "subcategory__category_id",
+                  "subcategory___order", "subcategory_id", "_order", "pk")
+
+    categories = []
+    for question in questions:
+        subcategory = question.subcategory
+        category = subcategory.category
+        if not categories or categories[-1][0].pk != category.pk:
+            categories.append((category, []))
+        subcategories = categories[-1][1]
+        if not subcategories or subcategories[-1][0].pk != subcategory.pk:
+            subcategories.append((subcategory, []))
+        subcategories[-1][1].append(QuestionNode(
+            question.pk, question.prompt, question.field_type, question.required,
+            question.invert_rating))
+
+    return SurveyTree(survey.pk, tuple(
+        CategoryNode(category.pk, category.title, category.description, tuple(
+            SubcategoryNode(subcategory.pk, subcategory.title, subcategory.description,
+                            tuple(question_nodes))
+            for subcategory, question_nodes in subcategories))
+        for category, subcategories in categories))
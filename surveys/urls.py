@@ -12,6 +12,8 @@ UUID_RE = "[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
 
 purchase_create_view = import_view(settings.SURVEYS_PURCHASE_CREATE_VIEW)
 purchase_report_view = import_view(settings.SURVEYS_PURCHASE_REPORT_VIEW)
+response_create_view = import_view(settings.SURVEYS_RESPONSE_CREATE_VIEW)
+response_complete_view = import_view(settings.SURVEYS_RESPONSE_COMPLETE_VIEW)
 
 urlpatterns = [
     re_path("^purchase/(?P<slug>.*)/$",
@@ -19,9 +21,15 @@ urlpatterns = [
     re_path("^manage/(?P<public_id>%s)/$" % UUID_RE,
             views.SurveyPurchaseDetail.as_view(), name="purchase_detail"),
     re_path("^take/(?P<public_id>%s)/$" % UUID_RE,
-            views.SurveyResponseCreate.as_view(), name="response_create"),
+            response_create_view, name="response_create"),
     re_path("^take/(?P<public_id>%s)/complete/$" % UUID_RE,
-            views.SurveyResponseComplete.as_view(), name="response_complete"),
+            response_complete_view, name="response_complete"),
     re_path("^report/(?P<public_id>%s)/$" % UUID_RE,
             purchase_report_view, name="purchase_report"),
+    re_path("^report/(?P<public_id>%s)/status/$" % UUID_RE,
+            views.SurveyPurchaseReportStatus.as_view(), name="purchase_report_status"),
+    re_path("^export/(?P<public_id>%s)/(?P<format>csv|ndjson)/$" % UUID_RE,
+            views.SurveyPurchaseExport.as_view(), name="purchase_export"),
+    re_path("^ingest/(?P<public_id>%s)/$" % UUID_RE,
+            views.SurveyPurchaseIngest.as_view(), name="purchase_ingest"),
 ]
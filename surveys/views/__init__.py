@@ -2,4 +2,6 @@
 
 from .surveys import (
     SurveyPurchaseCreate, SurveyPurchaseDetail, SurveyResponseCreate, SurveyResponseComplete,
-    SurveyPurchaseReport)
+    SurveyPurchaseReport, SurveyPurchaseReportStatus, SurveyPurchaseExport,
+    SurveyPurchaseIngest, AsyncSurveyResponseCreate, AsyncSurveyResponseComplete,
+    SurveyResponsePagedCreate)
@@ -1,44 +1,93 @@
 from __future__ import absolute_import, unicode_literals
 
+import json
+import uuid
+
+from asgiref.sync import sync_to_async
+
 from django.contrib import messages
 from django.core.exceptions import ValidationError
-from django.db import IntegrityError
-from django.db.models import F
+from django.db import IntegrityError, transaction
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.middleware.csrf import CsrfViewMiddleware
 from django.shortcuts import get_object_or_404, redirect
-from django.utils.functional import cached_property
+from django.utils.crypto import constant_time_compare
+from django.utils.decorators import method_decorator
+from django.utils.functional import SimpleLazyObject, cached_property
+from django.utils.http import urlencode
 from django.utils.translation import gettext_lazy as _
 from django.views import generic
+from django.views.decorators.csrf import csrf_exempt
+
+from mezzanine.conf import settings
 
 from mezzy.utils.views import FormMessagesMixin, LoginRequiredMixin, UserPassesTestMixin
 
+from ..buffer import get_response_buffer
+from ..codes import add_failed_attempt, get_code_filter, invalidate_code_filter, is_attempt_limited
+from ..exports import EXPORT_FORMATS, iter_responses
 from ..forms.surveys import SurveyPurchaseForm, SurveyResponseForm
-from ..models import SurveyPage, SurveyPurchase, SurveyPurchaseCode
+from ..ingest import get_form_data, ingest_responses
+from ..instrumentation import QueryBudgetMixin
+from ..jobs import enqueue_report
+from ..models import SurveyPage, SurveyPurchase, SurveyPurchaseCode, SurveyResponseDraft
+from ..routers import ReplicaReadMixin
+from ..schema import get_form_schema
 
 
 class SurveyPurchaseMixin(object):
     """
     Generic view to get SurveyPurchase intstances by public ID.
     """
+    def get_purchase_queryset(self):
+        # The report is only loaded if it's not already parsed in the cache. The survey tree
+        # is read from the cached form schema (see `survey_tree`).
+        return SurveyPurchase.objects.defer("report_cache").select_related("survey")
+
     @cached_property
     def purchase(self):
-        qs = SurveyPurchase.objects.all() \
-            .select_related("survey") \
-            .prefetch_related("survey__categories__subcategories__questions")
-        return get_object_or_404(qs, public_id=self.kwargs["public_id"])
+        return get_object_or_404(self.get_purchase_queryset(), public_id=self.kwargs["public_id"])
+
+    @cached_property
+    def form_schema(self):
+        return get_form_schema(self.purchase.survey)
+
+    @cached_property
+    def survey_tree(self):
+        return self.form_schema.tree
 
     def get_context_data(self, **kwargs):
         kwargs.update({
             "purchase": self.purchase,
             "survey": self.purchase.survey,
+            "survey_tree": SimpleLazyObject(lambda: self.survey_tree),
         })
         return super(SurveyPurchaseMixin, self).get_context_data(**kwargs)
 
 
-class SurveyPurchaseCreate(LoginRequiredMixin, FormMessagesMixin, generic.CreateView):
+class AsyncSurveyPurchaseMixin(SurveyPurchaseMixin):
+    """
+    Loads the SurveyPurchase with the async ORM, for views served under ASGI.
+    Handlers must await `aget_purchase` before using `self.purchase`.
+    """
+    async def aget_purchase(self):
+        try:
+            purchase = await self.get_purchase_queryset().aget(public_id=self.kwargs["public_id"])
+        except SurveyPurchase.DoesNotExist:
+            raise Http404("No SurveyPurchase matches the given query.")
+        self.__dict__["purchase"] = purchase  # Fill the cached properties
+        # The survey tree is loaded along with the form schema, outside of the event loop
+        self.__dict__["form_schema"] = await sync_to_async(get_form_schema)(purchase.survey)
+        return purchase
+
+
+class SurveyPurchaseCreate(
+        QueryBudgetMixin, LoginRequiredMixin, FormMessagesMixin, generic.CreateView):
     """
     Allows users to purchase surveys.
     """
     form_class = SurveyPurchaseForm
+    query_budget = 6
     template_name = "surveys/survey_purchase_create.html"
     success_message = _("You have successfully purchased this survey")
     error_message = _("There was a problem with the purchase process")
@@ -79,16 +128,23 @@ class SurveyPurchaseCreate(LoginRequiredMixin, FormMessagesMixin, generic.Create
     def process_purchase_code(self, purchase_code, form):
         """
         Process a purchase based on code entered by the user.
+        Codes that aren't in the filter of usable codes are rejected without queries,
+        and clients with too many failed attempts are turned away.
         """
+        if is_attempt_limited(self.request):
+            raise ValidationError(_("Too many invalid codes, please try again later"))
+
         try:
-            code = self.survey.purchase_codes.get(code=purchase_code, uses_remaining__gt=0)
+            if purchase_code not in get_code_filter(self.survey):
+                raise SurveyPurchaseCode.DoesNotExist
+            code = self.survey.purchase_codes.get(code=purchase_code)
         except SurveyPurchaseCode.DoesNotExist:
+            add_failed_attempt(self.request)
             raise ValidationError(_("The code you entered is not valid"))
 
-        code.uses_remaining = F("uses_remaining") - 1
-        try:
-            code.save()
-        except IntegrityError:  # Raised when uses_remaining becomes negative
+        if not code.redeem():
+            add_failed_attempt(self.request)
+            invalidate_code_filter(self.survey.pk)  # Leave the used up code out of the filter
             raise ValidationError(_("The code you entered is no longer available"))
 
         form.instance.amount = 0
@@ -105,11 +161,13 @@ class SurveyPurchaseCreate(LoginRequiredMixin, FormMessagesMixin, generic.Create
         form.instance.amount = 0
 
 
-class SurveyPurchaseDetail(UserPassesTestMixin, SurveyPurchaseMixin, generic.TemplateView):
+class SurveyPurchaseDetail(
+        QueryBudgetMixin, UserPassesTestMixin, SurveyPurchaseMixin, generic.TemplateView):
     """
     Allows users to manage a survey they've purchased.
     """
     template_name = "surveys/survey_purchase_detail.html"
+    query_budget = 6
 
     def test_func(self):
         """
@@ -121,25 +179,150 @@ class SurveyPurchaseDetail(UserPassesTestMixin, SurveyPurchaseMixin, generic.Tem
         return self.purchase.purchaser == user
 
 
-class SurveyResponseCreate(FormMessagesMixin, SurveyPurchaseMixin, generic.CreateView):
+class SurveyResponseCreate(
+        QueryBudgetMixin, FormMessagesMixin, SurveyPurchaseMixin, generic.CreateView):
     """
     Allows a user to answer a survey and submit it.
     """
     form_class = SurveyResponseForm
+    query_budget = 20
     template_name = "surveys/survey_response_create.html"
     success_message = "Thank you! Your responses have been saved successfully"
 
     def get_form_kwargs(self):
         kwargs = super(SurveyResponseCreate, self).get_form_kwargs()
         kwargs.update({
-            "purchase": self.purchase
+            "purchase": self.purchase,
+            "schema": self.form_schema,
         })
         return kwargs
 
+    def form_valid(self, form):
+        """
+        Submissions are appended to the response buffer when SURVEYS_RESPONSE_BUFFER is set.
+        """
+        buffer = get_response_buffer()
+        if buffer is None:
+            return super(SurveyResponseCreate, self).form_valid(form)
+        form.save_to_buffer(buffer)
+        messages.success(self.request, self.get_success_message(form), fail_silently=True)
+        return redirect(self.get_success_url())
+
     def get_success_url(self):
         return self.purchase.get_complete_url()
 
 
+class SurveyResponsePagedCreate(SurveyResponseCreate):
+    """
+    Allows a user to answer a survey one category at a time.
+    The answers of each step are kept in a SurveyResponseDraft identified by the submission
+    token, the complete response is validated and saved when the last step is submitted.
+    """
+
+    @cached_property
+    def steps(self):
+        return self.form_schema.steps
+
+    @cached_property
+    def step(self):
+        """
+        Current step from the query string, None if the survey doesn't have any questions.
+        """
+        if not self.steps:
+            return None
+        try:
+            step = int(self.request.GET.get("step", 0))
+        except ValueError:
+            step = 0
+        return min(max(step, 0), len(self.steps) - 1)
+
+    @cached_property
+    def draft(self):
+        token = self.request.POST.get("submission_token") or self.request.GET.get("draft")
+        try:
+            token = uuid.UUID(token)
+        except (TypeError, ValueError):
+            return None
+        return SurveyResponseDraft.objects \
+            .filter(purchase=self.purchase, submission_token=token).first()
+
+    def get_step_url(self, token, step):
+        return "%s?%s" % (
+            self.purchase.get_response_create_url(), urlencode({"draft": token, "step": step}))
+
+    def get_initial(self):
+        initial = super(SurveyResponsePagedCreate, self).get_initial()
+        if self.draft is not None:
+            initial.update(get_form_data(self.draft.get_answers()))
+            initial["submission_token"] = self.draft.submission_token
+        return initial
+
+    def get_form_kwargs(self):
+        kwargs = super(SurveyResponsePagedCreate, self).get_form_kwargs()
+        kwargs["step"] = self.step
+        return kwargs
+
+    def get_context_data(self, **kwargs):
+        if self.step is not None:
+            kwargs.update({
+                "step": self.step,
+                "steps": self.steps,
+                "step_title": self.steps[self.step][1],
+                "is_last_step": self.step == len(self.steps) - 1,
+            })
+            if self.step and self.draft is not None:
+                kwargs["previous_step_url"] = self.get_step_url(
+                    self.draft.submission_token, self.step - 1)
+        return super(SurveyResponsePagedCreate, self).get_context_data(**kwargs)
+
+    def save_draft(self, token, answers):
+        draft = self.draft or SurveyResponseDraft(purchase=self.purchase, submission_token=token)
+        draft.set_answers(answers)
+        try:
+            with transaction.atomic():
+                draft.save()
+        except IntegrityError:  # Created by a concurrent request for the same step
+            SurveyResponseDraft.objects \
+                .filter(purchase=self.purchase, submission_token=token) \
+                .update(answers=draft.answers)
+
+    def get_first_invalid_step(self, form):
+        for step in range(0, len(self.steps)):
+            if any("question_%s" % spec.question_id in form.errors
+                   for spec in form.schema.get_step_fields(step)):
+                return step
+        return 0
+
+    def form_valid(self, form):
+        """
+        Add the answers of the step to the draft and move on to the next step.
+        After the last step the whole response is validated and saved in one go.
+        """
+        if self.step is None:
+            return super(SurveyResponsePagedCreate, self).form_valid(form)
+
+        token = form.cleaned_data.get("submission_token") or uuid.uuid4()
+        answers = self.draft.get_answers() if self.draft is not None else {}
+        for spec in form.schema.get_step_fields(self.step):
+            answers[str(spec.question_id)] = form.cleaned_data["question_%s" % spec.question_id]
+        if self.step < len(self.steps) - 1:
+            self.save_draft(token, answers)
+            return redirect(self.get_step_url(token, self.step + 1))
+
+        data = get_form_data(answers)
+        data["submission_token"] = token
+        response_form = SurveyResponseForm(
+            data=data, purchase=self.purchase, schema=self.form_schema)
+        if not response_form.is_valid():
+            # Questions were added or changed since the draft was started
+            self.save_draft(token, answers)
+            return redirect(self.get_step_url(token, self.get_first_invalid_step(response_form)))
+
+        response = super(SurveyResponsePagedCreate, self).form_valid(response_form)
+        SurveyResponseDraft.objects.filter(submission_token=token).delete()
+        return response
+
+
 class SurveyResponseComplete(SurveyPurchaseMixin, generic.TemplateView):
     """
     Displays a confirmation message after the user has completed a survey.
@@ -147,14 +330,155 @@ class SurveyResponseComplete(SurveyPurchaseMixin, generic.TemplateView):
     template_name = "surveys/survey_response_complete.html"
 
 
-class SurveyPurchaseReport(SurveyPurchaseDetail):
+class AsyncSurveyResponseCreate(AsyncSurveyPurchaseMixin, SurveyResponseCreate):
+    """
+    Async version of SurveyResponseCreate.
+    The purchase is loaded with the async ORM and the survey tree in a worker thread, the form
+    is built from memory and responses are saved in a worker thread too, since transactions
+    are sync-only.
+    """
+    http_method_names = ["get", "post", "head", "options"]
+
+    async def get(self, request, *args, **kwargs):
+        await self.aget_purchase()
+        return super(AsyncSurveyResponseCreate, self).get(request, *args, **kwargs)
+
+    async def post(self, request, *args, **kwargs):
+        await self.aget_purchase()
+        self.object = None
+        form = self.get_form()
+        if form.is_valid():
+            return await sync_to_async(self.form_valid)(form)
+        return self.form_invalid(form)
+
+
+class AsyncSurveyResponseComplete(AsyncSurveyPurchaseMixin, SurveyResponseComplete):
+    """
+    Async version of SurveyResponseComplete.
+    """
+    async def get(self, request, *args, **kwargs):
+        await self.aget_purchase()
+        return super(AsyncSurveyResponseComplete, self).get(request, *args, **kwargs)
+
+
+class SurveyPurchaseReport(ReplicaReadMixin, SurveyPurchaseDetail):
     """
     Allow users to generate a report for their survey when requested via POST.
     The report is stored as JSON in the SurveyPurchase and can be retrieved via GET.
     """
     template_name = "surveys/survey_purchase_report.html"
+    query_budget = 28
+
+    def get_context_data(self, **kwargs):
+        """
+        The rendered results are cached per report version and language.
+        """
+        kwargs.update({
+            "report_fragment_timeout": settings.SURVEYS_REPORT_FRAGMENT_TIMEOUT,
+            "report_fragment_cache": settings.SURVEYS_REPORT_CACHE_BACKEND or "default",
+        })
+        return super(SurveyPurchaseReport, self).get_context_data(**kwargs)
 
     def post(self, request, *args, **kwargs):
-        self.purchase.generate_report()
-        messages.success(request, _("Report generated successfully"), fail_silently=True)
+        """
+        Generate the report right away or enqueue it when SURVEYS_REPORT_ASYNC is enabled.
+        """
+        if settings.SURVEYS_REPORT_ASYNC:
+            enqueue_report(self.purchase)
+            messages.info(request, _("Your report is being generated"), fail_silently=True)
+        else:
+            self.purchase.generate_report()
+            messages.success(request, _("Report generated successfully"), fail_silently=True)
         return redirect(self.purchase.get_report_url())
+
+
+class SurveyPurchaseReportStatus(ReplicaReadMixin, SurveyPurchaseDetail):
+    """
+    Returns the status of the report generation as JSON so it can be polled.
+    """
+
+    def get_purchase_queryset(self):
+        # Avoid loading the survey tree and the cached report on every poll
+        return SurveyPurchase.objects.defer("report_cache")
+
+    def get(self, request, *args, **kwargs):
+        report_generated = self.purchase.report_generated
+        status = self.purchase.report_status
+        if self.purchase.get_report_stale():
+            status = SurveyPurchase.REPORT_FAILED  # The worker was lost, stop polling
+        return JsonResponse({
+            "status": status or None,
+            "report_generated": report_generated.isoformat() if report_generated else None,
+        })
+
+
+class SurveyPurchaseExport(SurveyPurchaseDetail):
+    """
+    Streams all responses of a purchase as CSV or NDJSON.
+    """
+    chunk_size = 2000
+
+    def get_purchase_queryset(self):
+        return SurveyPurchase.objects.defer("report_cache")
+
+    def get(self, request, *args, **kwargs):
+        serializer, content_type = EXPORT_FORMATS[self.kwargs["format"]]
+        rows = iter_responses(self.purchase, chunk_size=self.chunk_size)
+        response = StreamingHttpResponse(serializer(rows), content_type=content_type)
+        response["Content-Disposition"] = "attachment; filename=responses-%s.%s" % (
+            self.purchase.public_id, self.kwargs["format"])
+        return response
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class SurveyPurchaseIngest(SurveyPurchaseDetail):
+    """
+    Accepts a batch of responses collected offline as JSON in the form of
+    {"responses": [{"answers": {question_id: answer}, "created": "ISO 8601 date"}, ...]}.
+    Valid responses are saved and the errors of the invalid ones are reported by index.
+    Closed purchases don't accept responses, their report has already been generated.
+    Machine clients authenticate with the purchase's ingest token in an
+    "Authorization: Token <token>" header, other requests need the purchaser's session
+    and a CSRF token.
+    """
+    http_method_names = ["post"]
+    raise_exception = True
+    query_budget = None  # Depends on the size of the batch and the DB backend
+
+    def get_ingest_token(self):
+        scheme, __, token = self.request.META.get("HTTP_AUTHORIZATION", "").partition(" ")
+        return token.strip() if scheme.lower() == "token" else None
+
+    def dispatch(self, request, *args, **kwargs):
+        if self.get_ingest_token() is None:
+            # Session authenticated uploads still need the CSRF token
+            rejected = CsrfViewMiddleware(lambda request: None).process_view(
+                request, None, (), {})
+            if rejected is not None:
+                return rejected
+        return super(SurveyPurchaseIngest, self).dispatch(request, *args, **kwargs)
+
+    def test_func(self):
+        token = self.get_ingest_token()
+        if token is None:
+            return super(SurveyPurchaseIngest, self).test_func()
+        return bool(self.purchase.ingest_token) and \
+            constant_time_compare(token, self.purchase.ingest_token)
+
+    def post(self, request, *args, **kwargs):
+        if self.purchase.report_generated is not None:
+            return JsonResponse({"error": "The report of this purchase has been generated."},
+                                status=409)
+        try:
+            items = json.loads(request.body.decode("utf-8"))["responses"]
+        except (ValueError, TypeError, KeyError):
+            return JsonResponse({"error": "Expected a JSON object with a list of responses."},
+                                status=400)
+        if not isinstance(items, list):
+            return JsonResponse({"error": "Expected a list of responses."}, status=400)
+        if len(items) > settings.SURVEYS_INGEST_MAX_RESPONSES:
+            return JsonResponse({"error": "Upload at most %s responses at once." %
+                                 settings.SURVEYS_INGEST_MAX_RESPONSES}, status=400)
+
+        created, errors = ingest_responses(self.purchase, items)
+        return JsonResponse({"created": created, "errors": errors}, status=201 if created else 400)